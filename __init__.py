@@ -2,10 +2,16 @@ import logging
 import sys
 
 import bpy
+import bpy.utils.previews
+import hashlib
 import json
 import time
 import requests
 import io
+import os
+import glob
+import re
+import tempfile
 import tarfile
 from bpy.props import (StringProperty,
                        BoolProperty,
@@ -20,6 +26,11 @@ from bpy.types import (Panel,
 
 import threading
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 bl_info = {
     'name': 'Glacier Render',
     'description': '',
@@ -40,6 +51,31 @@ logging.basicConfig(stream=sys.stdout,
 logger = logging.getLogger(__name__)
 
 
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as asset_file:
+        for block in iter(lambda: asset_file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Files behind one path of bpy.utils.blend_paths: UDIM and UV tile tokens and # frame numbers in
+# the file name are matched against the tiles and frames on disk, a directory (caches, image
+# strips) stands for every file beneath it. Empty when nothing matches.
+def dependency_files(path):
+    if os.path.isfile(path):
+        return [path]
+    if os.path.isdir(path):
+        return sorted(os.path.join(directory, name) for directory, _, names in os.walk(path) for name in names)
+    directory, name = os.path.split(path)
+    pattern = glob.escape(name).replace('<UDIM>', '[0-9]' * 4).replace('<UVTILE>', 'u*_v*')
+    pattern = re.sub('#+', lambda match: '[0-9]' * len(match.group()), pattern)
+    if pattern == glob.escape(name):
+        return []
+    return sorted(match for match in glob.glob(os.path.join(glob.escape(directory), pattern))
+                  if os.path.isfile(match))
+
+
 class Backend:
     def __init__(self, no_write=False, insecure=False):
         self.task_refresh_delay = 0.2
@@ -58,6 +94,19 @@ class Backend:
         self.base_url = ''
         self.command_queue = []
         self.task_list = None
+        self.headers = {'Accept': 'application/msgpack, application/json' if msgpack is not None
+                        else 'application/json'}
+        self.submit_attempts = 6
+        self.max_backoff_seconds = 300
+        self.frame_preview = None
+        self.preview_task_id = ''
+        self.preview_frame_shown = None
+
+    # The server answers in msgpack when asked and able, bodies are decoded straight from bytes
+    def decode(self, response):
+        if response.headers.get('Content-Type', '').startswith('application/msgpack'):
+            return msgpack.unpackb(response.content)
+        return json.loads(response.content)
 
     def task_list_to_id_dict(self, task_list):
         task_dict = {}
@@ -72,35 +121,76 @@ class Backend:
         self.base_url = self.schema + self.address
         response = requests.get(f'{self.base_url}/login?'
                                 f'username={username}&'
-                                f'password={password}')
+                                f'password={password}',
+                                headers=self.headers)
         if response.status_code != 200:
             raise Exception(response.text)
-        self.session_id = json.loads(response.text)['session_id']
+        self.session_id = self.decode(response)['session_id']
         self.is_alive = True
         return True
 
-    def render(self, task_name, blend_file_path, start_frame, end_frame):
+    # A busy server answers 429 with Retry-After, waits grow until the last attempt
+    def post_with_backoff(self, url, file_path, **kwargs):
+        for attempt in range(self.submit_attempts):
+            with open(file_path, 'rb') as upload_file:
+                response = requests.post(url, files={'file': upload_file}, headers=self.headers, **kwargs)
+            if response.status_code != 429 or attempt == self.submit_attempts - 1:
+                break
+            time.sleep(min(max(float(response.headers.get('Retry-After', 1)), 2 ** attempt),
+                           self.max_backoff_seconds))
+        if response.status_code != 200:
+            raise Exception(response.text)
+        return self.decode(response)
+
+    # Files the .blend depends on are stored on the server by content, only the ones it lacks are sent.
+    # Returns the manifest of absolute path to sha256 that render passes along.
+    def upload_assets(self, asset_paths):
         if not self.is_alive:
             raise Exception('Connection is not alive')
-        response = requests.post(f'{self.base_url}/task/request?'
-                                 f'session_id={self.session_id}&'
-                                 f'start_frame={start_frame}&'
-                                 f'end_frame={end_frame}&'
-                                 f'task_name={task_name}',
-                                 files={'file': open(blend_file_path, 'rb')})
+        manifest = {os.path.abspath(path): file_sha256(path) for path in asset_paths}
+        response = requests.post(f'{self.base_url}/asset/missing?'
+                                 f'session_id={self.session_id}',
+                                 data={'sha256': sorted(set(manifest.values()))},
+                                 headers=self.headers)
         if response.status_code != 200:
             raise Exception(response.text)
-        return json.loads(response.text)
+        missing = set(self.decode(response)['missing'])
+        for path, sha256 in manifest.items():
+            if sha256 in missing:
+                self.post_with_backoff(f'{self.base_url}/asset/upload?'
+                                       f'session_id={self.session_id}&'
+                                       f'sha256={sha256}', path)
+                missing.discard(sha256)
+        return manifest
+
+    def render(self, task_name, blend_file_path, start_frame, end_frame, render_overrides=None, priority=0,
+               asset_paths=None):
+        if not self.is_alive:
+            raise Exception('Connection is not alive')
+        data = None
+        if asset_paths:
+            data = {'assets': json.dumps(self.upload_assets(asset_paths)),
+                    'blend_path': os.path.abspath(blend_file_path)}
+        return self.post_with_backoff(f'{self.base_url}/task/request?'
+                                      f'session_id={self.session_id}&'
+                                      f'start_frame={start_frame}&'
+                                      f'end_frame={end_frame}&'
+                                      f'task_name={task_name}&'
+                                      f'priority={priority}',
+                                      blend_file_path,
+                                      params=render_overrides,
+                                      data=data)
 
     def stat(self, task_id):
         if not self.is_alive:
             raise Exception('Connection is not alive')
         response = requests.get(f'{self.base_url}/task/stat?'
                                 f'session_id={self.session_id}&'
-                                f'task_id={task_id}')
+                                f'task_id={task_id}',
+                                headers=self.headers)
         if response.status_code != 200:
             raise Exception(response.text)
-        return json.loads(response.text)
+        return self.decode(response)
 
     def fetch(self, task_id, load_dir):
         if self.no_write:
@@ -109,7 +199,8 @@ class Backend:
             raise Exception('Connection is not alive')
         response = requests.get(f'{self.base_url}/task/result?'
                                 f'session_id={self.session_id}&'
-                                f'task_id={task_id}', stream=True)
+                                f'task_id={task_id}', stream=True,
+                                headers=self.headers)
         if response.status_code != 200:
             raise Exception(response.status_code)
         if self.no_write:
@@ -118,35 +209,74 @@ class Backend:
             tarfile.open(fileobj=tarball, format=tarfile.GNU_FORMAT).extractall(load_dir)
         return True
 
+    # Returns (offset to ask for next, new output); pass the returned offset back to tail
+    def log(self, task_id, offset=0):
+        if not self.is_alive:
+            raise Exception('Connection is not alive')
+        response = requests.get(f'{self.base_url}/task/log?'
+                                f'session_id={self.session_id}&'
+                                f'task_id={task_id}&'
+                                f'offset={offset}',
+                                headers=self.headers)
+        if response.status_code != 200:
+            raise Exception(response.text)
+        return int(response.headers['X-Next-Offset']), response.content.decode(errors='replace')
+
+    # Returns (frame, content type, image bytes) of the newest preview unless a frame is given
+    def preview(self, task_id, frame=None):
+        if not self.is_alive:
+            raise Exception('Connection is not alive')
+        response = requests.get(f'{self.base_url}/task/preview?'
+                                f'session_id={self.session_id}&'
+                                f'task_id={task_id}',
+                                params={'frame': frame} if frame is not None else None,
+                                headers=self.headers)
+        if response.status_code != 200:
+            raise Exception(response.text)
+        return int(response.headers['X-Frame']), response.headers['Content-Type'], response.content
+
+    # Kept in a temporary file for the panel to load, only the latest one is kept
+    def save_preview(self, task_id):
+        frame, content_type, data = self.preview(task_id)
+        path = os.path.join(tempfile.gettempdir(), f'glacier-{task_id}-{frame}.{content_type.split("/")[-1]}')
+        with open(path, 'wb') as preview_file:
+            preview_file.write(data)
+        if self.frame_preview is not None and self.frame_preview[2] != path:
+            os.remove(self.frame_preview[2])
+        self.frame_preview = (task_id, frame, path)
+
     def list_session_tasks(self):
         if not self.is_alive:
             raise Exception('Connection is not alive')
         response = requests.get(f'{self.base_url}/task/list?'
-                                f'session_id={self.session_id}')
+                                f'session_id={self.session_id}',
+                                headers=self.headers)
         if response.status_code != 200:
             raise Exception(response.text)
         logger.debug(response.text)
-        return self.task_list_to_id_dict(json.loads(response.text))
+        return self.task_list_to_id_dict(self.decode(response))
 
     def kill(self, task_id):
         if not self.is_alive:
             raise Exception('Connection is not alive')
         response = requests.get(f'{self.base_url}/task/kill?'
                                 f'session_id={self.session_id}&'
-                                f'task_id={task_id}')
+                                f'task_id={task_id}',
+                                headers=self.headers)
         if response.status_code != 200:
             raise Exception(response.text)
-        return task_id == json.loads(response.text)['task_id']
+        return task_id == self.decode(response)['task_id']
 
     def delete_task(self, task_id):
         if not self.is_alive:
             raise Exception('Connection is not alive')
         response = requests.get(f'{self.base_url}/task/delete?'
                                 f'session_id={self.session_id}&'
-                                f'task_id={task_id}')
+                                f'task_id={task_id}',
+                                headers=self.headers)
         if response.status_code != 200:
             raise Exception(response.text)
-        return task_id == json.loads(response.text)['task_id']
+        return task_id == self.decode(response)['task_id']
 
     def delete_session(self, session_id):
         if not self.is_alive:
@@ -154,10 +284,11 @@ class Backend:
         response = requests.get(f'{self.base_url}/session/remove?'
                                 f'username={self.username}&'
                                 f'password={self.password}&'
-                                f'session_id={session_id}')
+                                f'session_id={session_id}',
+                                headers=self.headers)
         if response.status_code != 200:
             raise Exception(response.text)
-        return session_id == json.loads(response.text)['session_id']
+        return session_id == self.decode(response)['session_id']
 
     def command_queue_processor(self):
         while not self.killed:
@@ -179,6 +310,8 @@ class Backend:
                         self.kill(*args)
                     elif func == 'delete':
                         self.delete_task(*args)
+                    elif func == 'preview':
+                        self.save_preview(*args)
                     else:
                         pass
                 except requests.exceptions.ConnectionError:
@@ -211,6 +344,12 @@ class Backend:
                     new_task.progress = new_task_data['progress']
                     new_task.time_left = '00:00:10'
                     logger.debug(f'+task {new_task}')
+                # The watched task's preview is refreshed once the server has made a newer one
+                watched_task = remote_task_dict.get(self.preview_task_id)
+                if watched_task is not None and watched_task.get('preview_frame') is not None \
+                        and watched_task['preview_frame'] != self.preview_frame_shown:
+                    self.preview_frame_shown = watched_task['preview_frame']
+                    self.command_queue.append(['preview', self.preview_task_id])
             else:
                 self.task_list.clear()
             time.sleep(self.task_refresh_delay)
@@ -219,6 +358,7 @@ class Backend:
 
 
 backend = Backend()
+preview_collections = {}
 
 
 def task_list_binder_from_context(context):
@@ -251,6 +391,7 @@ class WM_OT_ScheduleTask(Operator):
     bl_idname = 'wm.schedule_task'
     bl_label = 'Render'
     bl_description = 'Render current blend file'
+    render_overrides = None
 
     def execute(self, context):
         task_list_binder_from_context(context)
@@ -263,8 +404,20 @@ class WM_OT_ScheduleTask(Operator):
         task_name = bpy.path.basename(bpy.data.filepath)
         task_name = str(task_name).split('.')[0]
         blend_file_path = bpy.path.abspath(bpy.data.filepath)
-        bpy.ops.file.pack_all()
         bpy.ops.wm.save_as_mainfile(filepath=blend_file_path)
+        # Dependencies upload once by content instead of being packed into every .blend, a missing
+        # one would render as a pink texture so the task is not sent
+        asset_paths = []
+        unresolved_paths = []
+        for path in bpy.utils.blend_paths(absolute=True, packed=False, local=False):
+            files = dependency_files(path)
+            asset_paths += files
+            if not files:
+                unresolved_paths.append(path)
+        if unresolved_paths:
+            self.report({'ERROR'}, f'Missing dependencies: {", ".join(sorted(unresolved_paths)[:3])}'
+                                   f'{" and more" if len(unresolved_paths) > 3 else ""}')
+            return {'CANCELLED'}
         scene = context.scene
         if context.scene.glacier.is_animation:
             frame_start = scene.frame_start
@@ -272,10 +425,18 @@ class WM_OT_ScheduleTask(Operator):
         else:
             frame_start = scene.frame_current
             frame_end = scene.frame_current
-        backend.command_queue.append(['render', task_name, blend_file_path, frame_start, frame_end])
+        backend.command_queue.append(['render', task_name, blend_file_path, frame_start, frame_end,
+                                      self.render_overrides, 0, asset_paths])
         return{'FINISHED'}
 
 
+class WM_OT_SchedulePreview(WM_OT_ScheduleTask):
+    bl_idname = 'wm.schedule_preview'
+    bl_label = 'Preview'
+    bl_description = 'Render current blend file at reduced resolution, samples and frame rate'
+    render_overrides = {'preview': 1}
+
+
 class WM_OT_CancelTask(Operator):
     bl_label = 'Cancel'
     bl_idname = 'wm.cancel_task'
@@ -333,6 +494,26 @@ class WM_OT_DownloadTaskResult(Operator):
         return {'FINISHED'}
 
 
+class WM_OT_ShowFramePreview(Operator):
+    bl_label = 'Latest Frame'
+    bl_idname = 'wm.show_frame_preview'
+    bl_description = 'Show a downscaled preview of the last frame saved, updated as the task renders'
+
+    @classmethod
+    def poll(cls, context):
+        return context.scene.task_list
+
+    def execute(self, context):
+        task_list_binder_from_context(context)
+        if not backend.is_alive:
+            self.report({'ERROR'}, 'Backend is not connected')
+            return {'CANCELLED'}
+        selected_task = context.scene.task_list[bpy.context.scene.list_index]
+        backend.preview_task_id = selected_task.id
+        backend.preview_frame_shown = None
+        return {'FINISHED'}
+
+
 class MY_UL_List(UIList):
     def draw_item(self, context, layout, data, task, icon, active_data,
                   active_propname, index):
@@ -400,9 +581,10 @@ class RENDER_PT_MainPanel(Panel, RENDER_PT_Any):
         else:
             row.split(factor=0.5).prop(scene, 'frame_current')
 
-        row = layout.row()
+        row = layout.row(align=True)
         row.scale_y = 2
         row.operator('wm.schedule_task', icon='ADD')
+        row.operator('wm.schedule_preview', icon='HIDE_OFF')
 
     def glacier_disabled(self):
         layout = self.layout
@@ -435,6 +617,16 @@ class RENDER_PT_ManagementPanel(Panel, RENDER_PT_Any):
             row.operator('wm.cancel_task', icon='CANCEL')
             row.operator('wm.download_task_result', icon='TRIA_DOWN_BAR')
             row.operator('wm.delete_task', icon='TRASH')
+            layout.operator('wm.show_frame_preview', icon='IMAGE_DATA')
+
+        if backend.frame_preview is not None and backend.frame_preview[0] == backend.preview_task_id:
+            _, frame, path = backend.frame_preview
+            frame_previews = preview_collections['frames']
+            if path not in frame_previews:
+                frame_previews.clear()
+                frame_previews.load(path, path, 'IMAGE')
+            layout.template_icon(icon_value=frame_previews[path].icon_id, scale=10)
+            layout.label(text=f'Frame {frame}')
 
 
 def key_path_update_callback(self,  context):
@@ -467,9 +659,11 @@ class GlacierProperties(PropertyGroup):
 classes = (
     GlacierProperties,
     WM_OT_ScheduleTask,
+    WM_OT_SchedulePreview,
     WM_OT_CancelTask,
     WM_OT_DeleteTask,
     WM_OT_DownloadTaskResult,
+    WM_OT_ShowFramePreview,
     RENDER_PT_MainPanel,
     RENDER_PT_ManagementPanel,
     MY_UL_List,
@@ -480,6 +674,7 @@ def register():
     from bpy.utils import register_class
     for cls in classes:
         register_class(cls)
+    preview_collections['frames'] = bpy.utils.previews.new()
     bpy.types.Scene.glacier = PointerProperty(type=GlacierProperties)
     bpy.types.Scene.task_list = CollectionProperty(type=ListItem)
     bpy.types.Scene.list_index = bpy.props.IntProperty(name='Index for task_list',
@@ -497,6 +692,7 @@ def unregister():
     from bpy.utils import unregister_class
     for cls in reversed(classes):
         unregister_class(cls)
+    bpy.utils.previews.remove(preview_collections.pop('frames'))
     del bpy.types.Scene.glacier
     del bpy.types.Scene.task_list
     del bpy.types.Scene.list_index
@@ -0,0 +1,187 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import sys
+import time
+
+from frontend import Backend, file_sha256
+
+# Headless batch submission: renders every entry of a manifest, one JSON object per line
+#   {"file": "shot010.blend", "start_frame": 1, "end_frame": 120, "name": "shot010",
+#    "overrides": {"samples": 64}, "priority": 0}
+# Identical entries share one task, and entries matching a task already in the session (same
+# file contents, frame range, name, overrides and priority, not failed) are picked up instead
+# of uploaded again, so a rerun after an interruption resumes the batch. Results are downloaded
+# as soon as each task is packed, and again on a rerun while the server still keeps them, into
+# a directory named after the entry, suffixed with a hash of its key when names repeat. Exit
+# status is 0 when every entry was fetched, 1 otherwise.
+
+FINAL_STATES = ('PACKED', 'DONE', 'KILLED', 'FAILED(BLENDER)', 'FAILED(TAR)')
+REUSABLE_STATES = ('CREATED', 'SCHEDULED', 'RUNNING', 'COMPLETED', 'COMPRESSING', 'PACKED', 'DONE')
+FETCHABLE_STATES = ('PACKED', 'DONE')
+
+
+def read_manifest(path):
+    entries = []
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path) as manifest:
+        for line_number, line in enumerate(manifest, 1):
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            entry = json.loads(line)
+            if 'file' not in entry or 'start_frame' not in entry or 'end_frame' not in entry:
+                raise Exception(f'{path}:{line_number}: file, start_frame and end_frame are required')
+            entry['file'] = os.path.join(base_dir, entry['file'])
+            entry.setdefault('name', os.path.splitext(os.path.basename(entry['file']))[0])
+            entry.setdefault('overrides', {})
+            entry.setdefault('priority', 0)
+            entries.append(entry)
+    return entries
+
+
+# The server stores overrides typed and enums upper-cased, both sides are compared as that text
+def overrides_key(overrides):
+    return json.dumps({name: str(value).upper() for name, value in overrides.items()}, sort_keys=True)
+
+
+def submission_key(entry, blend_sha256):
+    return (blend_sha256, int(entry['start_frame']), int(entry['end_frame']), entry['name'],
+            overrides_key(entry['overrides']), int(entry['priority']))
+
+
+def task_key(task):
+    return (task.get('blend_sha256'), task['start_frame'], task['end_frame'], task['task_name'],
+            overrides_key(json.loads(task.get('render_overrides') or '{}')), int(task.get('priority') or 0))
+
+
+class Batch:
+    def __init__(self, backend, entries, output_dir, parallel):
+        self.backend = backend
+        self.entries = entries
+        self.output_dir = output_dir
+        self.parallel = parallel
+        self.task_id_by_key = {}
+        self.keys = []
+        self.tasks_by_id = {}
+        self.fetched_task_ids = set()
+        self.errors_by_key = {}
+
+    def submit(self):
+        with concurrent.futures.ThreadPoolExecutor(self.parallel) as pool:
+            blend_sha256s = list(pool.map(file_sha256, [entry['file'] for entry in self.entries]))
+        self.keys = [submission_key(entry, blend_sha256) for entry, blend_sha256 in zip(self.entries, blend_sha256s)]
+        for task in self.backend.list_session_tasks().values():
+            key = task_key(task)
+            if task['state'] in REUSABLE_STATES and key in self.keys:
+                self.task_id_by_key.setdefault(key, task['task_id'])
+        entries_by_key = {}
+        for key, entry in zip(self.keys, self.entries):
+            if key not in self.task_id_by_key:
+                entries_by_key.setdefault(key, entry)
+        reused = len(set(self.keys)) - len(entries_by_key)
+        print(f'{len(self.entries)} entries, {len(set(self.keys))} distinct, {reused} already on the server, '
+              f'uploading {len(entries_by_key)}')
+        with concurrent.futures.ThreadPoolExecutor(self.parallel) as pool:
+            futures_by_key = {key: pool.submit(self.backend.render, entry['name'], entry['file'],
+                                               entry['start_frame'], entry['end_frame'],
+                                               entry['overrides'] or None, entry['priority'])
+                              for key, entry in entries_by_key.items()}
+            for key, future in futures_by_key.items():
+                try:
+                    self.task_id_by_key[key] = future.result()['task_id']
+                except Exception as e:
+                    self.errors_by_key[key] = f'upload failed: {e}'
+                    print(f'{key[3]}: upload failed: {e}', file=sys.stderr)
+
+    # One list request per poll covers every task of the batch
+    def watch(self, poll_seconds, timeout_seconds):
+        deadline = time.monotonic() + timeout_seconds if timeout_seconds else None
+        pending_task_ids = set(self.task_id_by_key.values())
+        last_line_by_task_id = {}
+        while pending_task_ids:
+            try:
+                self.tasks_by_id = self.backend.list_session_tasks()
+            except Exception as e:
+                print(f'poll failed: {e}', file=sys.stderr)
+                time.sleep(poll_seconds)
+                continue
+            for task_id in list(pending_task_ids):
+                task = self.tasks_by_id.get(task_id)
+                if task is None:
+                    pending_task_ids.discard(task_id)
+                    continue
+                line = f'{task["task_name"]}: {task["state"]} {task["frames_done"] or 0} frames'
+                if last_line_by_task_id.get(task_id) != line:
+                    print(line)
+                    last_line_by_task_id[task_id] = line
+                if task['state'] in FETCHABLE_STATES:
+                    self.fetch(task)
+                if task['state'] in FINAL_STATES:
+                    pending_task_ids.discard(task_id)
+            if deadline is not None and time.monotonic() > deadline:
+                print(f'timed out with {len(pending_task_ids)} task(s) unfinished', file=sys.stderr)
+                break
+            if pending_task_ids:
+                time.sleep(poll_seconds)
+
+    def target_dir(self, key):
+        name = key[3]
+        if sum(1 for other_key in set(self.keys) if other_key[3] == name) == 1:
+            return os.path.join(self.output_dir, name)
+        return os.path.join(self.output_dir, f'{name}-{hashlib.sha256(repr(key).encode()).hexdigest()[:8]}')
+
+    def fetch(self, task):
+        for key, task_id in self.task_id_by_key.items():
+            if task_id != task['task_id']:
+                continue
+            target_dir = self.target_dir(key)
+            try:
+                self.backend.fetch(task['task_id'], target_dir)
+                self.fetched_task_ids.add(task['task_id'])
+                print(f'{task["task_name"]}: fetched to {target_dir}')
+            except Exception as e:
+                print(f'{task["task_name"]}: fetch failed: {e}', file=sys.stderr)
+
+    def summary(self):
+        lines = [f'{"name":<24} {"task":<32} {"frames":>6}  state']
+        is_complete = True
+        for key in dict.fromkeys(self.keys):
+            task_id = self.task_id_by_key.get(key)
+            task = self.tasks_by_id.get(task_id, {})
+            if task_id in self.fetched_task_ids:
+                state = 'FETCHED'
+            else:
+                state = self.errors_by_key.get(key) or task.get('state', 'MISSING')
+                is_complete = False
+            lines.append(f'{key[3]:<24} {task_id or "-":<32} {task.get("frames_done") or 0:>6}  {state}')
+        return '\n'.join(lines), is_complete
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Submit a manifest of .blend files and collect the results')
+    parser.add_argument('manifest', help='JSON lines of file, start_frame, end_frame and optional name, '
+                                         'overrides and priority')
+    parser.add_argument('--address', default=os.environ.get('GLACIER_ADDRESS', 'localhost:8888'))
+    parser.add_argument('--username', default=os.environ.get('GLACIER_USER', ''))
+    parser.add_argument('--password', default=os.environ.get('GLACIER_PASSWORD', ''),
+                        help='GLACIER_PASSWORD by default, which keeps it out of the process list')
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--parallel', type=int, default=4, help='concurrent uploads')
+    parser.add_argument('--poll-seconds', type=float, default=2.0)
+    parser.add_argument('--timeout', type=float, default=0, help='seconds to wait for the batch, 0 waits forever')
+    args = parser.parse_args()
+
+    backend = Backend()
+    backend.connect(args.address, args.username, args.password)
+    batch = Batch(backend, read_manifest(args.manifest), args.output_dir, args.parallel)
+    batch.submit()
+    batch.watch(args.poll_seconds, args.timeout)
+    summary, is_complete = batch.summary()
+    print(summary)
+    sys.exit(0 if is_complete else 1)
+
+
+if __name__ == '__main__':
+    main()
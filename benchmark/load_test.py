@@ -0,0 +1,163 @@
+import argparse
+import collections
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(REPO_DIR, 'glacier-backend')
+STUB_BLENDER = os.path.join(REPO_DIR, 'benchmark', 'stub_blender.py')
+sys.path.insert(0, REPO_DIR)
+
+import minimal_blend  # noqa: E402
+from frontend import Backend  # noqa: E402
+
+USER = 'bench'
+PASSWORD = 'bench'
+FINAL_STATES = ('PACKED', 'DONE', 'KILLED', 'FAILED(BLENDER)', 'FAILED(TAR)')
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# The socket opens before the database is connected, /readyz answers 200 once the API is usable
+def wait_for_ready(port, process, timeout=60):
+    end_time = time.monotonic() + timeout
+    while time.monotonic() < end_time:
+        if process.poll() is not None:
+            raise Exception(f'server exited with code {process.returncode}')
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/readyz', timeout=1):
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise Exception(f'server is not ready after {timeout}s')
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples_by_operation = collections.defaultdict(list)
+        self.errors_by_operation = collections.Counter()
+
+    def timed(self, operation, function, *args):
+        start_time = time.perf_counter()
+        try:
+            return function(*args)
+        except Exception:
+            with self.lock:
+                self.errors_by_operation[operation] += 1
+            raise
+        finally:
+            with self.lock:
+                self.samples_by_operation[operation].append(time.perf_counter() - start_time)
+
+    def report(self):
+        lines = [f'{"operation":<10} {"count":>7} {"errors":>7} {"p50 ms":>10} {"p99 ms":>10} {"max ms":>10}']
+        for operation, samples in sorted(self.samples_by_operation.items()):
+            lines.append(f'{operation:<10} {len(samples):>7} {self.errors_by_operation[operation]:>7} '
+                         f'{1000 * percentile(samples, 0.50):>10.2f} '
+                         f'{1000 * percentile(samples, 0.99):>10.2f} '
+                         f'{1000 * max(samples):>10.2f}')
+        return '\n'.join(lines)
+
+
+def client(args, port, blend_file_path, output_dir, recorder, finished_states):
+    backend = Backend()
+    recorder.timed('login', backend.connect, f'127.0.0.1:{port}', USER, PASSWORD)
+    for task_index in range(args.tasks_per_client):
+        task_id = recorder.timed('spawn', backend.render, f'bench{task_index}', blend_file_path,
+                                 1, args.frames, {'preview': 1} if args.preview else None)['task_id']
+        state = ''
+        while state not in FINAL_STATES:
+            time.sleep(args.poll_delay)
+            state = recorder.timed('stat', backend.stat, task_id)['state']
+            recorder.timed('list', backend.list_session_tasks)
+        if state == 'PACKED':
+            recorder.timed('result', backend.fetch, task_id, os.path.join(output_dir, task_id))
+        with recorder.lock:
+            finished_states[state] += 1
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='glacier-bench-')
+    upload_facility = os.path.join(work_dir, 'uploads')
+    output_dir = os.path.join(work_dir, 'results')
+    os.mkdir(upload_facility)
+    os.mkdir(output_dir)
+    blend_file_path = args.blend
+    if not blend_file_path:
+        blend_file_path = os.path.join(work_dir, 'bench.blend')
+        minimal_blend.write_blend(blend_file_path, args.blend_size)
+    port = args.port or free_port()
+    environment = dict(os.environ,
+                       DB_URL=args.db_url or f'sqlite:///{work_dir}/glacier.sqlite',
+                       DB_HOST='localhost', DB_PORT='5432', DB_NAME='glacier', DB_USER='glacier', DB_PASS='glacier',
+                       UPLOAD_FACILITY=upload_facility,
+                       BLENDER_BIN=STUB_BLENDER,
+                       SERVER_PORT=str(port),
+                       STUB_FRAME_SECONDS=str(args.frame_seconds),
+                       GLACIER_USER=USER,
+                       GLACIER_PASSWORD=PASSWORD)
+    subprocess.run([sys.executable, 'useradd.py'], cwd=BACKEND_DIR, env=environment, check=True)
+    server_log_path = os.path.join(work_dir, 'server.log')
+    with open(server_log_path, 'wb') as server_log:
+        server = subprocess.Popen([sys.executable, 'server.py'], cwd=BACKEND_DIR, env=environment,
+                                  stdout=server_log, stderr=subprocess.STDOUT)
+    try:
+        wait_for_ready(port, server)
+        recorder = LatencyRecorder()
+        finished_states = collections.Counter()
+        threads = [threading.Thread(target=client,
+                                    args=(args, port, blend_file_path, output_dir, recorder, finished_states))
+                   for _ in range(args.clients)]
+        start_time = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall_time = time.monotonic() - start_time
+    finally:
+        server.terminate()
+        server.wait()
+    print(recorder.report())
+    print(f'tasks: {dict(finished_states)} in {wall_time:.1f}s, '
+          f'{60 * finished_states["PACKED"] / wall_time:.2f} packed tasks/min')
+    print(f'server log: {server_log_path}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive concurrent clients against a server with a stub Blender')
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--tasks-per-client', type=int, default=3)
+    parser.add_argument('--frames', type=int, default=5)
+    parser.add_argument('--frame-seconds', type=float, default=0.2)
+    parser.add_argument('--poll-delay', type=float, default=0.2)
+    parser.add_argument('--preview', action='store_true', help='submit with the preview render preset')
+    parser.add_argument('--blend', default='', help='file to upload, a generated minimal .blend by default')
+    parser.add_argument('--blend-size', type=int, default=1 << 20)
+    parser.add_argument('--db-url', default='', help='SQLAlchemy URL, a fresh SQLite file by default')
+    parser.add_argument('--port', type=int, default=0)
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
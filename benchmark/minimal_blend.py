@@ -0,0 +1,83 @@
+import struct
+
+# Writes a small but well-formed .blend: a struct catalogue covering the fields the server
+# reads at upload time, one scene with Cycles samples stored as ID properties, and an
+# opaque block padding the file to the requested size.
+
+STRUCTS = [
+    ('ListBase', [('void', '*first'), ('void', '*last')]),
+    ('IDPropertyData', [('void', '*pointer'), ('ListBase', 'group'), ('int', 'val'), ('int', 'val2')]),
+    ('IDProperty', [('IDProperty', '*next'), ('IDProperty', '*prev'), ('char', 'type'), ('char', 'subtype'),
+                    ('short', 'flag'), ('char', 'name[64]'), ('int', 'saved'), ('IDPropertyData', 'data'),
+                    ('int', 'len'), ('int', 'totallen')]),
+    ('ID', [('char', 'name[66]'), ('short', 'flag'), ('int', 'tag'), ('IDProperty', '*properties')]),
+    ('RenderData', [('int', 'sfra'), ('int', 'efra'), ('int', 'frame_step'), ('int', 'xsch'), ('int', 'ysch'),
+                    ('short', 'size'), ('short', 'pad'), ('char', 'engine[32]')]),
+    ('SceneEEVEE', [('int', 'taa_render_samples'), ('int', 'pad')]),
+    ('Scene', [('ID', 'id'), ('RenderData', 'r'), ('SceneEEVEE', 'eevee')]),
+    ('FileGlobal', [('char', 'subvstr[4]'), ('Scene', '*curscene')]),
+]
+PRIMITIVE_LENGTHS = {'void': 0, 'char': 1, 'short': 2, 'int': 4}
+SCENE_POINTER = 0x1000
+PROPERTIES_POINTER = 0x2000
+CYCLES_POINTER = 0x3000
+SAMPLES_POINTER = 0x4000
+
+
+def pad4(data):
+    return data + b'\x00' * (-len(data) % 4)
+
+
+def struct_catalogue():
+    type_names = list(PRIMITIVE_LENGTHS) + [name for name, _ in STRUCTS]
+    names = []
+    for _, fields in STRUCTS:
+        for _, field_name in fields:
+            if field_name not in names:
+                names.append(field_name)
+    lengths = dict(PRIMITIVE_LENGTHS)
+    for name, fields in STRUCTS:
+        lengths[name] = sum(8 if field_name.startswith('*') else
+                            lengths[field_type] * int(field_name.split('[')[1].rstrip(']'))
+                            if '[' in field_name else lengths[field_type]
+                            for field_type, field_name in fields)
+    data = b'SDNA' + b'NAME' + struct.pack('<i', len(names))
+    data = pad4(data + b''.join(name.encode() + b'\x00' for name in names))
+    data += b'TYPE' + struct.pack('<i', len(type_names))
+    data = pad4(data + b''.join(name.encode() + b'\x00' for name in type_names))
+    data = pad4(data + b'TLEN' + struct.pack(f'<{len(type_names)}h', *(lengths[name] for name in type_names)))
+    data += b'STRC' + struct.pack('<i', len(STRUCTS))
+    for name, fields in STRUCTS:
+        data += struct.pack('<hh', type_names.index(name), len(fields))
+        for field_type, field_name in fields:
+            data += struct.pack('<hh', type_names.index(field_type), names.index(field_name))
+    return data, lengths
+
+
+def block(code, old_pointer, payload):
+    return struct.pack('<4siQii', code, len(payload), old_pointer, 0, 1) + payload
+
+
+def id_property(name, property_type, next_pointer=0, first_child=0, value=0):
+    return (struct.pack('<QQbbh', next_pointer, 0, property_type, 0, 0) + name.encode().ljust(64, b'\x00')
+            + struct.pack('<i', 0) + struct.pack('<QQQii', 0, first_child, first_child, value, 0)
+            + struct.pack('<ii', 0, 0))
+
+
+def write_blend(path, size=0, start_frame=1, end_frame=250, resolution=(1920, 1080), samples=128):
+    catalogue, _ = struct_catalogue()
+    scene = (b'SCScene'.ljust(66, b'\x00') + struct.pack('<hiQ', 0, 0, PROPERTIES_POINTER)
+             + struct.pack('<iiiiihh', start_frame, end_frame, 1, resolution[0], resolution[1], 100, 0)
+             + b'CYCLES'.ljust(32, b'\x00') + struct.pack('<ii', 64, 0))
+    data = b'BLENDER-v305'
+    data += block(b'GLOB', 0, b'305\x00' + struct.pack('<Q', SCENE_POINTER))
+    data += block(b'SC\x00\x00', SCENE_POINTER, scene)
+    data += block(b'DATA', PROPERTIES_POINTER, id_property('', 6, first_child=CYCLES_POINTER))
+    data += block(b'DATA', CYCLES_POINTER, id_property('cycles', 6, first_child=SAMPLES_POINTER))
+    data += block(b'DATA', SAMPLES_POINTER, id_property('samples', 1, value=samples))
+    padding = max(0, size - len(data) - len(catalogue) - 64)
+    data += block(b'TEST', 0x5000, b'\x00' * padding)
+    data += block(b'DNA1', 0, catalogue)
+    data += struct.pack('<4siQii', b'ENDB', 0, 0, 0, 0)
+    with open(path, 'wb') as blend_file:
+        blend_file.write(data)
@@ -0,0 +1,141 @@
+import argparse
+import heapq
+import itertools
+import json
+import math
+import os
+import random
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'glacier-backend'))
+
+import scheduling  # noqa: E402
+
+# Discrete-event replay of submission traces through the real scheduling.Scheduler.
+# A trace is JSON lines of {"submitted_at": s, "user": str, "frames": n, "frame_cost": s},
+# as written by RenderBus when SCHEDULER_TRACE_PATH is set.
+
+
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def load_trace(trace_path):
+    with open(trace_path) as trace_file:
+        entries = [json.loads(line) for line in trace_file if line.strip()]
+    first_submission = min(entry['submitted_at'] for entry in entries)
+    for entry in entries:
+        entry['submitted_at'] -= first_submission
+    return entries
+
+
+def synthetic_trace(task_count, user_count, seed):
+    generator = random.Random(seed)
+    entries = []
+    submitted_at = 0.0
+    for _ in range(task_count):
+        submitted_at += generator.expovariate(1 / 300)
+        entries.append({'submitted_at': submitted_at,
+                        'user': f'user{generator.randrange(user_count)}',
+                        'frames': generator.choice((1, 1, 10, 50, 250)),
+                        'frame_cost': generator.lognormvariate(1.5, 0.8)})
+    return entries
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def jain_index(values):
+    if not values:
+        return 1.0
+    return sum(values) ** 2 / (len(values) * sum(value * value for value in values))
+
+
+def simulate(trace, slot_count, chunk_size, policy_name, startup_seconds):
+    clock = VirtualClock()
+    slots = [scheduling.Slot(f'sim{index}') for index in range(slot_count)]
+    scheduler = scheduling.Scheduler(slots, scheduling.policies[policy_name](), clock)
+    sequence = itertools.count()
+    events = [(entry['submitted_at'], next(sequence), 'submit', (task_index, entry))
+              for task_index, entry in enumerate(trace)]
+    heapq.heapify(events)
+    cost_by_task = {}
+    jobs_left_by_task = {}
+    finished_at_by_task = {}
+    waits = []
+    while events:
+        clock.now, _, kind, payload = heapq.heappop(events)
+        if kind == 'submit':
+            task_index, entry = payload
+            cost_by_task[task_index] = entry['frame_cost']
+            jobs = [scheduling.Job(task_index, entry['user'], chunk_start, chunk_end)
+                    for chunk_start, chunk_end in scheduling.split_frames(1, entry['frames'], chunk_size)]
+            # Oracle predictions, the best case for the history-driven policies
+            for job in jobs:
+                job.expected_seconds = job.frame_count * entry['frame_cost']
+            jobs_left_by_task[task_index] = len(jobs)
+            scheduler.submit(jobs)
+        else:
+            scheduler.release(payload)
+            jobs_left_by_task[payload.task_id] -= 1
+            if not jobs_left_by_task[payload.task_id]:
+                finished_at_by_task[payload.task_id] = clock.now
+        for job in scheduler.dispatch():
+            waits.append(job.started_at - job.queued_at)
+            duration = startup_seconds + job.frame_count * cost_by_task[job.task_id] / job.slot.speed
+            heapq.heappush(events, (clock.now + duration, next(sequence), 'finish', job))
+    makespan = max(finished_at_by_task.values()) - min(entry['submitted_at'] for entry in trace)
+    slowdowns_by_user = {}
+    for task_index, entry in enumerate(trace):
+        alone = startup_seconds + entry['frames'] * entry['frame_cost']
+        turnaround = finished_at_by_task[task_index] - entry['submitted_at']
+        slowdowns_by_user.setdefault(entry['user'], []).append(turnaround / alone)
+    mean_slowdowns = [sum(values) / len(values) for values in slowdowns_by_user.values()]
+    return {'policy': policy_name,
+            'slots': slot_count,
+            'chunk_size': chunk_size,
+            'makespan': makespan,
+            'wait_p50': percentile(waits, 0.50),
+            'wait_p99': percentile(waits, 0.99),
+            'utilization': sum(slot.busy_seconds for slot in slots) / (slot_count * makespan) if makespan else 0.0,
+            'fairness': jain_index(mean_slowdowns),
+            'worst_user_slowdown': max(mean_slowdowns)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a submission trace against scheduler settings')
+    parser.add_argument('trace', nargs='?', default='', help='JSON lines trace, synthetic when omitted')
+    parser.add_argument('--slots', default='1', help='comma separated slot counts to compare')
+    parser.add_argument('--chunk-size', default='0', help='comma separated chunk sizes, 0 renders a task whole')
+    parser.add_argument('--policy', default=','.join(scheduling.policies), help='comma separated policies')
+    parser.add_argument('--startup-seconds', type=float, default=15.0, help='Blender launch cost per chunk')
+    parser.add_argument('--synthetic-tasks', type=int, default=200)
+    parser.add_argument('--synthetic-users', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        trace = synthetic_trace(args.synthetic_tasks, args.synthetic_users, args.seed)
+    print(f'{"policy":<8} {"slots":>5} {"chunk":>5} {"makespan s":>12} {"wait p50 s":>11} {"wait p99 s":>11} '
+          f'{"util":>6} {"fairness":>8} {"worst slowdown":>14}')
+    for policy_name, slot_count, chunk_size in itertools.product(args.policy.split(','),
+                                                                 [int(value) for value in args.slots.split(',')],
+                                                                 [int(value) for value in args.chunk_size.split(',')]):
+        result = simulate(trace, slot_count, chunk_size, policy_name, args.startup_seconds)
+        print(f'{result["policy"]:<8} {result["slots"]:>5} {result["chunk_size"]:>5} {result["makespan"]:>12.1f} '
+              f'{result["wait_p50"]:>11.1f} {result["wait_p99"]:>11.1f} {result["utilization"]:>6.1%} '
+              f'{result["fairness"]:>8.3f} {result["worst_user_slowdown"]:>14.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+import json
+import os
+import re
+import struct
+import sys
+import time
+import zlib
+
+# Stands in for BLENDER_BIN: accepts the command line Renderer builds, prints Cycles-like
+# progress and writes a placeholder PNG per frame. STUB_FRAME_SECONDS sets the per-frame
+# render time, STUB_SAMPLES the number of "Sample N/M" lines per frame. Without -a it answers
+# the render device probe with STUB_DEVICES, comma separated TYPE:id entries. Given
+# --python blender_worker.py it speaks the warm pool protocol on stdin/stdout instead.
+# STUB_CRASH_FRAMES and STUB_HANG_FRAMES list frames, as N or N@device_id to affect only the
+# pinned device, on which the stub exits with a segfault code or stops printing for an hour.
+
+DEVICE_ID_PATTERN = re.compile(r"device.use = device.id == '([^']*)'")
+
+
+def placeholder_png():
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    header = struct.pack('>IIBBBBB', 1, 1, 8, 2, 0, 0, 0)
+    pixels = zlib.compress(b'\x00\x80\x80\x80')
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', pixels) + chunk(b'IEND', b'')
+
+
+def clock(seconds):
+    return f'{int(seconds // 60):02d}:{seconds % 60:05.2f}'
+
+
+def parse_args(argv):
+    args = {'output': '/tmp/', 'start': 1, 'end': 1, 'step': 1, 'blend': '', 'animation': False, 'python': '',
+            'device_id': ''}
+    index = 0
+    while index < len(argv):
+        arg = argv[index]
+        if arg == '-b':
+            args['blend'] = argv[index + 1]
+            index += 1
+        elif arg == '-o':
+            args['output'] = argv[index + 1]
+            index += 1
+        elif arg == '-s':
+            args['start'] = int(argv[index + 1])
+            index += 1
+        elif arg == '-e':
+            args['end'] = int(argv[index + 1])
+            index += 1
+        elif arg == '-j':
+            args['step'] = int(argv[index + 1])
+            index += 1
+        elif arg == '--python-expr':
+            device_match = DEVICE_ID_PATTERN.search(argv[index + 1])
+            if device_match:
+                args['device_id'] = device_match.group(1)
+            index += 1
+        elif arg == '-F':
+            index += 1
+        elif arg == '--python':
+            args['python'] = argv[index + 1]
+            index += 1
+        elif arg == '-a':
+            args['animation'] = True
+        elif arg == '--':
+            break
+        index += 1
+    return args
+
+
+def emit(line):
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+
+def is_faulty(variable, frame, device_id):
+    for entry in filter(None, os.environ.get(variable, '').split(',')):
+        fault_frame, _, fault_device_id = entry.partition('@')
+        if int(fault_frame) == frame and fault_device_id in ('', device_id):
+            return True
+    return False
+
+
+def render_frames(output, start, end, step, frame_seconds, samples, device_id=''):
+    png = placeholder_png()
+    for frame in range(start, end + 1, step):
+        if is_faulty('STUB_CRASH_FRAMES', frame, device_id):
+            emit(f'Fra:{frame} Mem:12.40M (Peak 14.02M) | Segmentation fault')
+            os._exit(139)
+        if is_faulty('STUB_HANG_FRAMES', frame, device_id):
+            time.sleep(3600)
+        frame_start_time = time.monotonic()
+        prefix = f'Fra:{frame} Mem:12.40M (Peak 14.02M)'
+        emit(f'{prefix} | Time:00:00.00 | Mem:0.00M, Peak:0.00M | Scene, ViewLayer | Synchronizing object | Cube')
+        for sample in range(1, samples + 1):
+            time.sleep(frame_seconds / samples)
+            elapsed = time.monotonic() - frame_start_time
+            remaining = elapsed / sample * (samples - sample)
+            emit(f'{prefix} | Time:{clock(elapsed)} | Remaining:{clock(remaining)} | '
+                 f'Mem:1.21M, Peak:1.21M | Scene, ViewLayer | Sample {sample}/{samples}')
+        emit(f'{prefix} | Time:{clock(time.monotonic() - frame_start_time)} | '
+             f'Mem:1.21M, Peak:1.21M | Scene, ViewLayer | Finished')
+        frame_path = os.path.join(output, f'{frame:04d}.png')
+        with open(frame_path, 'wb') as frame_file:
+            frame_file.write(png)
+        emit(f"Saved: '{frame_path}'")
+        emit(f' Time: {clock(time.monotonic() - frame_start_time)} (Saving: 00:00.00)')
+        emit('')
+
+
+def serve_worker(frame_seconds, samples):
+    emit('GLACIER_WORKER_READY')
+    loaded_key = None
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        key = (job['blend_sha256'] or job['blend'], tuple(job['setup']))
+        if key != loaded_key:
+            time.sleep(frame_seconds)
+            emit(f'Read blend: {job["blend"]}')
+            loaded_key = key
+        device_ids = [match.group(1) for match in map(DEVICE_ID_PATTERN.search, job['setup']) if match]
+        render_frames(job['output'], job['start'], job['end'], job['step'], frame_seconds, samples,
+                      device_ids[0] if device_ids else '')
+        emit('GLACIER_WORKER_DONE 0')
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    frame_seconds = float(os.environ.get('STUB_FRAME_SECONDS', '0.5'))
+    samples = int(os.environ.get('STUB_SAMPLES', '16'))
+    emit('Blender 3.5.1 (hash e1ccd9d4a1d3 built 2023-04-24 23:31:28)')
+    if args['python'].endswith('blender_worker.py'):
+        serve_worker(frame_seconds, samples)
+        return
+    if not args['animation']:
+        for device in filter(None, os.environ.get('STUB_DEVICES', '').split(',')):
+            device_type, device_id = device.split(':', 1)
+            emit(f'GLACIER_DEVICE\t{device_type}\t{device_id}\tStub {device_type} {device_id}')
+        emit('Blender quit')
+        return
+    emit(f'Read blend: {args["blend"]}')
+    render_frames(args['output'], args['start'], args['end'], args['step'], frame_seconds, samples,
+                  args['device_id'])
+    emit('Blender quit')
+
+
+if __name__ == '__main__':
+    main()
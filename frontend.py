@@ -1,10 +1,25 @@
+import hashlib
 import json
+import os
 import time
 
 import requests
 import io
 import tarfile
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as asset_file:
+        for block in iter(lambda: asset_file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
 
 class Backend:
     def __init__(self, no_write=False):
@@ -19,6 +34,16 @@ class Backend:
         self.base_url = ''
         self.command_queue = []
         self.task_list = None
+        self.headers = {'Accept': 'application/msgpack, application/json' if msgpack is not None
+                        else 'application/json'}
+        self.submit_attempts = 6
+        self.max_backoff_seconds = 300
+
+    # The server answers in msgpack when asked and able, bodies are decoded straight from bytes
+    def decode(self, response):
+        if response.headers.get('Content-Type', '').startswith('application/msgpack'):
+            return msgpack.unpackb(response.content)
+        return json.loads(response.content)
 
     def task_list_to_id_dict(self, task_list):
         task_dict = {}
@@ -33,35 +58,76 @@ class Backend:
         self.base_url = self.schema + self.address
         response = requests.get(f'{self.base_url}/login?'
                                 f'username={username}&'
-                                f'password={password}')
+                                f'password={password}',
+                                headers=self.headers)
         if response.status_code != 200:
             raise Exception(response.text)
-        self.session_id = json.loads(response.text)['session_id']
+        self.session_id = self.decode(response)['session_id']
         self.is_alive = 1
         return True
 
-    def render(self, task_name, blend_file_path, start_frame, end_frame):
+    # A busy server answers 429 with Retry-After, waits grow until the last attempt
+    def post_with_backoff(self, url, file_path, **kwargs):
+        for attempt in range(self.submit_attempts):
+            with open(file_path, 'rb') as upload_file:
+                response = requests.post(url, files={'file': upload_file}, headers=self.headers, **kwargs)
+            if response.status_code != 429 or attempt == self.submit_attempts - 1:
+                break
+            time.sleep(min(max(float(response.headers.get('Retry-After', 1)), 2 ** attempt),
+                           self.max_backoff_seconds))
+        if response.status_code != 200:
+            raise Exception(response.text)
+        return self.decode(response)
+
+    # Files the .blend depends on are stored on the server by content, only the ones it lacks are sent.
+    # Returns the manifest of absolute path to sha256 that render passes along.
+    def upload_assets(self, asset_paths):
         if not self.is_alive:
             raise Exception('Connection is not alive')
-        response = requests.post(f'{self.base_url}/task/request?'
-                                 f'session_id={self.session_id}&'
-                                 f'start_frame={start_frame}&'
-                                 f'end_frame={end_frame}&'
-                                 f'task_name={task_name}',
-                                 files={'file': open(blend_file_path, 'rb')})
+        manifest = {os.path.abspath(path): file_sha256(path) for path in asset_paths}
+        response = requests.post(f'{self.base_url}/asset/missing?'
+                                 f'session_id={self.session_id}',
+                                 data={'sha256': sorted(set(manifest.values()))},
+                                 headers=self.headers)
         if response.status_code != 200:
             raise Exception(response.text)
-        return json.loads(response.text)
+        missing = set(self.decode(response)['missing'])
+        for path, sha256 in manifest.items():
+            if sha256 in missing:
+                self.post_with_backoff(f'{self.base_url}/asset/upload?'
+                                       f'session_id={self.session_id}&'
+                                       f'sha256={sha256}', path)
+                missing.discard(sha256)
+        return manifest
+
+    def render(self, task_name, blend_file_path, start_frame, end_frame, render_overrides=None, priority=0,
+               asset_paths=None):
+        if not self.is_alive:
+            raise Exception('Connection is not alive')
+        data = None
+        if asset_paths:
+            data = {'assets': json.dumps(self.upload_assets(asset_paths)),
+                    'blend_path': os.path.abspath(blend_file_path)}
+        return self.post_with_backoff(f'{self.base_url}/task/request?'
+                                      f'session_id={self.session_id}&'
+                                      f'start_frame={start_frame}&'
+                                      f'end_frame={end_frame}&'
+                                      f'task_name={task_name}&'
+                                      f'priority={priority}',
+                                      blend_file_path,
+                                      params=render_overrides,
+                                      data=data)
 
     def stat(self, task_id):
         if not self.is_alive:
             raise Exception('Connection is not alive')
         response = requests.get(f'{self.base_url}/task/stat?'
                                 f'session_id={self.session_id}&'
-                                f'task_id={task_id}')
+                                f'task_id={task_id}',
+                                headers=self.headers)
         if response.status_code != 200:
             raise Exception(response.text)
-        return json.loads(response.text)
+        return self.decode(response)
 
     def fetch(self, task_id, load_dir):
         if self.no_write:
@@ -70,7 +136,8 @@ class Backend:
             raise Exception('Connection is not alive')
         response = requests.get(f'{self.base_url}/task/result?'
                                 f'session_id={self.session_id}&'
-                                f'task_id={task_id}', stream=True)
+                                f'task_id={task_id}', stream=True,
+                                headers=self.headers)
         if response.status_code != 200:
             raise Exception(response.status_code)
         if self.no_write:
@@ -79,24 +146,52 @@ class Backend:
             tarfile.open(fileobj=tarball, format=tarfile.GNU_FORMAT).extractall(load_dir)
         return True
 
+    # Returns (offset to ask for next, new output); pass the returned offset back to tail
+    def log(self, task_id, offset=0):
+        if not self.is_alive:
+            raise Exception('Connection is not alive')
+        response = requests.get(f'{self.base_url}/task/log?'
+                                f'session_id={self.session_id}&'
+                                f'task_id={task_id}&'
+                                f'offset={offset}',
+                                headers=self.headers)
+        if response.status_code != 200:
+            raise Exception(response.text)
+        return int(response.headers['X-Next-Offset']), response.content.decode(errors='replace')
+
+    # Returns (frame, content type, image bytes) of the newest preview unless a frame is given
+    def preview(self, task_id, frame=None):
+        if not self.is_alive:
+            raise Exception('Connection is not alive')
+        response = requests.get(f'{self.base_url}/task/preview?'
+                                f'session_id={self.session_id}&'
+                                f'task_id={task_id}',
+                                params={'frame': frame} if frame is not None else None,
+                                headers=self.headers)
+        if response.status_code != 200:
+            raise Exception(response.text)
+        return int(response.headers['X-Frame']), response.headers['Content-Type'], response.content
+
     def list_session_tasks(self):
         if not self.is_alive:
             raise Exception('Connection is not alive')
         response = requests.get(f'{self.base_url}/task/list?'
-                                f'session_id={self.session_id}')
+                                f'session_id={self.session_id}',
+                                headers=self.headers)
         if response.status_code != 200:
             raise Exception(response.text)
-        return self.task_list_to_id_dict(json.loads(response.text))
+        return self.task_list_to_id_dict(self.decode(response))
 
     def kill(self, task_id):
         if not self.is_alive:
             raise Exception('Connection is not alive')
         response = requests.get(f'{self.base_url}/task/kill?'
                                 f'session_id={self.session_id}&'
-                                f'task_id={task_id}')
+                                f'task_id={task_id}',
+                                headers=self.headers)
         if response.status_code != 200:
             raise Exception(response.text)
-        return task_id == json.loads(response.text)['task_id']
+        return task_id == self.decode(response)['task_id']
 
     def delete_session(self, session_id):
         if not self.is_alive:
@@ -104,10 +199,11 @@ class Backend:
         response = requests.get(f'{self.base_url}/session/remove?'
                                 f'username={self.username}&'
                                 f'password={self.password}&'
-                                f'session_id={session_id}')
+                                f'session_id={session_id}',
+                                headers=self.headers)
         if response.status_code != 200:
             raise Exception(response.text)
-        return session_id == json.loads(response.text)['session_id']
+        return session_id == self.decode(response)['session_id']
 
     def command_queue_processor(self):
         while not self.killed:
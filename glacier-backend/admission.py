@@ -0,0 +1,96 @@
+import datetime
+import logging
+import math
+import threading
+
+import metrics
+import overrides
+from config import AdmissionConfig
+from database import as_utc
+
+logger = logging.getLogger(__name__)
+
+PENDING_STATES = ('CREATED', 'SCHEDULED', 'RUNNING')
+UPLOAD_RETRY_SECONDS = 5
+NO_HISTORY_RETRY_SECONDS = 60
+
+rejected_submissions = metrics.registry.counter('glacier_admission_rejections_total',
+                                                'Task submissions turned away with 429',
+                                                ('reason',))
+
+
+# Turns a submission away before its upload is read. Upload slots are counted per server
+# process, queued frames and submission rates come from the database and hold across
+# processes. Every limit is off at 0.
+class AdmissionControl(AdmissionConfig):
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+        self.uploads_in_flight = 0
+        self.lock = threading.Lock()
+        metrics.registry.gauge('glacier_uploads_in_flight', 'Task uploads being received by this process',
+                               callback=lambda: self.uploads_in_flight)
+
+    # None when admitted, which takes an upload slot until release(); otherwise
+    # (reason, retry_after_seconds)
+    def admit(self, username, frame_count):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        rejection = self.check_rate(username, now) or self.check_queue(frame_count, now) or self.take_upload_slot()
+        if rejection is not None:
+            self.reject(username, rejection)
+        return rejection
+
+    # Asset uploads queue no frames, they only compete for upload slots
+    def admit_upload(self, username):
+        rejection = self.take_upload_slot()
+        if rejection is not None:
+            self.reject(username, rejection)
+        return rejection
+
+    def take_upload_slot(self):
+        with self.lock:
+            if self.max_concurrent_uploads and self.uploads_in_flight >= self.max_concurrent_uploads:
+                return 'uploads', UPLOAD_RETRY_SECONDS
+            self.uploads_in_flight += 1
+        return None
+
+    @staticmethod
+    def reject(username, rejection):
+        reason, retry_after = rejection
+        rejected_submissions.inc(reason=reason)
+        logger.warning(f'submission by {username} rejected ({reason}), retry after {retry_after}s')
+
+    def release(self):
+        with self.lock:
+            self.uploads_in_flight -= 1
+
+    def check_rate(self, username, now):
+        if not self.user_submissions_per_minute:
+            return None
+        submissions, earliest = self.db.get_user_submissions_since(username, now - datetime.timedelta(minutes=1))
+        if submissions < self.user_submissions_per_minute:
+            return None
+        return 'rate', self.clamp(60 - (now - as_utc(earliest)).total_seconds())
+
+    # A task larger than the whole limit is still admitted into an empty queue
+    def check_queue(self, frame_count, now):
+        if not self.max_queued_frames:
+            return None
+        queued_frames = 0
+        for start_frame, end_frame, frames_done, render_overrides in self.db.get_pending_task_frames(PENDING_STATES):
+            frame_step = overrides.loads(render_overrides).get('frame_step', 1)
+            queued_frames += max((end_frame - start_frame) // frame_step + 1 - (frames_done or 0), 0)
+        if not queued_frames or queued_frames + frame_count <= self.max_queued_frames:
+            return None
+        return 'queue', self.drain_seconds(queued_frames + frame_count - self.max_queued_frames, now)
+
+    # Time for the render farm to get through excess_frames at the pace of the recent window
+    def drain_seconds(self, excess_frames, now):
+        recent_frames, earliest = self.db.get_frames_since(now - datetime.timedelta(seconds=self.drain_window_seconds))
+        if not recent_frames:
+            return self.clamp(NO_HISTORY_RETRY_SECONDS)
+        window_seconds = max((now - as_utc(earliest)).total_seconds(), 1.0)
+        return self.clamp(excess_frames * window_seconds / recent_frames)
+
+    def clamp(self, seconds):
+        return min(max(int(math.ceil(seconds)), 1), self.max_retry_after_seconds)
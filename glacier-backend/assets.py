@@ -0,0 +1,129 @@
+import json
+import os
+import re
+import shutil
+from uuid import uuid4
+
+# Content-addressed store for the files a .blend depends on (textures, linked libraries,
+# caches), kept once under UPLOAD_FACILITY/assets/<sha256> however many tasks use them.
+# A task's manifest maps the client's absolute paths to hashes. The task tree mirrors those
+# paths, and the .blend itself, under <task_id>.assets, so relative paths in the file and
+# its libraries resolve unchanged. Absolute paths are remapped into the tree when Blender starts.
+# Files are hard linked into task trees, so a store file with one link is used by no task.
+
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+DRIVE_PATTERN = re.compile(r'^([A-Za-z]):')
+MAX_MANIFEST_BYTES = 4 << 20
+
+REMAP_EXPR = '''import bpy
+import glob
+import re
+root = {root!r}
+def exists(target):
+    directory, name = target.rsplit('/', 1)
+    pattern = glob.escape(name).replace('<UDIM>', '[0-9]' * 4).replace('<UVTILE>', 'u*_v*')
+    pattern = re.sub('#+', lambda match: '[0-9]' * len(match.group()), pattern)
+    return bool(glob.glob(glob.escape(directory) + '/' + pattern))
+def remap(path):
+    if not path or path.startswith('//'):
+        return None
+    path = re.sub(r'^([A-Za-z]):', r'\\1', path.replace('\\\\', '/'))
+    parts = [part for part in path.split('/') if part not in ('', '.')]
+    target = '/'.join([root] + parts)
+    return target if '..' not in parts and exists(target) else None
+for collection in (bpy.data.images, bpy.data.movieclips, bpy.data.sounds, bpy.data.fonts, bpy.data.volumes,
+                   bpy.data.cache_files):
+    for datablock in collection:
+        target = remap(datablock.filepath) if datablock.library is None else None
+        if target:
+            datablock.filepath = target
+for library in bpy.data.libraries:
+    target = remap(library.filepath)
+    if target:
+        library.filepath = target
+        library.reload()'''
+
+
+def store_dir(upload_facility):
+    return f'{upload_facility}/assets'
+
+
+def asset_path(upload_facility, sha256):
+    return f'{store_dir(upload_facility)}/{sha256}'
+
+
+def task_root(upload_facility, task_id):
+    return f'{upload_facility}/{task_id}.assets'
+
+
+# Received next to the store and moved in once its hash checks out
+def new_upload_path(upload_facility):
+    os.makedirs(store_dir(upload_facility), exist_ok=True)
+    return f'{store_dir(upload_facility)}/{uuid4().hex}.part'
+
+
+# Files reported present are touched, so the janitor keeps them until the task linking them is submitted
+def missing(upload_facility, hashes):
+    absent = []
+    for sha256 in hashes:
+        try:
+            os.utime(asset_path(upload_facility, sha256))
+        except FileNotFoundError:
+            absent.append(sha256)
+    return absent
+
+
+# POSIX and Windows client paths alike, C:\maps\wood.png becomes C/maps/wood.png
+def relative_location(client_path):
+    path = DRIVE_PATTERN.sub(r'\1', client_path.replace('\\', '/'))
+    parts = [part for part in path.split('/') if part not in ('', '.')]
+    if not parts or '..' in parts:
+        raise Exception(f'invalid asset path {client_path!r}')
+    return '/'.join(parts)
+
+
+def parse_manifest(text):
+    manifest = json.loads(text)
+    if not isinstance(manifest, dict):
+        raise Exception('assets must map file paths to sha256 hashes')
+    for client_path, sha256 in manifest.items():
+        if not isinstance(sha256, str) or not SHA256_PATTERN.match(sha256):
+            raise Exception(f'invalid sha256 for {client_path!r}')
+        relative_location(client_path)
+    return manifest
+
+
+def link(source_path, target_path):
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copyfile(source_path, target_path)
+    os.utime(source_path)
+
+
+# Returns the .blend's new path inside the tree; the uploaded file is moved, not copied
+def build_task_tree(upload_facility, task_id, blend_file_path, blend_client_path, manifest):
+    absent = missing(upload_facility, set(manifest.values()))
+    if absent:
+        raise Exception(f'{len(absent)} asset(s) not uploaded: {", ".join(sorted(absent)[:5])}')
+    root = task_root(upload_facility, task_id)
+    try:
+        for client_path, sha256 in manifest.items():
+            target_path = f'{root}/{relative_location(client_path)}'
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            if not os.path.exists(target_path):
+                link(asset_path(upload_facility, sha256), target_path)
+        blend_target_path = f'{root}/{relative_location(blend_client_path)}'
+        os.makedirs(os.path.dirname(blend_target_path), exist_ok=True)
+        os.replace(blend_file_path, blend_target_path)
+    except Exception:
+        shutil.rmtree(root, ignore_errors=True)
+        raise
+    return blend_target_path
+
+
+def remap_expr(upload_facility, task_id):
+    root = task_root(upload_facility, task_id)
+    if not os.path.isdir(root):
+        return ''
+    return REMAP_EXPR.format(root=root)
@@ -1,27 +1,57 @@
+import datetime
 import logging
+import os
 import time
 from secrets import token_hex
 from uuid import uuid4
 
 import argon2
 
+import admission
+import assets
+import blendfile
+import history
+import janitor
+import metrics
+import overrides
+import previews
 import render
-from database import OperatorAliases
+import sessions
+import tasklog
+from tracing import traced
+from database import OperatorAliases, as_utc
 
 logger = logging.getLogger(__name__)
 
+# Every password check takes this long whatever its outcome, the wait is left to the caller
+PASSWORD_CHECK_SECONDS = 5
+PREDICTION_INTERVAL_SECONDS = 10
+PREDICTION_RESOLUTION_SECONDS = 30
+
+argon2_verify_seconds = metrics.registry.histogram('glacier_argon2_verify_seconds',
+                                                   'Password hash verification time')
+
 
 class AuthManager:
     def __init__(self):
         self.db = OperatorAliases()
         self.render_bus = render.render_bus
+        self.janitor = janitor.Janitor(self.db, self.render_bus)
+        self.sessions = sessions.SessionKeeper(self.db, self.render_bus)
+        self.admission = admission.AdmissionControl(self.db)
+        self.is_scheduler = False
+        self.reported_progress_by_task_id = {}
+        self.has_adopted = False
+        self.predicted_finish_by_task_id = {}
+        self.predicted_at = 0.0
         self.argon_hasher = argon2.PasswordHasher()
 
+    @traced('auth.is_user')
     def is_user(self, username):
         return bool(self.db.get_user_by_username(username))
 
+    @traced('auth.is_password_correct')
     def is_password_correct(self, username, candidate_password):
-        expected_end_time = time.time() + 5
         user = self.db.get_user_by_username(username)
         is_password_correct = False
         if user:
@@ -30,18 +60,14 @@ class AuthManager:
         else:
             user_exists = False
         if user_exists:
+            verify_start_time = time.perf_counter()
             try:
                 self.argon_hasher.verify(password_hash, candidate_password)
                 is_password_correct = True
             except argon2.exceptions.VerifyMismatchError:
                 pass
-        if user_exists:
-            if is_password_correct:
-                auth_result = True
-        else:
-            auth_result = False
-        time.sleep(expected_end_time - time.time())
-        return auth_result
+            argon2_verify_seconds.observe(time.perf_counter() - verify_start_time)
+        return user_exists and is_password_correct
 
     def add_user(self, username, password):
         if self.is_user(username):
@@ -50,54 +76,255 @@ class AuthManager:
         return self.db.add_user(username=username,
                                 password_hash=password_hash)
 
+    @traced('auth.add_session')
     def add_session(self, username):
         session_id = token_hex(16)
-        creation_time = time.time()
+        creation_time = datetime.datetime.now(datetime.timezone.utc)
         self.db.add_session(username=username,
                             session_id=session_id,
-                            creation_time=creation_time)
+                            creation_time=creation_time,
+                            last_seen=creation_time)
         return session_id
 
+    @traced('auth.is_session_by_username')
     def is_session_by_username(self, username):
         return bool(self.db.get_sessions_by_username(username))
 
+    @traced('auth.is_session_id')
     def is_session_id(self, session_id):
         return bool(self.db.get_session_by_id(session_id))
 
+    @traced('auth.get_session')
+    def get_session(self, session_id):
+        return self.sessions.check(self.db.get_session_by_id(session_id))
+
+    @traced('auth.get_sessions')
+    def get_sessions(self, username):
+        return [row[0] for row in self.db.get_sessions_by_username(username) if self.sessions.is_live(row[0])]
+
+    @traced('auth.get_tasks_for_session')
+    def get_tasks_for_session(self, session_id):
+        session, tasks = self.db.get_tasks_if_session(session_id)
+        if not self.sessions.check(session):
+            return None
+        return tasks
+
+    @traced('auth.get_task_for_session')
+    def get_task_for_session(self, session_id, task_id):
+        session, task = self.db.get_task_if_session(session_id, task_id)
+        if not self.sessions.check(session):
+            return None, None
+        return session, task
+
+    @traced('auth.delete_session')
     def delete_session(self, session_id):
         self.db.delete_task_by_session_id(session_id)
         self.db.delete_session_by_id(session_id)
+        for record in self.render_bus.tasks.by_session(session_id):
+            record.renderer.kill()
+            self.render_bus.delete_task(record.task_id)
 
-    def add_task(self, task_name, parent_session_id, blend_file, start_frame, end_frame):
+    # The upload is streamed to this path before the task row exists
+    def new_task_upload(self):
         task_id = uuid4().hex
+        return task_id, f'{self.render_bus.upload_facility}/{task_id}.blend'
+
+    @traced('auth.missing_assets')
+    def missing_assets(self, hashes):
+        return assets.missing(self.render_bus.upload_facility, hashes)
+
+    def new_asset_upload(self):
+        return assets.new_upload_path(self.render_bus.upload_facility)
+
+    def add_asset(self, upload_path, sha256):
+        os.replace(upload_path, assets.asset_path(self.render_bus.upload_facility, sha256))
+
+    @traced('auth.build_task_tree')
+    def build_task_tree(self, task_id, blend_file_path, blend_client_path, manifest):
+        return assets.build_task_tree(self.render_bus.upload_facility, task_id, blend_file_path, blend_client_path,
+                                      manifest)
+
+    @traced('auth.add_task')
+    def add_task(self, task_id, task_name, parent_session_id, file_path, start_frame, end_frame, username=None,
+                 render_overrides=None, blend_info=None, blend_sha256=None, deadline=None, priority=0):
         state = 'CREATED'
-        file_path = f'{self.render_bus.upload_facility}/{task_id}.blend'
-        username = self.db.get_session_by_id(parent_session_id).username
-        with open(file_path, 'wb') as blend_file_on_disk:
-            blend_file_on_disk.write(blend_file)
+        if username is None:
+            username = self.db.get_session_by_id(parent_session_id).username
+        blend_columns = blendfile.BlendInfo('', '').as_task_columns()
+        estimated_cost = None
+        if blend_info is not None:
+            blend_columns = blend_info.as_task_columns()
+            estimated_cost = blend_info.estimate_cost(int(start_frame), int(end_frame), render_overrides or {})
+        frame_count = (int(end_frame) - int(start_frame)) // (render_overrides or {}).get('frame_step', 1) + 1
+        predicted_seconds = history.predict_seconds(self.db, blend_sha256, username, estimated_cost, frame_count)
         self.db.add_task(task_name=task_name,
                          task_id=task_id,
                          parent_session_id=parent_session_id,
                          username=username,
                          blend_file_path=file_path,
-                         state=state)
-        new_task = render.Renderer(task_id, file_path, start_frame, end_frame, self.task_updater)
+                         state=state,
+                         priority=priority,
+                         progress='',
+                         created_at=datetime.datetime.now(datetime.timezone.utc),
+                         started_at=None,
+                         finished_at=None,
+                         start_frame=int(start_frame),
+                         end_frame=int(end_frame),
+                         tar_path='',
+                         frames_done=0,
+                         kill_requested=0,
+                         render_overrides=overrides.dumps(render_overrides),
+                         estimated_cost=estimated_cost,
+                         blend_sha256=blend_sha256,
+                         deadline=deadline,
+                         predicted_seconds=predicted_seconds,
+                         predicted_finish=None,
+                         retries=0,
+                         failed_frames='',
+                         preview_frame=None,
+                         **blend_columns)
+        if self.is_scheduler:
+            self.render_bus.wakeup.set()
         return task_id
 
-    def task_updater(self, task_id, new_state):
+    # Runs on the scheduler thread of the elected process only: adopts tasks created by any
+    # API process (and, right after election, those left unfinished by the previous scheduler),
+    # applies kill and delete requests made through the database and writes the render
+    # progress of live tasks back in one statement, along with the saved frames' timings
+    def sync_tasks(self):
+        adopted_states = ('CREATED',) if self.has_adopted else ('CREATED', 'SCHEDULED', 'RUNNING', 'COMPLETED',
+                                                                'COMPRESSING')
+        self.has_adopted = True
+        for state in adopted_states:
+            for row in self.db.get_tasks_by_state(state):
+                task = row[0]
+                if task.task_id in self.render_bus.tasks:
+                    continue
+                if task.kill_requested:
+                    self.task_updater(task.task_id, 'KILLED')
+                    continue
+                deadline = as_utc(task.deadline).timestamp() if task.deadline else None
+                finished_frames = self.db.get_saved_frames_by_task_id(task.task_id) if state != 'CREATED' else ()
+                # Rendered but not yet packed, the new scheduler only packs it
+                is_rendered = state in ('COMPLETED', 'COMPRESSING')
+                render.Renderer(task.task_id, task.blend_file_path, task.start_frame, task.end_frame,
+                                self.task_updater, task.username, overrides.loads(task.render_overrides),
+                                task.blend_sha256 or '', task.estimated_cost, task.predicted_seconds, deadline,
+                                task.priority or 0, finished_frames, task.parent_session_id, is_rendered)
+        frame_records = self.render_bus.take_frame_records()
+        if frame_records:
+            self.db.add_frames([dict(frame_record, frame_id=uuid4().hex) for frame_record in frame_records])
+        live_tasks = [record.renderer for record in self.render_bus.tasks.values()]
+        if not live_tasks:
+            return
+        self.update_predictions()
+        kill_requested_by_task_id = dict(self.db.get_task_controls([task.id for task in live_tasks]))
+        progress_by_task_id = {}
+        for task in live_tasks:
+            if task.id not in kill_requested_by_task_id:
+                task.kill()
+                self.render_bus.delete_task(task.id)
+                continue
+            if kill_requested_by_task_id[task.id] and not task.killed:
+                task.kill()
+            predicted_finish = self.predicted_finish_by_task_id.get(task.id)
+            progress = (task.last_line, task.frames_saved, predicted_finish, task.retries,
+                        ','.join(map(str, task.failed_frames)), self.render_bus.previews.latest_frame(task.id))
+            if self.reported_progress_by_task_id.get(task.id) != progress:
+                progress_by_task_id[task.id] = progress
+        if progress_by_task_id:
+            self.db.update_tasks_progress(progress_by_task_id)
+            self.reported_progress_by_task_id.update(progress_by_task_id)
+        for task_id in list(self.reported_progress_by_task_id):
+            if task_id not in self.render_bus.tasks:
+                del self.reported_progress_by_task_id[task_id]
+
+    # The projection walks the whole queue, so it is refreshed every few ticks and rounded
+    # to keep unchanged estimates from rewriting rows
+    def update_predictions(self):
+        now = time.time()
+        if now - self.predicted_at < PREDICTION_INTERVAL_SECONDS:
+            return
+        self.predicted_at = now
+        self.predicted_finish_by_task_id = {
+            task_id: datetime.datetime.fromtimestamp(
+                round((now + seconds) / PREDICTION_RESOLUTION_SECONDS) * PREDICTION_RESOLUTION_SECONDS,
+                datetime.timezone.utc)
+            for task_id, seconds in self.render_bus.slot_scheduler.predict_finish().items()}
+
+    def task_updater(self, task_id, new_state, **kwvalues):
         logger.info(f'task {task_id} state changed to {new_state}')
-        self.db.update_task_state(task_id, new_state)
+        if new_state == 'RUNNING':
+            kwvalues['started_at'] = datetime.datetime.now(datetime.timezone.utc)
+        elif new_state in ('COMPLETED', 'KILLED') or new_state.startswith('FAILED'):
+            kwvalues['finished_at'] = datetime.datetime.now(datetime.timezone.utc)
+        self.db.update_task_state(task_id, new_state, **kwvalues)
 
+    @traced('auth.is_task_id')
     def is_task_id(self, task_id):
         return bool(self.db.get_task_by_id(task_id))
 
+    @traced('auth.is_task_by_session_id')
     def is_task_by_session_id(self, session_id):
         return bool(self.db.get_tasks_by_session_id(session_id))
 
+    @traced('auth.kill_task')
+    def kill_task(self, task_id):
+        self.db.request_task_kill(task_id)
+        live_task = self.render_bus.live_task(task_id)
+        if live_task is not None:
+            live_task.kill()
+
+    # The scheduler process answers from the ring buffer while the offset is still in it
+    @traced('auth.read_task_log')
+    def read_task_log(self, task_id, offset, limit):
+        live_task = self.render_bus.live_task(task_id)
+        if live_task is not None:
+            result = live_task.log.read(offset, limit)
+            if result is not None:
+                return result
+        return tasklog.read_segments(self.render_bus.upload_facility, task_id, offset, limit,
+                                     self.render_bus.task_log_segment_bytes)
+
+    # Previews are plain files, so any process serves them
+    @traced('auth.read_preview')
+    def read_preview(self, task_id, frame=None):
+        found = previews.find_preview(previews.preview_dir(self.render_bus.upload_facility, task_id), frame)
+        if found is None:
+            return None
+        frame, path, content_type = found
+        try:
+            with open(path, 'rb') as preview_file:
+                return frame, content_type, preview_file.read()
+        except FileNotFoundError:
+            return None
+
+    # Another process' scheduler notices the missing row on its next tick and cleans up
+    @traced('auth.delete_task')
     def delete_task(self, task_id):
-        self.render_bus.tasks_by_id[task_id].kill()
         self.db.delete_task_by_id(task_id)
-        self.render_bus.delete_task(task_id)
+        live_task = self.render_bus.live_task(task_id)
+        if live_task is not None:
+            live_task.kill()
+            self.render_bus.delete_task(task_id)
+
+    def record_chunk(self, task_id, job, started_at, render_seconds, return_code):
+        self.db.add_chunk(chunk_id=uuid4().hex,
+                          task_id=task_id,
+                          start_frame=job.start_frame,
+                          end_frame=job.end_frame,
+                          slot=job.slot.name,
+                          device=job.slot.device.name,
+                          started_at=datetime.datetime.fromtimestamp(started_at, datetime.timezone.utc),
+                          render_seconds=render_seconds,
+                          return_code=return_code)
+
+    def become_scheduler(self):
+        self.is_scheduler = True
+        self.janitor.is_evicting = True
+        self.sessions.is_sweeping = True
+        self.render_bus.tick_callback = self.sync_tasks
+        self.render_bus.chunk_callback = self.record_chunk
 
     def __del__(self):
         del self.db
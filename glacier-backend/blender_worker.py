@@ -0,0 +1,61 @@
+import json
+import sys
+import traceback
+
+import bpy
+
+# Control script of a warm pool worker, started by workers.py as
+#   blender -b --factory-startup --python blender_worker.py [-- --cycles-device KIND]
+# It reads one JSON job per line from stdin and answers on stdout with Blender's own render
+# log followed by a single DONE_MARKER line carrying the exit code. The loaded file is kept
+# between jobs and only reopened when the .blend's content or the setup expressions change;
+# every task uploads its own copy of the file, so the path alone would never match.
+
+DONE_MARKER = 'GLACIER_WORKER_DONE'
+READY_MARKER = 'GLACIER_WORKER_READY'
+
+loaded_key = None
+
+
+def load(job):
+    global loaded_key
+    key = (job['blend_sha256'] or job['blend'], tuple(job['setup']))
+    if key == loaded_key:
+        return
+    loaded_key = None
+    bpy.ops.wm.open_mainfile(filepath=job['blend'])
+    for expr in job['setup']:
+        exec(expr, {})
+    loaded_key = key
+
+
+def render(job):
+    load(job)
+    scene = bpy.context.scene
+    scene.render.engine = job['engine']
+    scene.render.filepath = job['output']
+    if job['file_format']:
+        scene.render.image_settings.file_format = job['file_format']
+    scene.frame_start = job['start']
+    scene.frame_end = job['end']
+    scene.frame_step = job['step']
+    bpy.ops.render.render(animation=True)
+
+
+def main():
+    global loaded_key
+    print(READY_MARKER, flush=True)
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        return_code = 0
+        try:
+            render(json.loads(line))
+        except Exception:
+            loaded_key = None
+            traceback.print_exc(file=sys.stdout)
+            return_code = 1
+        print(f'{DONE_MARKER} {return_code}', flush=True)
+
+
+main()
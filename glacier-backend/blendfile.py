@@ -0,0 +1,361 @@
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Streaming reader for the .blend container, fed the upload as it arrives. It validates the
+# header, follows the block index without keeping block payloads, and holds on to the few
+# blocks needed afterwards: the file's struct catalogue (DNA1), FileGlobal (GLOB) and the
+# scenes with their data blocks. Struct layouts are taken from DNA1, so field reads do not
+# depend on the Blender version that wrote the file.
+
+BLEND_MAGIC = b'BLENDER'
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+SCENE_CODE = b'SC\x00\x00'
+DATA_CODE = b'DATA'
+END_CODE = b'ENDB'
+KEPT_CODES = (SCENE_CODE, b'DNA1', b'GLOB')
+MAX_KEPT_BYTES = 64 << 20
+
+IDP_INT = 1
+IDP_GROUP = 6
+# Cycles stores its settings as ID properties and leaves defaults unwritten
+CYCLES_DEFAULT_SAMPLES = 4096
+RENDER_ENGINE = 'CYCLES'
+
+PRIMITIVE_FORMATS = {
+    'char': 'b', 'uchar': 'B', 'short': 'h', 'ushort': 'H', 'int': 'i', 'uint': 'I',
+    'float': 'f', 'double': 'd', 'int8_t': 'b', 'uint8_t': 'B', 'int16_t': 'h', 'uint16_t': 'H',
+    'int32_t': 'i', 'uint32_t': 'I', 'int64_t': 'q', 'uint64_t': 'Q',
+}
+
+
+class Field:
+    def __init__(self, name, type_name, offset, size, is_pointer, array_length):
+        self.name = name
+        self.type_name = type_name
+        self.offset = offset
+        self.size = size
+        self.is_pointer = is_pointer
+        self.array_length = array_length
+
+
+class StructCatalogue:
+    def __init__(self, data, endian, pointer_size):
+        self.endian = endian
+        self.pointer_size = pointer_size
+        if data[:4] != b'SDNA':
+            raise Exception('malformed .blend struct catalogue')
+        position = 4
+        names, position = self.read_strings(data, position, b'NAME')
+        type_names, position = self.read_strings(data, position, b'TYPE')
+        if data[position:position + 4] != b'TLEN':
+            raise Exception('malformed .blend struct catalogue')
+        position += 4
+        type_lengths = struct.unpack_from(f'{endian}{len(type_names)}h', data, position)
+        position = self.align(position + 2 * len(type_names))
+        if data[position:position + 4] != b'STRC':
+            raise Exception('malformed .blend struct catalogue')
+        struct_count, = struct.unpack_from(f'{endian}i', data, position + 4)
+        position += 8
+        self.type_lengths = dict(zip(type_names, type_lengths))
+        self.fields_by_struct = {}
+        for _ in range(struct_count):
+            type_index, field_count = struct.unpack_from(f'{endian}hh', data, position)
+            position += 4
+            fields = {}
+            offset = 0
+            for _ in range(field_count):
+                field_type, field_name = struct.unpack_from(f'{endian}hh', data, position)
+                position += 4
+                field = self.make_field(names[field_name], type_names[field_type], offset)
+                fields[field.name] = field
+                offset += field.size
+            self.fields_by_struct[type_names[type_index]] = fields
+
+    @staticmethod
+    def align(position):
+        return (position + 3) & ~3
+
+    def read_strings(self, data, position, tag):
+        if data[position:position + 4] != tag:
+            raise Exception('malformed .blend struct catalogue')
+        count, = struct.unpack_from(f'{self.endian}i', data, position + 4)
+        position += 8
+        strings = []
+        for _ in range(count):
+            end = data.index(b'\x00', position)
+            strings.append(data[position:end].decode('ascii', errors='replace'))
+            position = end + 1
+        return strings, self.align(position)
+
+    def make_field(self, declaration, type_name, offset):
+        is_pointer = declaration.startswith('*') or declaration.startswith('(*')
+        array_length = 1
+        for dimension in declaration.split('[')[1:]:
+            array_length *= int(dimension.rstrip(']'))
+        name = declaration.split('[')[0].lstrip('*(').split(')')[0]
+        element_size = self.pointer_size if is_pointer else self.type_lengths[type_name]
+        return Field(name, type_name, offset, element_size * array_length, is_pointer, array_length)
+
+    def field(self, struct_name, path):
+        offset = 0
+        field = None
+        for name in path:
+            field = self.fields_by_struct[struct_name].get(name)
+            if field is None:
+                return None
+            offset += field.offset
+            struct_name = field.type_name
+        return Field(field.name, field.type_name, offset, field.size, field.is_pointer, field.array_length)
+
+    def read(self, data, struct_name, path):
+        field = self.field(struct_name, path)
+        if field is None or field.offset + field.size > len(data):
+            return None
+        if field.is_pointer:
+            pointer_format = 'Q' if self.pointer_size == 8 else 'I'
+            return struct.unpack_from(f'{self.endian}{pointer_format}', data, field.offset)[0]
+        if field.type_name == 'char' and field.array_length > 1:
+            return bytes(data[field.offset:field.offset + field.size]).split(b'\x00')[0].decode(errors='replace')
+        value_format = PRIMITIVE_FORMATS.get(field.type_name)
+        if value_format is None:
+            return bytes(data[field.offset:field.offset + field.size])
+        return struct.unpack_from(f'{self.endian}{value_format}', data, field.offset)[0]
+
+
+class BlendInfo:
+    def __init__(self, version, compression):
+        self.version = version
+        self.compression = compression
+        self.start_frame = None
+        self.end_frame = None
+        self.frame_step = None
+        self.resolution_x = None
+        self.resolution_y = None
+        self.resolution_percentage = None
+        self.engine = None
+        self.samples = None
+
+    # Pixel samples in billions, a device independent measure of render work
+    def estimate_cost(self, start_frame, end_frame, render_overrides):
+        if not self.resolution_x or not self.resolution_y:
+            return None
+        percentage = render_overrides.get('resolution_percentage', self.resolution_percentage or 100)
+        samples = render_overrides.get('samples', self.samples or 1)
+        frame_count = (end_frame - start_frame) // render_overrides.get('frame_step', 1) + 1
+        pixels = self.resolution_x * self.resolution_y * (percentage / 100) ** 2
+        return pixels * samples * frame_count / 1e9
+
+    # Why the file cannot render the requested frames, None when it can or the scene is unknown.
+    # A single frame may lie outside the scene range, previews render the current frame.
+    def mismatch(self, start_frame, end_frame):
+        if self.engine and self.engine != RENDER_ENGINE:
+            return f'scene renders with {self.engine}, tasks render with {RENDER_ENGINE}'
+        if start_frame == end_frame or self.start_frame is None or self.end_frame is None:
+            return None
+        if start_frame < self.start_frame or end_frame > self.end_frame:
+            return f'frames {start_frame}..{end_frame} are outside the scene range {self.start_frame}..{self.end_frame}'
+        return None
+
+    def as_task_columns(self):
+        return {'blend_version': self.version,
+                'blend_compression': self.compression,
+                'scene_start_frame': self.start_frame,
+                'scene_end_frame': self.end_frame,
+                'resolution_x': self.resolution_x,
+                'resolution_y': self.resolution_y,
+                'resolution_percentage': self.resolution_percentage,
+                'render_engine': self.engine,
+                'samples': self.samples}
+
+
+class BlendReader:
+    def __init__(self):
+        self.compression = None
+        self.decompressor = None
+        self.is_opaque = False
+        self.pending_raw = b''
+        self.buffer = bytearray()
+        self.header_size = 0
+        self.block_header_format = None
+        self.endian = '<'
+        self.pointer_size = 8
+        self.version = ''
+        self.skip_bytes = 0
+        self.collecting = None
+        self.is_in_scene = False
+        self.blocks = []
+        self.kept_bytes = 0
+        self.is_ended = False
+
+    def feed(self, data):
+        if self.is_opaque or self.is_ended:
+            return
+        if self.compression is None:
+            self.pending_raw += data
+            if len(self.pending_raw) < len(ZSTD_MAGIC):
+                return
+            data = self.pending_raw
+            self.pending_raw = b''
+            self.detect_compression(data)
+            if self.is_opaque:
+                return
+        if self.decompressor is not None:
+            data = self.decompressor.decompress(data)
+        self.parse(data)
+
+    def detect_compression(self, data):
+        if data.startswith(GZIP_MAGIC):
+            self.compression = 'gzip'
+            self.decompressor = zlib.decompressobj(wbits=31)
+        elif data.startswith(ZSTD_MAGIC):
+            self.compression = 'zstd'
+            if zstandard is None:
+                self.is_opaque = True
+            else:
+                self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        elif data.startswith(BLEND_MAGIC[:len(ZSTD_MAGIC)]):
+            self.compression = 'none'
+        else:
+            raise Exception('not a .blend file')
+
+    def parse_header(self):
+        if len(self.buffer) < 12:
+            return False
+        if not self.buffer.startswith(BLEND_MAGIC):
+            raise Exception('not a .blend file')
+        if self.buffer[7:9].isdigit():
+            if len(self.buffer) < 17:
+                return False
+            self.header_size = int(self.buffer[7:9])
+            if self.buffer[9:10] != b'-' or self.buffer[10:12] != b'01' or self.buffer[12:13] not in (b'v', b'V'):
+                raise Exception('unsupported .blend file format')
+            self.endian = '<' if self.buffer[12:13] == b'v' else '>'
+            self.version = self.buffer[13:17].decode()
+            self.block_header_format = f'{self.endian}4siQqq'
+        else:
+            self.header_size = 12
+            if self.buffer[7:8] not in (b'_', b'-') or self.buffer[8:9] not in (b'v', b'V'):
+                raise Exception('unsupported .blend file format')
+            self.pointer_size = 4 if self.buffer[7:8] == b'_' else 8
+            self.endian = '<' if self.buffer[8:9] == b'v' else '>'
+            self.version = self.buffer[9:12].decode(errors='replace')
+            pointer_format = 'I' if self.pointer_size == 4 else 'Q'
+            self.block_header_format = f'{self.endian}4si{pointer_format}ii'
+        del self.buffer[:self.header_size]
+        return True
+
+    def unpack_block_header(self, data, position):
+        fields = struct.unpack_from(self.block_header_format, data, position)
+        if self.header_size == 12:
+            code, size, old_pointer, sdna_index, count = fields
+        else:
+            code, sdna_index, old_pointer, size, count = fields
+        return code, size, old_pointer, sdna_index
+
+    def parse(self, data):
+        self.buffer += data
+        if not self.block_header_format and not self.parse_header():
+            return
+        block_header_size = struct.calcsize(self.block_header_format)
+        position = 0
+        while position < len(self.buffer) and not self.is_ended:
+            available = len(self.buffer) - position
+            if self.skip_bytes:
+                skipped = min(self.skip_bytes, available)
+                self.skip_bytes -= skipped
+                position += skipped
+                continue
+            if self.collecting is not None:
+                code, old_pointer, sdna_index, payload, size = self.collecting
+                taken = min(size - len(payload), available)
+                payload += self.buffer[position:position + taken]
+                position += taken
+                if len(payload) == size:
+                    self.blocks.append((code, old_pointer, sdna_index, bytes(payload)))
+                    self.collecting = None
+                continue
+            if available < block_header_size:
+                break
+            code, size, old_pointer, sdna_index = self.unpack_block_header(self.buffer, position)
+            position += block_header_size
+            if size < 0:
+                raise Exception('corrupt .blend block index')
+            if code == END_CODE:
+                self.is_ended = True
+                break
+            if code != DATA_CODE:
+                self.is_in_scene = code == SCENE_CODE
+            is_kept = code in KEPT_CODES or (code == DATA_CODE and self.is_in_scene)
+            if is_kept and self.kept_bytes + size <= MAX_KEPT_BYTES:
+                self.kept_bytes += size
+                self.collecting = (code, old_pointer, sdna_index, bytearray(), size)
+                if not size:
+                    self.blocks.append((code, old_pointer, sdna_index, b''))
+                    self.collecting = None
+            else:
+                self.skip_bytes = size
+        del self.buffer[:position]
+
+    def finish(self):
+        if self.compression is None:
+            raise Exception('not a .blend file')
+        info = BlendInfo(self.version, self.compression)
+        if self.is_opaque:
+            return info
+        if not self.is_ended:
+            raise Exception('truncated .blend file')
+        catalogue_blocks = [block for block in self.blocks if block[0] == b'DNA1']
+        scene_blocks = [block for block in self.blocks if block[0] == SCENE_CODE]
+        if not catalogue_blocks:
+            raise Exception('.blend file has no struct catalogue')
+        if not scene_blocks:
+            raise Exception('.blend file has no scene')
+        catalogue = StructCatalogue(catalogue_blocks[0][3], self.endian, self.pointer_size)
+        blocks_by_pointer = {block[1]: block for block in self.blocks if block[1]}
+        scene = scene_blocks[0]
+        for block in self.blocks:
+            if block[0] == b'GLOB':
+                current_scene = blocks_by_pointer.get(catalogue.read(block[3], 'FileGlobal', ['curscene']))
+                if current_scene is not None and current_scene[0] == SCENE_CODE:
+                    scene = current_scene
+        self.read_scene(info, catalogue, scene[3], blocks_by_pointer)
+        return info
+
+    def read_scene(self, info, catalogue, data, blocks_by_pointer):
+        info.start_frame = catalogue.read(data, 'Scene', ['r', 'sfra'])
+        info.end_frame = catalogue.read(data, 'Scene', ['r', 'efra'])
+        info.frame_step = catalogue.read(data, 'Scene', ['r', 'frame_step'])
+        info.resolution_x = catalogue.read(data, 'Scene', ['r', 'xsch'])
+        info.resolution_y = catalogue.read(data, 'Scene', ['r', 'ysch'])
+        info.resolution_percentage = catalogue.read(data, 'Scene', ['r', 'size'])
+        info.engine = catalogue.read(data, 'Scene', ['r', 'engine'])
+        # Tasks render with Cycles, so its sample count is the one the cost depends on
+        info.samples = CYCLES_DEFAULT_SAMPLES
+        for properties_field in ('system_properties', 'properties'):
+            samples = self.read_id_property(catalogue, blocks_by_pointer,
+                                            catalogue.read(data, 'Scene', ['id', properties_field]),
+                                            ['cycles', 'samples'])
+            if samples is not None:
+                info.samples = samples
+                break
+
+    @staticmethod
+    def read_id_property(catalogue, blocks_by_pointer, pointer, path):
+        block = blocks_by_pointer.get(pointer)
+        for name in path:
+            if block is None or catalogue.read(block[3], 'IDProperty', ['type']) != IDP_GROUP:
+                return None
+            child = blocks_by_pointer.get(catalogue.read(block[3], 'IDProperty', ['data', 'group', 'first']))
+            while child is not None and catalogue.read(child[3], 'IDProperty', ['name']) != name:
+                child = blocks_by_pointer.get(catalogue.read(child[3], 'IDProperty', ['next']))
+            block = child
+        if block is None or catalogue.read(block[3], 'IDProperty', ['type']) != IDP_INT:
+            return None
+        return catalogue.read(block[3], 'IDProperty', ['data', 'val'])
@@ -9,12 +9,17 @@ class AnyConfigFromEnv:
     def __init__(self):
         environment = os.environ
         for field in dataclasses.fields(self):
+            if field.name.upper() not in environment and field.default is not dataclasses.MISSING:
+                setattr(self, field.name, field.default)
+                continue
             if field.name.upper() not in environment:
                 raise Exception(f'field {field} not found in env')
             if not environment[field.name.upper()]:
                 raise Exception(f'field {field} is empty')
             if field.type == int:
                 setattr(self, field.name, int(environment[field.name.upper()]))
+            elif field.type == float:
+                setattr(self, field.name, float(environment[field.name.upper()]))
             else:
                 setattr(self, field.name, environment[field.name.upper()])
 
@@ -26,6 +31,10 @@ class DatabaseConfig(AnyConfigFromEnv):
     db_name: str
     db_user: str
     db_pass: str
+    db_url: str = ''
+    db_connect_timeout_seconds: int = 5
+    db_retry_max_seconds: float = 5.0
+    db_startup_timeout_seconds: int = 180
 
     def __init__(self):
         super().__init__()
@@ -35,6 +44,27 @@ class DatabaseConfig(AnyConfigFromEnv):
 class RenderConfig(AnyConfigFromEnv):
     upload_facility: str
     blender_bin: str
+    render_slots: int = 1
+    render_devices: str = ''
+    device_probe_timeout_seconds: int = 60
+    render_backend: str = 'process'
+    chunk_size: int = 0
+    scheduling_policy: str = 'fifo'
+    scheduler_trace_path: str = ''
+    kill_grace_seconds: int = 10
+    task_log_ring_bytes: int = 64 << 10
+    task_log_segment_bytes: int = 4 << 20
+    task_log_segments: int = 2
+    still_tiles: int = 0
+    stall_seconds: int = 3600
+    stall_min_seconds: int = 300
+    stall_factor: float = 4.0
+    max_frame_attempts: int = 3
+    max_task_retries: int = 10
+    preview_workers: int = 2
+    preview_size: int = 512
+    preview_format: str = 'jpeg'
+    preview_quality: int = 80
 
     def __init__(self):
         super().__init__()
@@ -47,3 +77,57 @@ class UserAddConfig(AnyConfigFromEnv):
 
     def __init__(self):
         super().__init__()
+
+
+@dataclasses.dataclass
+class ServerConfig(AnyConfigFromEnv):
+    server_port: int = 8888
+    slow_request_ms: int = 500
+    admin_users: str = ''
+    profile_max_seconds: int = 60
+    server_workers: int = 1
+    scheduler_election_seconds: int = 5
+    max_upload_bytes: int = 16 << 30
+    max_user_priority: int = 0
+
+    def __init__(self):
+        super().__init__()
+
+
+@dataclasses.dataclass
+class StorageConfig(AnyConfigFromEnv):
+    upload_facility: str
+    janitor_interval_seconds: int = 300
+    artifact_ttl_hours: str = 'DONE=24,PACKED=168,KILLED=24,FAILED(BLENDER)=72,FAILED(TAR)=72'
+    user_quota_bytes: int = 0
+    global_quota_bytes: int = 0
+    min_free_percent: int = 10
+    orphan_grace_seconds: int = 3600
+    frame_history_days: int = 90
+    asset_ttl_hours: int = 720
+
+    def __init__(self):
+        super().__init__()
+
+
+@dataclasses.dataclass
+class SessionConfig(AnyConfigFromEnv):
+    session_idle_ttl_seconds: int = 7 * 24 * 3600
+    session_absolute_ttl_seconds: int = 30 * 24 * 3600
+    session_sweep_interval_seconds: int = 600
+    last_seen_flush_seconds: int = 30
+
+    def __init__(self):
+        super().__init__()
+
+
+@dataclasses.dataclass
+class AdmissionConfig(AnyConfigFromEnv):
+    max_concurrent_uploads: int = 0
+    max_queued_frames: int = 0
+    user_submissions_per_minute: int = 0
+    drain_window_seconds: int = 300
+    max_retry_after_seconds: int = 600
+
+    def __init__(self):
+        super().__init__()
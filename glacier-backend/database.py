@@ -1,6 +1,10 @@
+import contextlib
+import contextvars
 import dataclasses
+import datetime
 import logging
-import socket
+import operator
+import threading
 import time
 import typing
 from typing import Optional
@@ -8,36 +12,58 @@ from typing import Optional
 import sqlalchemy
 from sqlalchemy.orm import Mapped, mapped_column
 
+import metrics
+import migrations
+import tracing
 from config import DatabaseConfig
 
 
-def wait_for_database_up() -> None:
-    config = DatabaseConfig()
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    total_seconds_awaited = 0
-    timeout = 180
-    while True:
-        try:
-            s.connect((config.db_host, config.db_port))
-            s.close()
-            break
-        except socket.error:
-            if total_seconds_awaited > timeout:
-                raise Exception(f'Database is not up after {total_seconds_awaited}s')
-            time.sleep(0.5)
-            total_seconds_awaited += 0.5
+logger = logging.getLogger(__name__)
 
+query_seconds = metrics.registry.histogram('glacier_db_query_seconds',
+                                           'Database operation latency including pool checkout',
+                                           ('operation',))
+checkout_seconds = metrics.registry.histogram('glacier_db_pool_checkout_seconds',
+                                              'Time spent waiting for a pooled database connection')
 
-logger = logging.getLogger(__name__)
+
+# SQLite hands timestamps back naive, they are always stored in UTC
+def as_utc(value: datetime.datetime) -> datetime.datetime:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value
 
 
 class Base(sqlalchemy.orm.DeclarativeBase):
+    type_annotation_map = {
+        datetime.datetime: sqlalchemy.DateTime(timezone=True)
+    }
+
     def as_dict(self):
-        data_dict = {}
-        for field in dataclasses.fields(self):
-            value = getattr(self, field.name)
-            data_dict.update({field.name: value})
+        serializer = serializers_by_class.get(type(self))
+        if serializer is None:
+            serializer = serializers_by_class[type(self)] = make_serializer(type(self))
+        return serializer(self)
+
+
+# Built once per model: one attrgetter call for all fields, then isoformat for the
+# DateTime columns only
+def make_serializer(model_class):
+    field_names = tuple(field.name for field in dataclasses.fields(model_class))
+    get_values = operator.attrgetter(*field_names)
+    datetime_names = tuple(name for name in field_names
+                           if isinstance(model_class.__table__.columns[name].type, sqlalchemy.DateTime))
+
+    def serialize(row):
+        data_dict = dict(zip(field_names, get_values(row)))
+        for name in datetime_names:
+            if data_dict[name] is not None:
+                data_dict[name] = data_dict[name].isoformat()
         return data_dict
+    return serialize
+
+
+serializers_by_class = {}
 
 
 @dataclasses.dataclass
@@ -56,26 +82,57 @@ class User(Base):
 class Session(Base):
     __tablename__ = "session_table"
 
-    username: Mapped[Optional[str]]
+    username: Mapped[Optional[str]] = mapped_column(index=True)
     session_id: Mapped[Optional[str]] = mapped_column(primary_key=True)
-    creation_time: Mapped[Optional[str]]
+    creation_time: Mapped[Optional[datetime.datetime]]
+    last_seen: Mapped[Optional[datetime.datetime]] = mapped_column(index=True)
 
     def __repr__(self) -> str:
         return f"Session(username={self.username!r}, " \
                f"session_id={self.session_id!r}, " \
-               f"creation_time={self.creation_time!r})"
+               f"creation_time={self.creation_time!r}, " \
+               f"last_seen={self.last_seen!r})"
 
 
 @dataclasses.dataclass
 class Task(Base):
     __tablename__ = "task_table"
+    __table_args__ = (sqlalchemy.Index('ix_task_table_username_state', 'username', 'state'),)
 
     task_name: Mapped[Optional[str]]
     task_id: Mapped[Optional[str]] = mapped_column(primary_key=True)
-    parent_session_id: Mapped[Optional[str]]
+    parent_session_id: Mapped[Optional[str]] = mapped_column(index=True)
     username: Mapped[Optional[str]]
     blend_file_path: Mapped[Optional[str]]
-    state: Mapped[Optional[str]]
+    state: Mapped[Optional[str]] = mapped_column(index=True)
+    priority: Mapped[Optional[int]] = mapped_column(server_default=sqlalchemy.text('0'))
+    progress: Mapped[Optional[str]]
+    created_at: Mapped[Optional[datetime.datetime]]
+    started_at: Mapped[Optional[datetime.datetime]]
+    finished_at: Mapped[Optional[datetime.datetime]]
+    start_frame: Mapped[Optional[int]]
+    end_frame: Mapped[Optional[int]]
+    tar_path: Mapped[Optional[str]]
+    frames_done: Mapped[Optional[int]] = mapped_column(server_default=sqlalchemy.text('0'))
+    kill_requested: Mapped[Optional[int]] = mapped_column(server_default=sqlalchemy.text('0'))
+    render_overrides: Mapped[Optional[str]]
+    blend_version: Mapped[Optional[str]]
+    blend_compression: Mapped[Optional[str]]
+    scene_start_frame: Mapped[Optional[int]]
+    scene_end_frame: Mapped[Optional[int]]
+    resolution_x: Mapped[Optional[int]]
+    resolution_y: Mapped[Optional[int]]
+    resolution_percentage: Mapped[Optional[int]]
+    render_engine: Mapped[Optional[str]]
+    samples: Mapped[Optional[int]]
+    estimated_cost: Mapped[Optional[float]]
+    blend_sha256: Mapped[Optional[str]]
+    deadline: Mapped[Optional[datetime.datetime]]
+    predicted_seconds: Mapped[Optional[float]]
+    predicted_finish: Mapped[Optional[datetime.datetime]]
+    retries: Mapped[Optional[int]] = mapped_column(server_default=sqlalchemy.text('0'))
+    failed_frames: Mapped[Optional[str]]
+    preview_frame: Mapped[Optional[int]]
 
     def __repr__(self) -> str:
         return f"Task(task_name={self.task_name!r}, " \
@@ -83,42 +140,184 @@ class Task(Base):
                f"parent_session_id={self.parent_session_id!r}, " \
                f"username={self.username!r}, " \
                f"blend_file_path={self.blend_file_path!r}, " \
-               f"state={self.state!r})"
+               f"state={self.state!r}, " \
+               f"priority={self.priority!r})"
+
+
+# One row per frame chunk handed to Blender, with the device it ran on
+@dataclasses.dataclass
+class Chunk(Base):
+    __tablename__ = "chunk_table"
+
+    chunk_id: Mapped[Optional[str]] = mapped_column(primary_key=True)
+    task_id: Mapped[Optional[str]] = mapped_column(index=True)
+    start_frame: Mapped[Optional[int]]
+    end_frame: Mapped[Optional[int]]
+    slot: Mapped[Optional[str]]
+    device: Mapped[Optional[str]]
+    started_at: Mapped[Optional[datetime.datetime]]
+    render_seconds: Mapped[Optional[float]]
+    return_code: Mapped[Optional[int]]
+
+    def __repr__(self) -> str:
+        return f"Chunk(chunk_id={self.chunk_id!r}, " \
+               f"task_id={self.task_id!r}, " \
+               f"start_frame={self.start_frame!r}, " \
+               f"end_frame={self.end_frame!r}, " \
+               f"device={self.device!r})"
+
+
+# One row per saved frame, kept after its task is gone to predict later renders of the same
+# file or user; cost is the task's estimated pixel samples per frame
+@dataclasses.dataclass
+class Frame(Base):
+    __tablename__ = "frame_table"
+
+    frame_id: Mapped[Optional[str]] = mapped_column(primary_key=True)
+    task_id: Mapped[Optional[str]]
+    username: Mapped[Optional[str]] = mapped_column(index=True)
+    blend_sha256: Mapped[Optional[str]] = mapped_column(index=True)
+    frame: Mapped[Optional[int]]
+    slot: Mapped[Optional[str]]
+    speed: Mapped[Optional[float]]
+    render_seconds: Mapped[Optional[float]]
+    samples: Mapped[Optional[int]]
+    peak_memory_mb: Mapped[Optional[float]]
+    cost: Mapped[Optional[float]]
+    finished_at: Mapped[Optional[datetime.datetime]] = mapped_column(index=True)
+
+    def __repr__(self) -> str:
+        return f"Frame(task_id={self.task_id!r}, " \
+               f"frame={self.frame!r}, " \
+               f"slot={self.slot!r}, " \
+               f"render_seconds={self.render_seconds!r})"
 
 
 database_types_union = typing.Union[type(User),
                                     type(Session),
-                                    type(Task)]
+                                    type(Task),
+                                    type(Chunk),
+                                    type(Frame)]
 
 
 class DatabaseConnector(DatabaseConfig):
     def __init__(self):
         super().__init__()
+        if self.db_url:
+            self.engine = sqlalchemy.create_engine(self.db_url)
+            return
         self.engine = sqlalchemy.create_engine(f'postgresql+psycopg2://'
                                                f'{self.db_user}:{self.db_pass}'
                                                f'@{self.db_host}:{self.db_port}/'
-                                               f'{self.db_name}')
+                                               f'{self.db_name}',
+                                               connect_args={'connect_timeout': self.db_connect_timeout_seconds})
+
+
+current_unit_of_work = contextvars.ContextVar('current_unit_of_work', default=None)
+
+
+# One ORM session and one pooled connection shared by every operation of a request,
+# checked out on first use and returned when the request finishes
+class UnitOfWork:
+    def __init__(self, engine):
+        self.engine = engine
+        self.database_session = None
+
+    def get(self):
+        if self.database_session is None:
+            start_time = time.perf_counter()
+            self.database_session = sqlalchemy.orm.Session(self.engine, expire_on_commit=False)
+            self.database_session.connection()
+            checkout_seconds.observe(time.perf_counter() - start_time)
+        return self.database_session
+
+    def close(self):
+        if self.database_session is not None:
+            self.database_session.close()
+            self.database_session = None
 
 
+# Creating the engine does not connect; connect() does, on a background thread at server start
 class DatabaseOperator:
     def __init__(self):
-        self.engine = DatabaseConnector().engine
-        Base.metadata.create_all(self.engine)
+        self.connector = DatabaseConnector()
+        self.engine = self.connector.engine
+        self.ready = threading.Event()
+
+    # Every attempt opens a new connection, waits double up to DB_RETRY_MAX_SECONDS in between
+    def connect(self):
+        start_time = time.monotonic()
+        delay = 0.1
+        attempt = 1
+        while True:
+            try:
+                migrations.upgrade(self.engine)
+                break
+            except sqlalchemy.exc.OperationalError as e:
+                elapsed = time.monotonic() - start_time
+                if elapsed + delay > self.connector.db_startup_timeout_seconds:
+                    raise Exception(f'Database is not up after {elapsed:.0f}s and {attempt} attempt(s): {e}')
+                logger.warning(f'database is not reachable (attempt {attempt}), retrying in {delay:.1f}s: '
+                               f'{str(e.orig).strip()}')
+                time.sleep(delay)
+                delay = min(2 * delay, self.connector.db_retry_max_seconds)
+                attempt += 1
+        self.ready.set()
+        logger.info(f'database ready after {attempt} attempt(s)')
+
+    def begin_unit_of_work(self):
+        unit_of_work = UnitOfWork(self.engine)
+        return unit_of_work, current_unit_of_work.set(unit_of_work)
+
+    def end_unit_of_work(self, unit_of_work, token):
+        current_unit_of_work.reset(token)
+        unit_of_work.close()
+
+    @contextlib.contextmanager
+    def unit_of_work(self):
+        unit_of_work, token = self.begin_unit_of_work()
+        try:
+            yield unit_of_work
+        finally:
+            self.end_unit_of_work(unit_of_work, token)
+
+    @contextlib.contextmanager
+    def session(self, operation):
+        start_time = time.perf_counter()
+        unit_of_work = current_unit_of_work.get()
+        with tracing.span(f'db.{operation}'):
+            if unit_of_work is not None:
+                database_session = unit_of_work.get()
+                try:
+                    yield database_session
+                except Exception:
+                    database_session.rollback()
+                    raise
+                finally:
+                    query_seconds.observe(time.perf_counter() - start_time, operation=operation)
+                return
+            with sqlalchemy.orm.Session(self.engine) as database_session:
+                database_session.connection()
+                checkout_seconds.observe(time.perf_counter() - start_time)
+                try:
+                    yield database_session
+                finally:
+                    query_seconds.observe(time.perf_counter() - start_time, operation=operation)
 
     # database_operator_instance.insert_rows([Session(username, id, creation_time)])
     def insert_rows(self, data: list) -> bool:
-        with sqlalchemy.orm.Session(self.engine) as database_session:
+        with self.session('insert') as database_session:
             database_session.add_all(data)
             database_session.commit()
         return True
 
     def query_row_by_primary_field(self, object_class: database_types_union, value):
-        with sqlalchemy.orm.Session(self.engine) as database_session:
+        with self.session('get') as database_session:
             row = database_session.get(object_class, value)
         return row
 
     def query_rows(self, object_class: database_types_union, object_class_column_filter):
-        with sqlalchemy.orm.Session(self.engine) as database_session:
+        with self.session('select') as database_session:
             rows = database_session.execute(
                 sqlalchemy.select(object_class)
                 .where(object_class_column_filter)).fetchall()
@@ -126,7 +325,7 @@ class DatabaseOperator:
 
     # database_operator_instance.update_row(Session, Session.username == 'Spongebob', id='1x1')
     def update_row(self, object_class: database_types_union, object_class_column_filter, **kwvalues) -> bool:
-        with sqlalchemy.orm.Session(self.engine) as database_session:
+        with self.session('update') as database_session:
             database_session.execute(
                 sqlalchemy.update(object_class)
                 .where(object_class_column_filter)
@@ -134,8 +333,31 @@ class DatabaseOperator:
             database_session.commit()
         return True
 
+    # database_operator_instance.bulk_update_rows(Session, [{'session_id': '1x1', 'last_seen': now}])
+    # A Core executemany keyed on the primary key: rows deleted in the meantime are skipped, where
+    # the ORM bulk update raises StaleDataError and loses the whole batch
+    def bulk_update_rows(self, object_class: database_types_union, rows: list) -> bool:
+        if not rows:
+            return True
+        primary_key = object_class.__table__.primary_key.columns[0]
+        value_names = [name for name in rows[0] if name != primary_key.name]
+        statement = (sqlalchemy.update(object_class.__table__)
+                     .where(primary_key == sqlalchemy.bindparam('row_key'))
+                     .values({name: sqlalchemy.bindparam(f'row_{name}') for name in value_names}))
+        parameters = [dict({f'row_{name}': row[name] for name in value_names}, row_key=row[primary_key.name])
+                      for row in rows]
+        with self.session('bulk_update') as database_session:
+            database_session.execute(statement, parameters)
+            database_session.commit()
+        return True
+
+    def query_joined_rows(self, statement):
+        with self.session('select_joined') as database_session:
+            rows = database_session.execute(statement).fetchall()
+        return rows
+
     def delete_row(self, object_class: database_types_union, object_class_column_filter) -> bool:
-        with sqlalchemy.orm.Session(self.engine) as database_session:
+        with self.session('delete') as database_session:
             database_session.execute(
                 sqlalchemy.delete(object_class)
                 .where(object_class_column_filter))
@@ -168,8 +390,8 @@ class OperatorAliases(DatabaseOperator):
     def add_task(self, **kwvalues) -> bool:
         return self.insert_rows([Task(**kwvalues)])
 
-    def update_task_state(self, task_id: str, new_state: str) -> bool:
-        return self.update_row(Task, Task.task_id == task_id, state=new_state)
+    def update_task_state(self, task_id: str, new_state: str, **kwvalues) -> bool:
+        return self.update_row(Task, Task.task_id == task_id, state=new_state, **kwvalues)
 
     def get_task_by_id(self, task_id: str):
         return self.query_row_by_primary_field(Task, task_id)
@@ -177,11 +399,125 @@ class OperatorAliases(DatabaseOperator):
     def get_tasks_by_session_id(self, session_id: str):
         return self.query_rows(Task, Task.parent_session_id == session_id)
 
+    # (session, tasks) where session is None when it does not exist
+    def get_tasks_if_session(self, session_id: str):
+        rows = self.query_joined_rows(
+            sqlalchemy.select(Session, Task)
+            .outerjoin(Task, Task.parent_session_id == Session.session_id)
+            .where(Session.session_id == session_id))
+        if not rows:
+            return None, []
+        return rows[0][0], [task for _, task in rows if task is not None]
+
+    # (session, task) where task is None unless it exists and belongs to the session
+    def get_task_if_session(self, session_id: str, task_id: str):
+        rows = self.query_joined_rows(
+            sqlalchemy.select(Session, Task)
+            .outerjoin(Task, sqlalchemy.and_(Task.parent_session_id == Session.session_id,
+                                             Task.task_id == task_id))
+            .where(Session.session_id == session_id))
+        if not rows:
+            return None, None
+        return rows[0][0], rows[0][1]
+
+    def update_sessions_last_seen(self, last_seen_by_session_id: dict) -> bool:
+        return self.bulk_update_rows(Session, [{'session_id': session_id, 'last_seen': last_seen}
+                                               for session_id, last_seen in last_seen_by_session_id.items()])
+
+    def get_expired_session_ids(self, created_before: datetime.datetime, seen_before: datetime.datetime):
+        return [row[0].session_id for row in self.query_rows(
+            Session, sqlalchemy.or_(Session.creation_time < created_before,
+                                    sqlalchemy.func.coalesce(Session.last_seen, Session.creation_time)
+                                    < seen_before))]
+
+    def get_tasks_by_session_ids(self, session_ids: list):
+        return self.query_rows(Task, Task.parent_session_id.in_(session_ids))
+
+    def delete_tasks_by_ids(self, task_ids: list) -> bool:
+        self.delete_row(Chunk, Chunk.task_id.in_(task_ids))
+        return self.delete_row(Task, Task.task_id.in_(task_ids))
+
+    def delete_sessions_by_ids(self, session_ids: list) -> bool:
+        return self.delete_row(Session, Session.session_id.in_(session_ids))
+
+    def get_tasks_by_state(self, state: str):
+        return self.query_rows(Task, Task.state == state)
+
+    # (start_frame, end_frame, frames_done, render_overrides) of tasks not yet rendered
+    def get_pending_task_frames(self, states: tuple):
+        return self.query_joined_rows(sqlalchemy.select(Task.start_frame, Task.end_frame, Task.frames_done,
+                                                        Task.render_overrides)
+                                      .where(Task.state.in_(states)))
+
+    # (tasks, earliest created_at) submitted by username since created_after
+    def get_user_submissions_since(self, username: str, created_after: datetime.datetime):
+        return self.query_joined_rows(sqlalchemy.select(sqlalchemy.func.count(), sqlalchemy.func.min(Task.created_at))
+                                      .where(Task.username == username, Task.created_at >= created_after))[0]
+
+    # (task_id, kill_requested) for those of task_ids that still exist
+    def get_task_controls(self, task_ids: list):
+        return self.query_joined_rows(sqlalchemy.select(Task.task_id, Task.kill_requested)
+                                      .where(Task.task_id.in_(task_ids)))
+
+    def request_task_kill(self, task_id: str) -> bool:
+        return self.update_row(Task, Task.task_id == task_id, kill_requested=1)
+
+    # {task_id: (progress, frames_done, predicted_finish, retries, failed_frames, preview_frame)}
+    def update_tasks_progress(self, progress_by_task_id: dict) -> bool:
+        return self.bulk_update_rows(Task, [{'task_id': task_id, 'progress': progress, 'frames_done': frames_done,
+                                             'predicted_finish': predicted_finish, 'retries': retries,
+                                             'failed_frames': failed_frames, 'preview_frame': preview_frame}
+                                            for task_id, (progress, frames_done, predicted_finish, retries,
+                                                          failed_frames, preview_frame)
+                                            in progress_by_task_id.items()])
+
+    def add_frames(self, frames: list) -> bool:
+        return self.insert_rows([Frame(**frame) for frame in frames])
+
+    # (speed weighted seconds of frames with a cost, their summed cost, mean speed weighted seconds, frames)
+    def get_frame_history(self, frame_filter):
+        weighted_seconds = Frame.render_seconds * Frame.speed
+        return self.query_joined_rows(
+            sqlalchemy.select(sqlalchemy.func.sum(sqlalchemy.case((Frame.cost.isnot(None), weighted_seconds),
+                                                                  else_=0.0)),
+                              sqlalchemy.func.sum(Frame.cost),
+                              sqlalchemy.func.avg(weighted_seconds),
+                              sqlalchemy.func.count())
+            .where(frame_filter))[0]
+
+    def get_frame_history_by_blob(self, blend_sha256: str):
+        return self.get_frame_history(Frame.blend_sha256 == blend_sha256)
+
+    def get_frame_history_by_user(self, username: str):
+        return self.get_frame_history(Frame.username == username)
+
+    def get_saved_frames_by_task_id(self, task_id: str) -> list:
+        return [row[0] for row in self.query_joined_rows(sqlalchemy.select(Frame.frame)
+                                                         .where(Frame.task_id == task_id))]
+
+    # (frames, earliest finished_at) saved since finished_after
+    def get_frames_since(self, finished_after: datetime.datetime):
+        return self.query_joined_rows(sqlalchemy.select(sqlalchemy.func.count(), sqlalchemy.func.min(Frame.finished_at))
+                                      .where(Frame.finished_at >= finished_after))[0]
+
+    def delete_frames_before(self, finished_before: datetime.datetime) -> bool:
+        return self.delete_row(Frame, Frame.finished_at < finished_before)
+
+    def get_all_tasks(self):
+        return self.query_rows(Task, sqlalchemy.true())
+
     def delete_task_by_id(self, task_id: str) -> bool:
+        self.delete_row(Chunk, Chunk.task_id == task_id)
         return self.delete_row(Task, Task.task_id == task_id)
 
     def delete_task_by_session_id(self, session_id: str) -> bool:
+        self.delete_row(Chunk, Chunk.task_id.in_(sqlalchemy.select(Task.task_id)
+                                                 .where(Task.parent_session_id == session_id)))
         return self.delete_row(Task, Task.parent_session_id == session_id)
 
+    def add_chunk(self, **kwvalues) -> bool:
+        return self.insert_rows([Chunk(**kwvalues)])
+
+    def get_chunks_by_task_id(self, task_id: str):
+        return self.query_rows(Chunk, Chunk.task_id == task_id)
 
-wait_for_database_up()
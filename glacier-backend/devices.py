@@ -0,0 +1,130 @@
+import logging
+import subprocess
+
+import scheduling
+
+logger = logging.getLogger(__name__)
+
+# Every render device is a scheduling slot of its own. RENDER_DEVICES lists them as
+# comma separated KIND[:blender device id][=speed], e.g. 'OPTIX:OPTIX_0000:01:00=1,CPU=0.2';
+# when it is empty Blender is asked which devices it sees. Speed is relative throughput,
+# used to prefer faster free devices and to weight fair-share accounting.
+
+GPU_KINDS = ('OPTIX', 'CUDA', 'HIP', 'ONEAPI', 'METAL')
+DEFAULT_SPEED_BY_KIND = {'CPU': 0.2}
+PROBE_MARKER = 'GLACIER_DEVICE'
+
+PROBE_SCRIPT = f'''import bpy
+import os
+prefs = bpy.context.preferences.addons['cycles'].preferences
+for device_type in {GPU_KINDS!r}:
+    try:
+        devices = prefs.get_devices_for_type(device_type)
+    except Exception:
+        continue
+    for device in devices:
+        print({PROBE_MARKER!r}, device.type, device.id, device.name, sep='\\t', flush=True)
+print({PROBE_MARKER!r}, 'CPU', 'CPU', f'CPU, {{os.cpu_count()}} threads', sep='\\t', flush=True)
+'''
+
+
+class Device:
+    def __init__(self, kind, device_id='', name='', speed=None):
+        self.kind = kind
+        self.device_id = device_id
+        self.name = name or device_id or kind
+        self.speed = DEFAULT_SPEED_BY_KIND.get(kind, 1.0) if speed is None else speed
+
+    def __repr__(self):
+        return f'Device(kind={self.kind!r}, device_id={self.device_id!r}, speed={self.speed!r})'
+
+    # Blender renders on every device of a kind unless told otherwise
+    def pin_expr(self):
+        if self.kind == 'CPU' or not self.device_id:
+            return ''
+        return '\n'.join(['import bpy',
+                          "prefs = bpy.context.preferences.addons['cycles'].preferences",
+                          f'prefs.compute_device_type = {self.kind!r}',
+                          f'prefs.get_devices_for_type({self.kind!r})',
+                          'for device in prefs.devices:',
+                          f'    device.use = device.id == {self.device_id!r}',
+                          "bpy.context.scene.cycles.device = 'GPU'"])
+
+    def blender_args(self):
+        expr = self.pin_expr()
+        return ['--python-expr', expr] if expr else []
+
+    # --cycles-device renders on every device of the kind and overrides the preferences, so a
+    # pinned GPU goes without it and relies on pin_expr
+    def cycles_args(self):
+        if self.pin_expr():
+            return []
+        return ['--', '--cycles-device', self.kind]
+
+
+def parse_devices(text):
+    devices = []
+    for entry in text.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        speed = None
+        if '=' in entry:
+            entry, speed_text = entry.rsplit('=', 1)
+            speed = float(speed_text)
+        kind, _, device_id = entry.partition(':')
+        kind = kind.upper()
+        if kind != 'CPU' and kind not in GPU_KINDS:
+            raise Exception(f'unknown render device kind {kind}')
+        devices.append(Device(kind, device_id, speed=speed))
+    return devices
+
+
+# Keeps the devices of the first GPU kind Blender reports (OptiX before CUDA for the same
+# cards) and a single CPU device
+def probe_devices(blender_bin, timeout):
+    result = subprocess.run([blender_bin, '-b', '--factory-startup', '--python-expr', PROBE_SCRIPT],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL,
+                            timeout=timeout)
+    devices_by_kind = {}
+    for line in result.stdout.decode(errors='replace').splitlines():
+        fields = line.split('\t')
+        if len(fields) != 4 or fields[0] != PROBE_MARKER:
+            continue
+        _, kind, device_id, name = fields
+        if any(device.device_id == device_id for device in devices_by_kind.get(kind, [])):
+            continue
+        devices_by_kind.setdefault(kind, []).append(Device(kind, device_id, name))
+    devices = []
+    for kind in GPU_KINDS:
+        if kind in devices_by_kind:
+            devices += devices_by_kind[kind]
+            break
+    devices += devices_by_kind.get('CPU', [])[:1]
+    return devices
+
+
+def discover(config):
+    if config.render_devices:
+        devices = parse_devices(config.render_devices)
+    else:
+        try:
+            devices = probe_devices(config.blender_bin, config.device_probe_timeout_seconds)
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.error(f'render device probe failed: {e}')
+            devices = []
+    if not devices:
+        logger.warning(f'no render devices found, using {config.render_slots} CPU slot(s)')
+        devices = [Device('CPU') for _ in range(config.render_slots)]
+    for device in devices:
+        logger.info(f'render device {device.kind} {device.name}, speed {device.speed}')
+    return devices
+
+
+def make_slots(devices):
+    slots = []
+    for device in devices:
+        index = sum(1 for slot in slots if slot.device.kind == device.kind)
+        slots.append(scheduling.Slot(f'{device.kind.lower()}{index}', device.speed, device))
+    return slots
@@ -0,0 +1,66 @@
+import fcntl
+import logging
+import os
+
+import sqlalchemy
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_LOCK_ID = 0x61ac1e6
+
+
+# Exactly one server process owns the Blender children. On Postgres the lease is a session
+# advisory lock, so API replicas on other hosts sharing the database and UPLOAD_FACILITY
+# defer to it; otherwise it is an exclusive flock next to the uploads. Either is released
+# by the OS or the database when the owning process dies.
+class SchedulerLease:
+    def __init__(self, engine, lock_path):
+        self.engine = engine
+        self.lock_path = lock_path
+        self.connection = None
+        self.lock_fd = None
+        os.register_at_fork(after_in_child=self.close_in_child)
+
+    def try_acquire(self):
+        if self.engine.dialect.name == 'postgresql':
+            connection = self.engine.connect()
+            is_acquired = connection.execute(sqlalchemy.text('SELECT pg_try_advisory_lock(:lock_id)'),
+                                             {'lock_id': SCHEDULER_LOCK_ID}).scalar()
+            connection.commit()
+            if not is_acquired:
+                connection.close()
+                return False
+            self.connection = connection
+            return True
+        lock_fd = os.open(self.lock_path, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(lock_fd)
+            return False
+        self.lock_fd = lock_fd
+        return True
+
+    # Forked children (the preview pool) must not keep the lease alive after this process dies:
+    # the flock is held while any copy of its descriptor is open, the advisory lock while the
+    # connection's socket is
+    def close_in_child(self):
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+        if self.connection is not None:
+            os.close(self.connection.connection.dbapi_connection.fileno())
+            self.connection = None
+
+    # The advisory lock lives as long as its database session. Once the connection drops, another
+    # process can take the lease while this one still runs, so the scheduler checks every tick.
+    def is_held(self):
+        if self.connection is None:
+            return self.lock_fd is not None
+        try:
+            self.connection.execute(sqlalchemy.text('SELECT 1'))
+            self.connection.commit()
+            return True
+        except sqlalchemy.exc.DBAPIError as e:
+            logger.error(f'scheduler lease connection lost: {e}')
+            return False
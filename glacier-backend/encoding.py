@@ -0,0 +1,30 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_TYPE = 'application/json'
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+# msgpack when the client lists it and the server has it, JSON otherwise; orjson is used
+# for JSON when installed
+def negotiate(accept):
+    if msgpack is not None and any(content_type in accept for content_type in MSGPACK_TYPES):
+        return MSGPACK_TYPES[0]
+    return JSON_TYPE
+
+
+def encode(data, content_type):
+    if content_type != JSON_TYPE:
+        return msgpack.packb(data)
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode()
@@ -0,0 +1,20 @@
+MIN_FRAMES = 3
+
+
+# Seconds on a speed 1.0 device, scaled by estimated cost when both sides have one
+def seconds_from(history, estimated_cost, frame_count):
+    weighted_seconds, cost, mean_seconds, frames = history
+    if not frames or frames < MIN_FRAMES:
+        return None
+    if estimated_cost and cost:
+        return weighted_seconds / cost * estimated_cost
+    return mean_seconds * frame_count
+
+
+# Frames of the same file are the best guide, then the user's own history
+def predict_seconds(db, blend_sha256, username, estimated_cost, frame_count):
+    for history in (db.get_frame_history_by_blob(blend_sha256), db.get_frame_history_by_user(username)):
+        seconds = seconds_from(history, estimated_cost, frame_count)
+        if seconds is not None:
+            return seconds
+    return None
@@ -0,0 +1,226 @@
+import datetime
+import logging
+import os
+import re
+import shutil
+import time
+
+import assets
+import metrics
+from config import StorageConfig
+from database import as_utc
+
+logger = logging.getLogger(__name__)
+
+TASK_FILE_PATTERN = re.compile(r'^([0-9a-f]{32})(\.blend|\.tar\.gz|\.log\.\d+|\.previews|\.tiles|\.assets)?$')
+FINISHED_STATES = ('PACKED', 'DONE', 'KILLED', 'FAILED(BLENDER)', 'FAILED(TAR)')
+
+reclaimed_bytes = metrics.registry.counter('glacier_janitor_reclaimed_bytes_total',
+                                           'Bytes freed in UPLOAD_FACILITY by the janitor',
+                                           ('reason',))
+evicted_tasks = metrics.registry.counter('glacier_janitor_evicted_tasks_total',
+                                         'Tasks or orphaned artifacts removed by the janitor',
+                                         ('reason',))
+
+
+def path_size(path):
+    if not os.path.isdir(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+    total = 0
+    for directory, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                total += os.path.getsize(os.path.join(directory, file_name))
+            except OSError:
+                pass
+    return total
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class TaskArtifacts:
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.paths = []
+        self.size = 0
+        self.last_used = 0.0
+
+    def add(self, path):
+        self.paths.append(path)
+        self.size += path_size(path)
+        try:
+            self.last_used = max(self.last_used, os.path.getmtime(path))
+        except OSError:
+            pass
+
+
+class Janitor(StorageConfig):
+    def __init__(self, db, render_bus):
+        super().__init__()
+        self.db = db
+        self.render_bus = render_bus
+        self.ttl_by_state = {}
+        for policy in self.artifact_ttl_hours.split(','):
+            state, hours = policy.rsplit('=', 1)
+            self.ttl_by_state[state.strip()] = float(hours) * 3600
+        self.usage_bytes = 0
+        self.usage_by_user = {}
+        self.reclaiming = {}
+        self.last_sweep = {}
+        self.is_evicting = False
+        metrics.registry.gauge('glacier_storage_used_bytes', 'Bytes held by task artifacts in UPLOAD_FACILITY',
+                               callback=lambda: self.usage_bytes)
+        metrics.registry.gauge('glacier_storage_user_used_bytes', 'Bytes held by task artifacts per user',
+                               ('username',), callback=lambda: dict(self.usage_by_user))
+        metrics.registry.gauge('glacier_storage_free_bytes', 'Free bytes on the UPLOAD_FACILITY filesystem',
+                               callback=lambda: shutil.disk_usage(self.upload_facility).free)
+        metrics.registry.gauge('glacier_storage_last_sweep_reclaimed_bytes',
+                               'Bytes reclaimed by the last janitor sweep that freed anything', ('reason',),
+                               callback=lambda: dict(self.last_sweep))
+
+    def run(self):
+        logger.info(f'janitor start, sweeping every {self.janitor_interval_seconds}s')
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f'janitor sweep failed: {e}')
+            time.sleep(self.janitor_interval_seconds)
+
+    def scan(self):
+        artifacts_by_task_id = {}
+        for entry in os.scandir(self.upload_facility):
+            match = TASK_FILE_PATTERN.match(entry.name)
+            if not match:
+                continue
+            task_id = match.group(1)
+            artifacts_by_task_id.setdefault(task_id, TaskArtifacts(task_id)).add(entry.path)
+        return artifacts_by_task_id
+
+    def is_over_user_quota(self, username):
+        return bool(self.user_quota_bytes) and self.usage_by_user.get(username, 0) >= self.user_quota_bytes
+
+    def evict(self, task, artifacts, reason):
+        task_id = task.task_id if task else artifacts.task_id
+        live_task = self.render_bus.live_task(task_id)
+        if live_task is not None:
+            live_task.kill()
+            self.render_bus.delete_task(task_id)
+        if task:
+            self.db.delete_task_by_id(task_id)
+        for path in artifacts.paths:
+            remove_path(path)
+        reclaimed_bytes.inc(artifacts.size, reason=reason)
+        evicted_tasks.inc(reason=reason)
+        self.reclaiming[reason] = self.reclaiming.get(reason, 0) + artifacts.size
+        logger.info(f'janitor evicted {task_id} ({reason}), {artifacts.size} bytes')
+        return artifacts.size
+
+    # Store files no task tree links to any more are kept for reuse until asset_ttl_hours after
+    # their last use; partial uploads are dropped once abandoned
+    def prune_assets(self, now):
+        try:
+            entries = list(os.scandir(assets.store_dir(self.upload_facility)))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if entry.name.endswith('.part'):
+                is_unused = now - stat.st_mtime > self.orphan_grace_seconds
+            else:
+                is_unused = stat.st_nlink == 1 and now - stat.st_mtime > self.asset_ttl_hours * 3600
+            if not is_unused:
+                continue
+            try:
+                # A store file touched by /asset/missing since the scan is about to be linked
+                if os.stat(entry.path).st_mtime != stat.st_mtime:
+                    continue
+                os.remove(entry.path)
+            except OSError:
+                continue
+            reclaimed_bytes.inc(stat.st_size, reason='asset')
+            self.reclaiming['asset'] = self.reclaiming.get('asset', 0) + stat.st_size
+
+    @staticmethod
+    def usage_of(artifacts_by_task_id, tasks_by_id):
+        usage_by_user = {}
+        for task_id, artifacts in artifacts_by_task_id.items():
+            task = tasks_by_id.get(task_id)
+            username = task.username if task else ''
+            usage_by_user[username] = usage_by_user.get(username, 0) + artifacts.size
+        return usage_by_user
+
+    # Every server process measures usage for its quota checks, only the scheduler process evicts
+    def sweep(self):
+        now = time.time()
+        self.reclaiming = {}
+        artifacts_by_task_id = self.scan()
+        tasks_by_id = {row[0].task_id: row[0] for row in self.db.get_all_tasks()}
+        if not self.is_evicting:
+            self.usage_by_user = self.usage_of(artifacts_by_task_id, tasks_by_id)
+            self.usage_bytes = sum(self.usage_by_user.values())
+            return
+
+        if self.frame_history_days:
+            self.db.delete_frames_before(datetime.datetime.fromtimestamp(now - self.frame_history_days * 86400,
+                                                                         datetime.timezone.utc))
+
+        for task_id, artifacts in list(artifacts_by_task_id.items()):
+            if task_id not in tasks_by_id and now - artifacts.last_used > self.orphan_grace_seconds:
+                self.evict(None, artifacts, 'orphan')
+                del artifacts_by_task_id[task_id]
+        self.prune_assets(now)
+
+        evictable = []
+        for task_id, task in tasks_by_id.items():
+            artifacts = artifacts_by_task_id.get(task_id)
+            if artifacts is None or task.state not in FINISHED_STATES:
+                continue
+            ttl = self.ttl_by_state.get(task.state)
+            finished_at = artifacts.last_used
+            if task.finished_at:
+                finished_at = as_utc(task.finished_at).timestamp()
+            if ttl is not None and now - finished_at > ttl:
+                self.evict(task, artifacts, 'ttl')
+                del artifacts_by_task_id[task_id]
+                continue
+            evictable.append((task, artifacts))
+        evictable.sort(key=lambda item: item[1].last_used)
+
+        usage_by_user = self.usage_of(artifacts_by_task_id, tasks_by_id)
+        usage_bytes = sum(usage_by_user.values())
+
+        least_recently_used = []
+        for task, artifacts in evictable:
+            if self.user_quota_bytes and usage_by_user[task.username] > self.user_quota_bytes:
+                usage_by_user[task.username] -= self.evict(task, artifacts, 'user_quota')
+                usage_bytes -= artifacts.size
+            else:
+                least_recently_used.append((task, artifacts))
+
+        for task, artifacts in least_recently_used:
+            disk_usage = shutil.disk_usage(self.upload_facility)
+            is_below_watermark = 100 * disk_usage.free / disk_usage.total < self.min_free_percent
+            is_over_global_quota = self.global_quota_bytes and usage_bytes > self.global_quota_bytes
+            if not is_below_watermark and not is_over_global_quota:
+                break
+            usage_by_user[task.username] -= self.evict(task, artifacts, 'lru')
+            usage_bytes -= artifacts.size
+
+        self.usage_by_user = usage_by_user
+        self.usage_bytes = usage_bytes
+        # Published whole once the sweep is done, a scrape never sees a half finished sweep
+        if self.reclaiming:
+            self.last_sweep = self.reclaiming
+            logger.info(f'janitor reclaimed {self.last_sweep} bytes, {usage_bytes} bytes in use')
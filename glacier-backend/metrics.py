@@ -0,0 +1,192 @@
+import bisect
+import threading
+
+# Hot-path writes never take a lock: every thread owns a private shard per metric and only
+# that thread mutates it, the scraper sums the shards. Shards of finished threads are folded
+# into the retired totals on scrape, so short-lived render threads do not leak memory.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+# The sharding shared by counters and histograms; each defines merge(into, values), folding one
+# shard's values into a total, and expose() on top of it
+class ShardedMetric:
+    kind = ''
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.local = threading.local()
+        self.shards_by_id = {}
+        self.retired = {}
+
+    def key(self, labels):
+        if len(labels) != len(self.label_names):
+            raise Exception(f'metric {self.name} expects labels {self.label_names}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = {}
+            self.local.shard = shard
+            self.shards_by_id[id(shard)] = (threading.current_thread(), shard)
+        return shard
+
+    def collect(self):
+        totals = {}
+        self.merge(totals, self.retired)
+        for shard_id, (thread, shard) in list(self.shards_by_id.items()):
+            snapshot = dict(shard)
+            if thread.is_alive():
+                self.merge(totals, snapshot)
+                continue
+            self.merge(self.retired, snapshot)
+            self.merge(totals, snapshot)
+            del self.shards_by_id[shard_id]
+        return totals
+
+
+class Counter(ShardedMetric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        shard = self.shard()
+        key = self.key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def merge(self, into, values):
+        for key, value in values.items():
+            into[key] = into.get(key, 0) + value
+
+    def expose(self):
+        lines = []
+        for key, value in sorted(self.collect().items()):
+            lines.append(f'{self.name}{format_labels(self.label_names, key)} {format_value(value)}')
+        return lines
+
+
+class Histogram(ShardedMetric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    # Per key the shard holds [count per bucket..., count in +Inf, sum]
+    def observe(self, value, **labels):
+        shard = self.shard()
+        key = self.key(labels)
+        cells = shard.get(key)
+        if cells is None:
+            cells = [0] * (len(self.buckets) + 2)
+            shard[key] = cells
+        cells[bisect.bisect_left(self.buckets, value)] += 1
+        cells[-1] += value
+
+    def merge(self, into, values):
+        for key, cells in values.items():
+            cells = list(cells)
+            total = into.get(key)
+            if total is None:
+                into[key] = cells
+                continue
+            for index, cell in enumerate(cells):
+                total[index] += cell
+
+    def expose(self):
+        lines = []
+        for key, cells in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), cells):
+                cumulative += count
+                labels = format_labels(self.label_names, key, extra=(('le', format_value(float(bound))),))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = format_labels(self.label_names, key)
+            lines.append(f'{self.name}_sum{labels} {format_value(cells[-1])}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, label_names=(), callback=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.callback = callback
+        self.values = {}
+
+    # Plain dict assignment is atomic, last writer wins which is what a gauge means anyway
+    def set(self, value, **labels):
+        self.values[tuple(str(labels[name]) for name in self.label_names)] = value
+
+    def collect(self):
+        if self.callback is None:
+            return dict(self.values)
+        value = self.callback()
+        if isinstance(value, dict):
+            return {key if isinstance(key, tuple) else (key,): item for key, item in value.items()}
+        return {(): value}
+
+    def expose(self):
+        lines = []
+        for key, value in sorted(self.collect().items()):
+            lines.append(f'{self.name}{format_labels(self.label_names, key)} {format_value(value)}')
+        return lines
+
+
+class Registry:
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self.metrics_by_name = {}
+
+    def register(self, metric):
+        existing = self.metrics_by_name.get(metric.name)
+        if existing is not None:
+            return existing
+        self.metrics_by_name[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self.register(Counter(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, label_names, buckets))
+
+    def gauge(self, name, help_text, label_names=(), callback=None):
+        return self.register(Gauge(name, help_text, label_names, callback))
+
+    def exposition(self):
+        lines = []
+        for name, metric in sorted(self.metrics_by_name.items()):
+            lines.append(f'# HELP {name} {metric.help_text}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            lines += metric.expose()
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
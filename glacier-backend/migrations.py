@@ -0,0 +1,212 @@
+import datetime
+import logging
+import time
+
+import sqlalchemy
+
+logger = logging.getLogger(__name__)
+
+# The schema is owned by this list, not by Base.metadata.create_all: every change to the
+# models in database.py ships as a new numbered step here and is applied once at startup.
+# All pending steps run in one transaction, serialized across processes on Postgres.
+
+VERSION_TABLE = 'glacier_schema_version'
+ADVISORY_LOCK_ID = 0x61ac1e5
+
+
+def add_column(connection, table_name, column):
+    column_type = column.type.compile(dialect=connection.dialect)
+    ddl = f'ALTER TABLE {table_name} ADD COLUMN {column.name} {column_type}'
+    if column.server_default is not None:
+        ddl += f' DEFAULT {column.server_default.arg}'
+    connection.execute(sqlalchemy.text(ddl))
+
+
+def create_baseline(connection):
+    metadata = sqlalchemy.MetaData()
+    sqlalchemy.Table('user_table', metadata,
+                     sqlalchemy.Column('username', sqlalchemy.String, primary_key=True),
+                     sqlalchemy.Column('password_hash', sqlalchemy.String))
+    sqlalchemy.Table('session_table', metadata,
+                     sqlalchemy.Column('username', sqlalchemy.String),
+                     sqlalchemy.Column('session_id', sqlalchemy.String, primary_key=True),
+                     sqlalchemy.Column('creation_time', sqlalchemy.String))
+    sqlalchemy.Table('task_table', metadata,
+                     sqlalchemy.Column('task_name', sqlalchemy.String),
+                     sqlalchemy.Column('task_id', sqlalchemy.String, primary_key=True),
+                     sqlalchemy.Column('parent_session_id', sqlalchemy.String),
+                     sqlalchemy.Column('username', sqlalchemy.String),
+                     sqlalchemy.Column('blend_file_path', sqlalchemy.String),
+                     sqlalchemy.Column('state', sqlalchemy.String))
+    metadata.create_all(connection)
+
+
+def add_lookup_indexes(connection):
+    connection.execute(sqlalchemy.text(
+        'CREATE INDEX ix_session_table_username ON session_table (username)'))
+    connection.execute(sqlalchemy.text(
+        'CREATE INDEX ix_task_table_parent_session_id ON task_table (parent_session_id)'))
+    connection.execute(sqlalchemy.text(
+        'CREATE INDEX ix_task_table_username_state ON task_table (username, state)'))
+
+
+# Sessions used to store str(time.time())
+def convert_session_creation_time(connection):
+    if connection.dialect.name == 'postgresql':
+        connection.execute(sqlalchemy.text(
+            'ALTER TABLE session_table ALTER COLUMN creation_time TYPE TIMESTAMP WITH TIME ZONE '
+            "USING to_timestamp(NULLIF(creation_time, '')::double precision)"))
+        return
+    add_column(connection, 'session_table',
+               sqlalchemy.Column('creation_timestamp', sqlalchemy.DateTime(timezone=True)))
+    session_table = sqlalchemy.Table('session_table', sqlalchemy.MetaData(), autoload_with=connection)
+    rows = connection.execute(sqlalchemy.select(session_table.c.session_id, session_table.c.creation_time))
+    for session_id, creation_time in rows.fetchall():
+        if not creation_time:
+            continue
+        connection.execute(sqlalchemy.update(session_table)
+                           .where(session_table.c.session_id == session_id)
+                           .values(creation_timestamp=datetime.datetime.fromtimestamp(float(creation_time),
+                                                                                      datetime.timezone.utc)))
+    connection.execute(sqlalchemy.text('ALTER TABLE session_table DROP COLUMN creation_time'))
+    connection.execute(sqlalchemy.text(
+        'ALTER TABLE session_table RENAME COLUMN creation_timestamp TO creation_time'))
+
+
+def add_task_scheduling_columns(connection):
+    add_column(connection, 'task_table',
+               sqlalchemy.Column('priority', sqlalchemy.Integer, server_default=sqlalchemy.text('0')))
+    add_column(connection, 'task_table', sqlalchemy.Column('progress', sqlalchemy.String))
+    add_column(connection, 'task_table', sqlalchemy.Column('created_at', sqlalchemy.DateTime(timezone=True)))
+    add_column(connection, 'task_table', sqlalchemy.Column('started_at', sqlalchemy.DateTime(timezone=True)))
+    add_column(connection, 'task_table', sqlalchemy.Column('finished_at', sqlalchemy.DateTime(timezone=True)))
+
+
+def add_session_last_seen(connection):
+    add_column(connection, 'session_table', sqlalchemy.Column('last_seen', sqlalchemy.DateTime(timezone=True)))
+    connection.execute(sqlalchemy.text('UPDATE session_table SET last_seen = creation_time'))
+    connection.execute(sqlalchemy.text(
+        'CREATE INDEX ix_session_table_last_seen ON session_table (last_seen)'))
+
+
+def add_task_runtime_columns(connection):
+    add_column(connection, 'task_table', sqlalchemy.Column('start_frame', sqlalchemy.Integer))
+    add_column(connection, 'task_table', sqlalchemy.Column('end_frame', sqlalchemy.Integer))
+    add_column(connection, 'task_table', sqlalchemy.Column('tar_path', sqlalchemy.String))
+    add_column(connection, 'task_table',
+               sqlalchemy.Column('frames_done', sqlalchemy.Integer, server_default=sqlalchemy.text('0')))
+    add_column(connection, 'task_table',
+               sqlalchemy.Column('kill_requested', sqlalchemy.Integer, server_default=sqlalchemy.text('0')))
+    connection.execute(sqlalchemy.text('CREATE INDEX ix_task_table_state ON task_table (state)'))
+
+
+def add_task_render_overrides(connection):
+    add_column(connection, 'task_table', sqlalchemy.Column('render_overrides', sqlalchemy.String))
+
+
+def create_chunk_table(connection):
+    metadata = sqlalchemy.MetaData()
+    sqlalchemy.Table('chunk_table', metadata,
+                     sqlalchemy.Column('chunk_id', sqlalchemy.String, primary_key=True),
+                     sqlalchemy.Column('task_id', sqlalchemy.String, index=True),
+                     sqlalchemy.Column('start_frame', sqlalchemy.Integer),
+                     sqlalchemy.Column('end_frame', sqlalchemy.Integer),
+                     sqlalchemy.Column('slot', sqlalchemy.String),
+                     sqlalchemy.Column('device', sqlalchemy.String),
+                     sqlalchemy.Column('started_at', sqlalchemy.DateTime(timezone=True)),
+                     sqlalchemy.Column('render_seconds', sqlalchemy.Float),
+                     sqlalchemy.Column('return_code', sqlalchemy.Integer))
+    metadata.create_all(connection)
+
+
+def add_task_blend_metadata(connection):
+    for name, column_type in (('blend_version', sqlalchemy.String),
+                              ('blend_compression', sqlalchemy.String),
+                              ('scene_start_frame', sqlalchemy.Integer),
+                              ('scene_end_frame', sqlalchemy.Integer),
+                              ('resolution_x', sqlalchemy.Integer),
+                              ('resolution_y', sqlalchemy.Integer),
+                              ('resolution_percentage', sqlalchemy.Integer),
+                              ('render_engine', sqlalchemy.String),
+                              ('samples', sqlalchemy.Integer),
+                              ('estimated_cost', sqlalchemy.Float)):
+        add_column(connection, 'task_table', sqlalchemy.Column(name, column_type))
+
+
+def add_frame_history(connection):
+    add_column(connection, 'task_table', sqlalchemy.Column('blend_sha256', sqlalchemy.String))
+    add_column(connection, 'task_table', sqlalchemy.Column('deadline', sqlalchemy.DateTime(timezone=True)))
+    add_column(connection, 'task_table', sqlalchemy.Column('predicted_seconds', sqlalchemy.Float))
+    add_column(connection, 'task_table', sqlalchemy.Column('predicted_finish', sqlalchemy.DateTime(timezone=True)))
+    metadata = sqlalchemy.MetaData()
+    sqlalchemy.Table('frame_table', metadata,
+                     sqlalchemy.Column('frame_id', sqlalchemy.String, primary_key=True),
+                     sqlalchemy.Column('task_id', sqlalchemy.String),
+                     sqlalchemy.Column('username', sqlalchemy.String, index=True),
+                     sqlalchemy.Column('blend_sha256', sqlalchemy.String, index=True),
+                     sqlalchemy.Column('frame', sqlalchemy.Integer),
+                     sqlalchemy.Column('slot', sqlalchemy.String),
+                     sqlalchemy.Column('speed', sqlalchemy.Float),
+                     sqlalchemy.Column('render_seconds', sqlalchemy.Float),
+                     sqlalchemy.Column('samples', sqlalchemy.Integer),
+                     sqlalchemy.Column('peak_memory_mb', sqlalchemy.Float),
+                     sqlalchemy.Column('cost', sqlalchemy.Float),
+                     sqlalchemy.Column('finished_at', sqlalchemy.DateTime(timezone=True), index=True))
+    metadata.create_all(connection)
+
+
+def add_task_retries(connection):
+    add_column(connection, 'task_table',
+               sqlalchemy.Column('retries', sqlalchemy.Integer, server_default=sqlalchemy.text('0')))
+    add_column(connection, 'task_table', sqlalchemy.Column('failed_frames', sqlalchemy.String))
+
+
+def add_task_preview_frame(connection):
+    add_column(connection, 'task_table', sqlalchemy.Column('preview_frame', sqlalchemy.Integer))
+
+
+MIGRATIONS = [
+    (1, 'baseline tables', create_baseline),
+    (2, 'session and task lookup indexes', add_lookup_indexes),
+    (3, 'session creation_time as timestamp', convert_session_creation_time),
+    (4, 'task priority, progress and timings', add_task_scheduling_columns),
+    (5, 'session last_seen', add_session_last_seen),
+    (6, 'task frames, tar path and kill flag', add_task_runtime_columns),
+    (7, 'task render overrides', add_task_render_overrides),
+    (8, 'render chunk table', create_chunk_table),
+    (9, 'task blend metadata and cost estimate', add_task_blend_metadata),
+    (10, 'frame timing history and task predictions', add_frame_history),
+    (11, 'task retries and failed frames', add_task_retries),
+    (12, 'task latest preview frame', add_task_preview_frame),
+]
+
+
+def current_version(connection):
+    version_table = sqlalchemy.Table(VERSION_TABLE, sqlalchemy.MetaData(),
+                                     sqlalchemy.Column('version', sqlalchemy.Integer, nullable=False))
+    version_table.create(connection, checkfirst=True)
+    version = connection.execute(sqlalchemy.select(version_table.c.version)).scalar()
+    if version is None:
+        connection.execute(sqlalchemy.insert(version_table).values(version=0))
+        version = 0
+    return version_table, version
+
+
+def upgrade(engine):
+    with engine.begin() as connection:
+        if connection.dialect.name == 'postgresql':
+            connection.execute(sqlalchemy.text(f'SELECT pg_advisory_xact_lock({ADVISORY_LOCK_ID})'))
+        version_table, version = current_version(connection)
+        pending = [migration for migration in MIGRATIONS if migration[0] > version]
+        if not pending:
+            logger.info(f'database schema is at version {version}')
+            return version
+        for migration_version, description, migration in pending:
+            start_time = time.perf_counter()
+            migration(connection)
+            logger.info(f'migration {migration_version} ({description}) applied '
+                        f'in {1000 * (time.perf_counter() - start_time):.1f}ms')
+        version = pending[-1][0]
+        connection.execute(sqlalchemy.update(version_table).values(version=version))
+    logger.info(f'database schema upgraded to version {version}')
+    return version
@@ -0,0 +1,105 @@
+import json
+
+# Render settings a task may change without touching the uploaded .blend. Values are
+# validated here, then applied by Renderer through Blender command line options and a
+# generated --python-expr; nothing from the request is ever interpolated unchecked.
+
+DENOISERS = ('NONE', 'OPENIMAGEDENOISE', 'OPTIX')
+OUTPUT_FORMATS = ('PNG', 'JPEG', 'OPEN_EXR', 'OPEN_EXR_MULTILAYER', 'TIFF')
+
+# (type, minimum, maximum) for numbers, allowed values for enums
+FIELDS = {
+    'resolution_percentage': (int, 1, 100),
+    'samples': (int, 1, 65536),
+    'adaptive_threshold': (float, 0.0, 1.0),
+    'denoiser': DENOISERS,
+    'output_format': OUTPUT_FORMATS,
+    'frame_step': (int, 1, 1000),
+}
+
+# Quarter of the pixels, a fraction of the samples and every other frame: roughly 5% of a
+# typical final render, enough to check motion, framing and lighting
+PREVIEW_PRESET = {
+    'resolution_percentage': 50,
+    'samples': 32,
+    'adaptive_threshold': 0.1,
+    'denoiser': 'OPENIMAGEDENOISE',
+    'output_format': 'JPEG',
+    'frame_step': 2,
+}
+
+
+def parse_value(name, raw_value):
+    spec = FIELDS[name]
+    if isinstance(spec[0], str):
+        value = raw_value.upper()
+        if value not in spec:
+            raise Exception(f'{name} must be one of {", ".join(spec)}')
+        return value
+    value_type, minimum, maximum = spec
+    try:
+        value = value_type(raw_value)
+    except ValueError:
+        raise Exception(f'{name} must be a number')
+    if not minimum <= value <= maximum:
+        raise Exception(f'{name} must be in {minimum}..{maximum}')
+    return value
+
+
+# get_argument(name) returns the raw request value or None; explicit values win over the preset
+def parse(get_argument):
+    overrides = {}
+    if get_argument('preview') in ('1', 'true'):
+        overrides.update(PREVIEW_PRESET)
+    for name in FIELDS:
+        raw_value = get_argument(name)
+        if raw_value:
+            overrides[name] = parse_value(name, raw_value)
+    return overrides
+
+
+def dumps(overrides):
+    return json.dumps(overrides) if overrides else ''
+
+
+def loads(text):
+    if not text:
+        return {}
+    return {name: parse_value(name, str(value)) for name, value in json.loads(text).items() if name in FIELDS}
+
+
+def python_expr(overrides):
+    lines = []
+    if 'resolution_percentage' in overrides:
+        lines.append(f'scene.render.resolution_percentage = {overrides["resolution_percentage"]}')
+    if 'samples' in overrides:
+        lines.append(f'scene.cycles.samples = {overrides["samples"]}')
+    if 'adaptive_threshold' in overrides:
+        lines.append('scene.cycles.use_adaptive_sampling = True')
+        lines.append(f'scene.cycles.adaptive_threshold = {overrides["adaptive_threshold"]!r}')
+    if overrides.get('denoiser') == 'NONE':
+        lines.append('scene.cycles.use_denoising = False')
+    elif 'denoiser' in overrides:
+        lines.append('scene.cycles.use_denoising = True')
+        lines.append(f'scene.cycles.denoiser = {overrides["denoiser"]!r}')
+    if not lines:
+        return ''
+    return '\n'.join(['import bpy', 'scene = bpy.context.scene'] + lines)
+
+
+# blender_worker.py applies the same overrides to a loaded scene
+def worker_settings(overrides):
+    return {'file_format': overrides.get('output_format', ''),
+            'step': overrides.get('frame_step', 1)}
+
+
+def blender_args(overrides):
+    args = []
+    if 'output_format' in overrides:
+        args += ['-F', overrides['output_format']]
+    if overrides.get('frame_step', 1) != 1:
+        args += ['-j', str(overrides['frame_step'])]
+    expr = python_expr(overrides)
+    if expr:
+        args += ['--python-expr', expr]
+    return args
@@ -0,0 +1,156 @@
+import concurrent.futures
+import logging
+import os
+import re
+import threading
+import time
+
+import metrics
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import numpy
+    import OpenEXR
+    import Imath
+except ImportError:
+    OpenEXR = None
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+PREVIEW_FILE_PATTERN = re.compile(r'^(\d+)\.(jpeg|webp)$')
+
+preview_seconds = metrics.registry.histogram('glacier_preview_seconds',
+                                             'Time to decode, downscale and encode one frame preview')
+preview_failures = metrics.registry.counter('glacier_preview_failures_total',
+                                            'Saved frames no preview could be made of')
+
+
+def preview_dir(upload_facility, task_id):
+    return f'{upload_facility}/{task_id}.previews'
+
+
+# Frame numbers of the previews made so far, the newest last
+def preview_frames(directory):
+    try:
+        file_names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(int(match.group(1)) for match in map(PREVIEW_FILE_PATTERN.match, file_names) if match)
+
+
+def find_preview(directory, frame=None):
+    frames = preview_frames(directory)
+    if frame is None and frames:
+        frame = frames[-1]
+    if frame not in frames:
+        return None
+    for image_format in CONTENT_TYPES:
+        path = f'{directory}/{frame}.{image_format}'
+        if os.path.exists(path):
+            return frame, path, CONTENT_TYPES[image_format]
+    return None
+
+
+# Multilayer files name their channels 'ViewLayer.Combined.R', the combined pass is preferred
+def exr_channel(channel_names, suffix):
+    candidates = [name for name in channel_names if name == suffix or name.endswith(f'.{suffix}')]
+    if not candidates:
+        raise Exception(f'no {suffix} channel in {sorted(channel_names)}')
+    return min(candidates, key=lambda name: ('Combined' not in name, len(name)))
+
+
+# Scene-referred floats are squeezed into display range with Reinhard's operator, then sRGB encoded
+def load_exr(path):
+    if OpenEXR is None:
+        raise Exception('OpenEXR is not installed')
+    exr_file = OpenEXR.InputFile(path)
+    header = exr_file.header()
+    window = header['dataWindow']
+    width = window.max.x - window.min.x + 1
+    height = window.max.y - window.min.y + 1
+    pixel_type = Imath.PixelType(Imath.PixelType.FLOAT)
+    rgb = numpy.stack([numpy.frombuffer(exr_file.channel(exr_channel(header['channels'], suffix), pixel_type),
+                                        dtype=numpy.float32).reshape(height, width)
+                       for suffix in 'RGB'], axis=-1)
+    exr_file.close()
+    rgb = numpy.nan_to_num(numpy.clip(rgb, 0.0, None))
+    rgb = rgb / (1.0 + rgb)
+    rgb = numpy.where(rgb <= 0.0031308, rgb * 12.92, 1.055 * numpy.power(rgb, 1 / 2.4) - 0.055)
+    return Image.fromarray((rgb * 255.0 + 0.5).astype(numpy.uint8), 'RGB')
+
+
+# Runs in a pool process; the preview is written next to its final name and moved in place
+# so that readers never see a partial file
+def make_preview(source_path, target_path, size, image_format, quality):
+    start_time = time.perf_counter()
+    if source_path.lower().endswith('.exr'):
+        image = load_exr(source_path)
+    else:
+        image = Image.open(source_path)
+        image.draft('RGB', (size, size))
+        image = image.convert('RGB')
+    image.thumbnail((size, size))
+    partial_path = f'{target_path}.part'
+    image.save(partial_path, image_format.upper(), quality=quality)
+    os.replace(partial_path, target_path)
+    return time.perf_counter() - start_time
+
+
+# Forked pool processes would outlive a crashed server, holding its listening socket and
+# the scheduler lease, so each one exits as soon as its parent is gone
+def exit_with_parent(parent_pid):
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target=watch, daemon=True).start()
+
+
+# Downscales frames on CPU processes as soon as Blender saves them, without taking a render slot.
+# The pool forks lazily on the first frame, which only ever happens in the scheduler process.
+class PreviewMaker:
+    def __init__(self, upload_facility, workers, size, image_format, quality):
+        self.upload_facility = upload_facility
+        self.workers = workers
+        self.size = size
+        self.image_format = image_format
+        self.quality = quality
+        self.pool = None
+        self.latest_frame_by_task_id = {}
+        if image_format not in CONTENT_TYPES:
+            raise Exception(f'preview format must be one of {", ".join(CONTENT_TYPES)}')
+        self.is_enabled = workers > 0 and Image is not None
+        if workers > 0 and Image is None:
+            logger.warning('Pillow is not installed, frame previews are disabled')
+
+    def submit(self, task_id, frame, source_path):
+        if not self.is_enabled or frame is None:
+            return
+        if self.pool is None:
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=exit_with_parent,
+                                                               initargs=(os.getpid(),))
+        directory = preview_dir(self.upload_facility, task_id)
+        os.makedirs(directory, exist_ok=True)
+        future = self.pool.submit(make_preview, source_path, f'{directory}/{frame}.{self.image_format}',
+                                  self.size, self.image_format, self.quality)
+        future.add_done_callback(lambda done: self.on_done(done, task_id, frame))
+
+    # The preview made last, reported in the task list so that clients fetch it once it exists
+    def latest_frame(self, task_id):
+        return self.latest_frame_by_task_id.get(task_id)
+
+    def forget(self, task_id):
+        self.latest_frame_by_task_id.pop(task_id, None)
+
+    def on_done(self, future, task_id, frame):
+        try:
+            preview_seconds.observe(future.result())
+            self.latest_frame_by_task_id[task_id] = frame
+        except Exception as e:
+            preview_failures.inc()
+            logger.warning(f'preview of task {task_id} frame {frame} failed: {e}')
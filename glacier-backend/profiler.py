@@ -0,0 +1,36 @@
+import collections
+import sys
+import threading
+import time
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{frame.f_lineno})'
+
+
+def collapsed_stack(frame):
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+# Samples every thread except the sampler itself and returns collapsed stacks
+# ("root;child;leaf count" per line), ready for flamegraph.pl or speedscope
+def sample_collapsed_stacks(seconds, interval=0.005):
+    own_thread_id = threading.get_ident()
+    thread_names = {}
+    counts = collections.Counter()
+    end_time = time.monotonic() + seconds
+    while time.monotonic() < end_time:
+        for thread in threading.enumerate():
+            thread_names[thread.ident] = thread.name
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread_id:
+                continue
+            thread_name = thread_names.get(thread_id, str(thread_id)).replace(' ', '_')
+            counts[f'{thread_name};{collapsed_stack(frame)}'] += 1
+        time.sleep(interval)
+    return ''.join(f'{stack} {count}\n' for stack, count in counts.most_common())
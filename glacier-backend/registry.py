@@ -0,0 +1,103 @@
+import enum
+import threading
+
+
+class TaskState(str, enum.Enum):
+    CREATED = 'CREATED'
+    SCHEDULED = 'SCHEDULED'
+    RUNNING = 'RUNNING'
+    COMPLETED = 'COMPLETED'
+    COMPRESSING = 'COMPRESSING'
+    PACKED = 'PACKED'
+    DONE = 'DONE'
+    KILLED = 'KILLED'
+    FAILED_BLENDER = 'FAILED(BLENDER)'
+    FAILED_TAR = 'FAILED(TAR)'
+
+
+class TaskRecord:
+    __slots__ = ('task_id', 'session_id', 'username', 'state', 'renderer')
+
+    def __init__(self, task_id, session_id, username, state, renderer):
+        self.task_id = task_id
+        self.session_id = session_id
+        self.username = username
+        self.state = state
+        self.renderer = renderer
+
+
+# Tasks live in the scheduler process, indexed by session, user and state so that lookups
+# cost the size of their result. All reads and writes go through one lock and return copies.
+class TaskRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records_by_id = {}
+        self.ids_by_state = {state: set() for state in TaskState}
+        self.ids_by_session = {}
+        self.ids_by_user = {}
+
+    def __len__(self):
+        return len(self.records_by_id)
+
+    def __contains__(self, task_id):
+        return task_id in self.records_by_id
+
+    def add(self, record):
+        with self.lock:
+            self.records_by_id[record.task_id] = record
+            self.ids_by_state[record.state].add(record.task_id)
+            self.ids_by_session.setdefault(record.session_id, set()).add(record.task_id)
+            self.ids_by_user.setdefault(record.username, set()).add(record.task_id)
+
+    def remove(self, task_id):
+        with self.lock:
+            record = self.records_by_id.pop(task_id, None)
+            if record is None:
+                return None
+            self.ids_by_state[record.state].discard(task_id)
+            self.discard(self.ids_by_session, record.session_id, task_id)
+            self.discard(self.ids_by_user, record.username, task_id)
+        return record
+
+    @staticmethod
+    def discard(ids_by_key, key, task_id):
+        task_ids = ids_by_key[key]
+        task_ids.discard(task_id)
+        if not task_ids:
+            del ids_by_key[key]
+
+    def set_state(self, record, state):
+        with self.lock:
+            if self.records_by_id.get(record.task_id) is record:
+                self.ids_by_state[record.state].discard(record.task_id)
+                self.ids_by_state[state].add(record.task_id)
+            record.state = state
+
+    def get(self, task_id):
+        return self.records_by_id.get(task_id)
+
+    def values(self):
+        with self.lock:
+            return list(self.records_by_id.values())
+
+    def select(self, task_ids):
+        return [self.records_by_id[task_id] for task_id in task_ids]
+
+    def by_state(self, state):
+        with self.lock:
+            return self.select(self.ids_by_state[state])
+
+    def by_session(self, session_id):
+        with self.lock:
+            return self.select(self.ids_by_session.get(session_id, ()))
+
+    def by_user(self, username):
+        with self.lock:
+            return self.select(self.ids_by_user.get(username, ()))
+
+    def count_by_state(self, state):
+        return len(self.ids_by_state[state])
+
+    def counts_by_state(self):
+        with self.lock:
+            return {state.value: len(task_ids) for state, task_ids in self.ids_by_state.items()}
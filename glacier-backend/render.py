@@ -1,123 +1,600 @@
+import datetime
+import json
+import re
 import subprocess
 import threading
 import time
 import logging
 import os
 import shutil
+import signal
+
+import assets
+import blendfile
+import devices
+import metrics
+import overrides
+import previews
+import registry
+import scheduling
+import startup
+import tasklog
+import tiles
+import workers
 from config import RenderConfig
+from registry import TaskState
 
 logger = logging.getLogger(__name__)
 
+render_task_seconds = metrics.registry.histogram('glacier_render_task_seconds',
+                                                 'Blender wall time per task, summed over its chunks')
+render_job_seconds = metrics.registry.histogram('glacier_render_job_seconds',
+                                                'Blender wall time per frame chunk',
+                                                ('device',))
+render_frame_seconds = metrics.registry.histogram('glacier_render_frame_seconds',
+                                                  'Blender wall time per saved frame')
+stitch_frame_seconds = metrics.registry.histogram('glacier_stitch_frame_seconds',
+                                                  'Time to stitch the tiles of a still frame')
+compress_task_seconds = metrics.registry.histogram('glacier_compress_task_seconds',
+                                                   'Output packing time per task')
+compress_frame_seconds = metrics.registry.histogram('glacier_compress_frame_seconds',
+                                                    'Output packing time divided by packed frame count')
+preempted_jobs = metrics.registry.counter('glacier_render_preemptions_total',
+                                          'Frame chunks stopped to give their slot to higher priority work')
+stalled_jobs = metrics.registry.counter('glacier_render_stalls_total',
+                                        'Frame chunks stopped by the watchdog after printing nothing for too long')
+retried_frames = metrics.registry.counter('glacier_render_frame_retries_total',
+                                          'Frames rendered again after Blender failed or stalled on them')
+given_up_frames = metrics.registry.counter('glacier_render_failed_frames_total',
+                                           'Frames given up on after failing every attempt')
+
+
+FINAL_RENDER_STATES = (TaskState.COMPLETED, TaskState.KILLED, TaskState.FAILED_BLENDER, TaskState.FAILED_TAR)
+FAILURE_TAIL_LINES = 20
+
+FRAME_PATTERN = re.compile(r'^Fra:(\d+) ')
+PEAK_MEMORY_PATTERN = re.compile(r'Peak[: ]\s*([\d.]+)([MG])')
+SAMPLE_PATTERN = re.compile(r'Sample \d+/(\d+)')
+SAVED_FRAME_PATTERN = re.compile(r'(\d+)\.\w+\'?$')
+SAVED_PATH_PATTERN = re.compile(r"^Saved: '(.+)'")
+
 
 class RenderBus(RenderConfig):
     def __init__(self):
         super().__init__()
-        self.tasks_by_id = {}
+        self.tasks = registry.TaskRegistry()
+        self.slot_scheduler = scheduling.Scheduler([], scheduling.policies[self.scheduling_policy]())
+        self.wakeup = threading.Event()
+        self.tick_callback = None
+        self.chunk_callback = None
+        self.worker_pool = None
+        self.is_running = False
+        self.is_stopping = False
+        self.lease = None
+        self.previews = previews.PreviewMaker(self.upload_facility, self.preview_workers, self.preview_size,
+                                              self.preview_format, self.preview_quality)
+        self.frame_records = []
+        self.frame_records_lock = threading.Lock()
 
     def scheduler(self):
         is_last_cycle_full = False
-        logger.info('task scheduler start')
+        with startup.clock.phase('device discovery'):
+            self.slot_scheduler.slots = devices.make_slots(devices.discover(self))
+        if self.render_backend == 'pool':
+            with startup.clock.phase('worker warm-up'):
+                self.worker_pool = workers.WorkerPool(self.blender_bin, self.slot_scheduler.slots,
+                                                      self.kill_grace_seconds)
+                self.worker_pool.warm_up()
+        self.is_running = True
+        startup.clock.report('scheduler running')
+        logger.info(f'task scheduler start, {len(self.slot_scheduler.slots)} slot(s), '
+                    f'policy {self.scheduling_policy}, chunk size {self.chunk_size}')
         while True:
-            if self.tasks_by_id:
+            if self.lease is not None and not self.lease.is_held():
+                logger.critical('scheduler lease lost, stopping every render of this process')
+                self.stop_renders()
+                return
+            if self.tick_callback is not None:
+                try:
+                    self.tick_callback()
+                except Exception as e:
+                    logger.error(f'scheduler tick callback failed: {e}')
+            if self.tasks:
                 if not is_last_cycle_full:
                     logger.info('full scheduler cycle')
-                for task in self.tasks_by_id.values():
-                    if task.state == 'SCHEDULED':
-                        is_last_cycle_full = True
-                        task.render()
-                    elif task.state == 'COMPLETED':
-                        is_last_cycle_full = True
-                        task.pack_output()
-                time.sleep(0.5)
+                is_last_cycle_full = True
+                for job in self.slot_scheduler.dispatch():
+                    task = self.live_task(job.task_id)
+                    if task is None or task.killed:
+                        self.slot_scheduler.release(job)
+                        continue
+                    task.render(job)
+                for job in self.slot_scheduler.preemptions():
+                    task = self.live_task(job.task_id)
+                    if task is not None:
+                        task.preempt(job)
+                self.check_stalls()
+                for record in self.tasks.by_state(TaskState.COMPLETED):
+                    record.renderer.pack_output()
             else:
                 if is_last_cycle_full:
                     logger.info('empty scheduler cycle')
                 is_last_cycle_full = False
-                time.sleep(0.5)
+            self.wakeup.wait(0.5)
+            self.wakeup.clear()
+
+    # Task states are left as they are in the database for the next scheduler to adopt
+    def stop_renders(self):
+        self.is_stopping = True
+        if self.worker_pool is not None:
+            self.worker_pool.stop()
+        for record in self.tasks.values():
+            with record.renderer.lock:
+                processes = list(record.renderer.processes_by_job.values())
+            for process in processes:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def submit(self, jobs):
+        self.slot_scheduler.submit(jobs)
+        self.wakeup.set()
+
+    def release(self, job):
+        self.slot_scheduler.release(job)
+        self.wakeup.set()
+
+    # A chunk that printed nothing for several of its expected frame times is taken to hang
+    def stall_seconds_for(self, job):
+        if job.expected_seconds is None:
+            return self.stall_seconds
+        frame_seconds = job.expected_seconds / job.frame_count / (job.slot.speed or 1.0)
+        return max(self.stall_min_seconds, self.stall_factor * frame_seconds)
+
+    def check_stalls(self):
+        now = time.monotonic()
+        for slot in self.slot_scheduler.slots:
+            job = slot.job
+            if job is None or job.stalled or job.preempted:
+                continue
+            if now - (job.last_output_at or job.started_at) > self.stall_seconds_for(job):
+                task = self.live_task(job.task_id)
+                if task is not None:
+                    task.stall(job)
+
+    def live_task(self, task_id):
+        record = self.tasks.get(task_id)
+        return record.renderer if record is not None else None
 
     def delete_task(self, task_id):
-        task = self.tasks_by_id.pop(task_id)
-        task.cleanup()
+        record = self.tasks.remove(task_id)
+        if record is not None:
+            record.renderer.cleanup()
         return True
 
+    def count_by_state(self, state):
+        return self.tasks.count_by_state(state)
+
+    def record_chunk(self, task, job, started_at, render_seconds, return_code):
+        if self.chunk_callback is None:
+            return
+        try:
+            self.chunk_callback(task.id, job, started_at, render_seconds, return_code)
+        except Exception as e:
+            logger.error(f'recording chunk of task {task.id} failed: {e}')
+
+    # Written to frame_table in batches by the scheduler tick
+    def record_frame(self, frame_record):
+        with self.frame_records_lock:
+            self.frame_records.append(frame_record)
+
+    def take_frame_records(self):
+        with self.frame_records_lock:
+            frame_records = self.frame_records
+            self.frame_records = []
+        return frame_records
+
+    # One JSON line per completed task, replayable with benchmark/simulate.py
+    def record_trace(self, task):
+        if not self.scheduler_trace_path:
+            return
+        frame_count = (task.end_frame - task.start_frame) // task.frame_step + 1
+        entry = {'submitted_at': task.submitted_at,
+                 'user': task.username,
+                 'frames': frame_count,
+                 'frame_cost': task.render_seconds / frame_count}
+        with open(self.scheduler_trace_path, 'a') as trace_file:
+            trace_file.write(json.dumps(entry) + '\n')
+
 
 render_bus = RenderBus()
 
+metrics.registry.gauge('glacier_render_queue_depth', 'Frame chunks waiting for a render slot',
+                       callback=render_bus.slot_scheduler.queue_depth)
+metrics.registry.gauge('glacier_render_slots_in_use', 'Render slots currently running Blender',
+                       callback=render_bus.slot_scheduler.slots_in_use)
+metrics.registry.gauge('glacier_render_slots', 'Render devices registered as slots',
+                       callback=lambda: len(render_bus.slot_scheduler.slots))
+metrics.registry.gauge('glacier_render_tasks', 'Tasks known to the render bus',
+                       callback=lambda: len(render_bus.tasks))
+metrics.registry.gauge('glacier_render_tasks_by_state', 'Tasks known to the render bus per state',
+                       ('state',), callback=render_bus.tasks.counts_by_state)
 
-class Renderer(RenderConfig):
-    def __init__(self, task_id, blend_file_path, start_frame, end_frame, update_callback):
-        super().__init__()
+
+# Settings come from render_bus, so creating one does not parse the environment again
+class Renderer:
+    def __init__(self, task_id, blend_file_path, start_frame, end_frame, update_callback, username='',
+                 render_overrides=None, blend_sha256='', estimated_cost=None, predicted_seconds=None, deadline=None,
+                 priority=0, finished_frames=(), session_id='', is_rendered=False):
         self.id = task_id
+        self.username = username
         self.update_callback = update_callback
-        self.output_dir = f'{self.upload_facility}/{task_id}/'
+        self.output_dir = f'{render_bus.upload_facility}/{task_id}/'
         self.killed = 0
-        self.render_engine = 'CYCLES'
-        self.cycles_device = 'CUDA'
-        self.blender_args = ['-E', self.render_engine,
-                             '-o', self.output_dir, '-noaudio',
-                             '-s', start_frame, '-e', end_frame,
-                             '-a', '--', '--cycles-device', self.cycles_device]
-        self.thread = None
+        self.failed = False
+        self.render_engine = blendfile.RENDER_ENGINE
+        self.start_frame = int(start_frame)
+        self.end_frame = int(end_frame)
+        self.render_overrides = render_overrides or {}
+        self.frame_step = self.render_overrides.get('frame_step', 1)
+        self.frame_count = (self.end_frame - self.start_frame) // self.frame_step + 1
+        # A still frame is split into bands, one per slot unless STILL_TILES says otherwise
+        self.tile_count = 1
+        if self.start_frame == self.end_frame and \
+                self.render_overrides.get('output_format', 'PNG') in tiles.STITCHABLE_FORMATS:
+            self.tile_count = max(1, render_bus.still_tiles or len(render_bus.slot_scheduler.slots))
+        self.blend_sha256 = blend_sha256
+        self.frame_cost = estimated_cost / self.frame_count if estimated_cost else None
+        self.lock = threading.Lock()
+        self.running_jobs = []
+        self.processes_by_job = {}
+        self.jobs_left = 0
         self.blend_file_path = blend_file_path
+        self.remap_expr = assets.remap_expr(render_bus.upload_facility, task_id)
         self.last_line = ''
-        self.state = 'SCHEDULED'
-        self.update_callback(self.id, self.state)
+        self.log = tasklog.TaskLog(render_bus.upload_facility, task_id, render_bus.task_log_ring_bytes,
+                                   render_bus.task_log_segment_bytes, render_bus.task_log_segments)
+        self.frames_saved = len(set(finished_frames))
+        self.retries = 0
+        self.failures_by_frame = {}
+        self.failed_frames = []
+        self.render_seconds = 0.0
+        self.submitted_at = time.time()
+        self.record = registry.TaskRecord(task_id, session_id, username, TaskState.SCHEDULED, self)
+        self.update_callback(self.id, TaskState.SCHEDULED.value)
         self.tar_path = ''
-        self.render = self.render_gpu_nvidia_in_thread
+        self.render = self.render_job_in_thread
+
+        os.makedirs(f'{render_bus.upload_facility}/{self.id}', exist_ok=True)
+        render_bus.tasks.add(self.record)
+        finished_frames = set(finished_frames)
+        jobs = []
+        chunks = [] if is_rendered else scheduling.split_frames(self.start_frame, self.end_frame,
+                                                                 render_bus.chunk_size, self.frame_step)
+        for chunk_start, chunk_end in chunks:
+            # An adopted task resumes each chunk from its first frame not yet saved
+            while chunk_start <= chunk_end and chunk_start in finished_frames:
+                chunk_start += self.frame_step
+            if chunk_start <= chunk_end:
+                jobs.append(scheduling.Job(self.id, self.username, chunk_start, chunk_end, self.frame_step, priority))
+        if jobs and self.tile_count > 1:
+            jobs = [scheduling.Job(self.id, self.username, self.start_frame, self.end_frame, self.frame_step, priority)
+                    for _ in range(self.tile_count)]
+            for index, job in enumerate(jobs):
+                job.tile = (index, self.tile_count)
+                os.makedirs(tiles.tile_dir(render_bus.upload_facility, self.id, index), exist_ok=True)
+        for job in jobs:
+            if predicted_seconds is not None:
+                job.expected_seconds = predicted_seconds * job.frame_count / self.frame_count
+                if job.tile:
+                    job.expected_seconds /= self.tile_count
+            job.deadline = deadline
+        self.jobs_left = len(jobs)
+        if jobs:
+            render_bus.submit(jobs)
+        else:
+            self.set_state(TaskState.COMPLETED)
+
+    @property
+    def state(self):
+        return self.record.state
 
-        os.mkdir(f'{self.upload_facility}/{self.id}')
-        render_bus.tasks_by_id.update({task_id: self})
+    def job_output_dir(self, job):
+        if job.tile is None:
+            return self.output_dir
+        return tiles.tile_dir(render_bus.upload_facility, self.id, job.tile[0])
+
+    def blender_args(self, job):
+        tile_args = ['--python-expr', tiles.python_expr(*job.tile)] if job.tile else []
+        remap_args = ['--python-expr', self.remap_expr] if self.remap_expr else []
+        return ['-E', self.render_engine,
+                '-o', self.job_output_dir(job), '-noaudio'] + remap_args + \
+            overrides.blender_args(self.render_overrides) + tile_args + \
+            ['-s', str(job.start_frame), '-e', str(job.end_frame), '-a'] + job.slot.device.cycles_args()
+
+    def set_state(self, new_state, **kwvalues):
+        if render_bus.is_stopping:
+            return
+        render_bus.tasks.set_state(self.record, new_state)
+        self.update_callback(self.id, new_state.value, **kwvalues)
+        if new_state in FINAL_RENDER_STATES:
+            self.log.close()
 
     def kill(self):
         self.killed = 1
+        render_bus.slot_scheduler.cancel(self.id)
+        with self.lock:
+            running_jobs = list(self.running_jobs)
+            if not running_jobs and self.state in (TaskState.SCHEDULED, TaskState.RUNNING):
+                self.set_state(TaskState.KILLED)
+        for job in running_jobs:
+            self.interrupt(job)
+
+    # The slot is released once Blender exits and the rest of the chunk is queued again
+    def preempt(self, job):
+        logger.info(f'task {self.id} frames {job.start_frame}-{job.end_frame} on {job.slot.name} preempted')
+        preempted_jobs.inc()
+        self.interrupt(job)
+
+    def stall(self, job):
+        silent_seconds = time.monotonic() - (job.last_output_at or job.started_at)
+        logger.warning(f'task {self.id} frames {job.start_frame}-{job.end_frame} on {job.slot.name} printed nothing '
+                       f'for {silent_seconds:.0f}s, stopping it')
+        stalled_jobs.inc()
+        job.stalled = True
+        self.interrupt(job)
+
+    # Stopping may wait out the grace period, so it never runs on the caller's thread
+    def interrupt(self, job):
+        if render_bus.worker_pool is not None:
+            thread = threading.Thread(target=render_bus.worker_pool.interrupt, args=(job,))
+        else:
+            with self.lock:
+                process = self.processes_by_job.get(job)
+            if process is None:
+                return
+            thread = threading.Thread(target=workers.stop_process_group, args=(process, render_bus.kill_grace_seconds))
+        thread.start()
+
+    def worker_job_spec(self, job):
+        setup = [expr for expr in (self.remap_expr, job.slot.device.pin_expr(),
+                                   overrides.python_expr(self.render_overrides)) if expr]
+        if job.tile:
+            setup.append(tiles.python_expr(*job.tile))
+        return dict(overrides.worker_settings(self.render_overrides),
+                    blend=self.blend_file_path,
+                    blend_sha256=self.blend_sha256,
+                    setup=setup,
+                    engine=self.render_engine,
+                    output=self.job_output_dir(job),
+                    start=job.start_frame,
+                    end=job.end_frame)
 
-    def render_gpu_nvidia(self):
+    def run_blender_process(self, job, on_line):
         blender_process = subprocess.Popen(
-            [self.blender_bin, '-b', self.blend_file_path] + self.blender_args,
+            [render_bus.blender_bin, '-b', self.blend_file_path] + job.slot.device.blender_args() + self.blender_args(job),
             stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
-        self.state = 'RUNNING'
-        self.update_callback(self.id, self.state)
-        while True:
+            stderr=subprocess.STDOUT,
+            start_new_session=True)
+        with self.lock:
+            self.processes_by_job[job] = blender_process
+        if self.killed or job.preempted or job.stalled:
+            self.interrupt(job)
+        for line in blender_process.stdout:
+            on_line(line.decode(errors='replace').strip())
+        return_code = blender_process.wait()
+        with self.lock:
+            del self.processes_by_job[job]
+        return return_code
+
+    def render_job(self, job):
+        device = job.slot.device
+        started_at = time.time()
+        start_time = time.perf_counter()
+        last_frame_time = start_time
+        job_frames_saved = 0
+        frame_stats = {'frame': None, 'samples': None, 'peak_memory_mb': 0.0}
+
+        def on_line(line):
+            nonlocal last_frame_time, job_frames_saved
+            job.last_output_at = time.monotonic()
+            self.last_line = line
+            self.log.write_line(f'[{job.slot.name}] {line}')
+            self.parse_frame_stats(line, frame_stats)
+            if line.startswith('Saved:') and job.tile:
+                job_frames_saved += 1
+            elif line.startswith('Saved:'):
+                frame_time = time.perf_counter()
+                render_frame_seconds.observe(frame_time - last_frame_time)
+                frame = self.record_frame(job, line, frame_stats, frame_time - last_frame_time)
+                saved_path_match = SAVED_PATH_PATTERN.match(line)
+                if saved_path_match:
+                    render_bus.previews.submit(self.id, frame, saved_path_match.group(1))
+                last_frame_time = frame_time
+                job_frames_saved += 1
+                with self.lock:
+                    self.frames_saved += 1
+
+        with self.lock:
+            if self.state == TaskState.SCHEDULED:
+                self.set_state(TaskState.RUNNING)
+        if render_bus.worker_pool is not None:
+            return_code = render_bus.worker_pool.render(job, self.worker_job_spec(job), on_line,
+                                                        lambda: self.killed or job.preempted or job.stalled)
+        else:
+            return_code = self.run_blender_process(job, on_line)
+        job_seconds = time.perf_counter() - start_time
+        render_job_seconds.observe(job_seconds, device=job.slot.name)
+        logger.info(f'task {self.id} frames {job.start_frame}-{job.end_frame} on {job.slot.name} '
+                    f'({device.name}) took {job_seconds:.1f}s, exit code {return_code}')
+        render_bus.record_chunk(self, job, started_at, job_seconds, return_code)
+        render_bus.release(job)
+        resumed_job = None
+        is_stitching = False
+        sibling_jobs = []
+        with self.lock:
+            self.running_jobs.remove(job)
+            self.render_seconds += job_seconds
+            if job.preempted and return_code != 0 and not self.killed:
+                return_code = 0
+                resumed_job = self.resume_job(job, job_frames_saved)
+            elif return_code != 0 and not self.killed:
+                resumed_job, return_code = self.retry_job(job, job_frames_saved, return_code)
+            if resumed_job is None:
+                self.jobs_left -= 1
             if self.killed:
-                blender_process.kill()
-                self.state = 'KILLED'
-                break
-            return_code = blender_process.poll()
-            line = blender_process.stdout.readline()
-            if line:
-                self.last_line = line.decode().strip()
-            if return_code is not None:
-                if return_code == 0:
-                    self.state = 'COMPLETED'
-                else:
-                    self.state = 'FAILED(BLENDER)'
-                break
-        self.update_callback(self.id, self.state)
-
-    def render_gpu_nvidia_in_thread(self):
-        self.thread = threading.Thread(target=self.render_gpu_nvidia)
-        self.thread.start()
+                # Chunks stopped because a sibling failed leave the task FAILED(BLENDER)
+                if not self.running_jobs and not self.failed:
+                    self.set_state(TaskState.KILLED)
+            elif return_code != 0:
+                self.killed = 1
+                self.failed = True
+                sibling_jobs = list(self.running_jobs)
+                render_bus.slot_scheduler.cancel(self.id)
+                tail = '\n'.join(self.log.tail(FAILURE_TAIL_LINES))
+                logger.error(f'task {self.id} failed on {job.slot.name}, last output:\n{tail}')
+                self.set_state(TaskState.FAILED_BLENDER)
+            elif not self.jobs_left and self.tile_count > 1:
+                is_stitching = True
+            elif not self.jobs_left:
+                render_task_seconds.observe(self.render_seconds)
+                render_bus.record_trace(self)
+                self.set_state(TaskState.COMPLETED)
+        for sibling_job in sibling_jobs:
+            self.interrupt(sibling_job)
+        if resumed_job is not None:
+            render_bus.submit([resumed_job])
+        if is_stitching:
+            self.stitch_tiles(job, frame_stats)
+
+    # The band finishing last stitches the frame on its own thread, away from the scheduler loop
+    def stitch_tiles(self, job, frame_stats):
+        start_time = time.perf_counter()
+        try:
+            stitched_paths = tiles.stitch(render_bus.upload_facility, self.id, self.tile_count, self.output_dir)
+        except Exception as e:
+            logger.error(f'task {self.id} stitching {self.tile_count} tiles failed: {e}')
+            with self.lock:
+                if self.state == TaskState.RUNNING:
+                    self.set_state(TaskState.FAILED_TAR)
+            return
+        stitch_frame_seconds.observe(time.perf_counter() - start_time)
+        for path in stitched_paths:
+            self.record_frame(job, f"Saved: '{path}'", frame_stats, self.render_seconds)
+            render_bus.previews.submit(self.id, self.start_frame, path)
+        with self.lock:
+            self.frames_saved += len(stitched_paths)
+            if self.state == TaskState.RUNNING:
+                render_task_seconds.observe(self.render_seconds)
+                render_bus.record_trace(self)
+                self.set_state(TaskState.COMPLETED)
+
+    # Frames saved before a crash or stall are kept. The frame being rendered is retried on another
+    # slot until it has failed MAX_FRAME_ATTEMPTS times, then marked failed and skipped. Returns
+    # the job to queue and the exit code left, non-zero once the task's retries are used up.
+    def retry_job(self, job, frames_saved, return_code):
+        frame = job.start_frame + frames_saved * job.frame_step
+        cause = 'stalled' if job.stalled else f'exit code {return_code}'
+        if frame > job.end_frame:
+            logger.warning(f'task {self.id} frames {job.start_frame}-{job.end_frame} all saved, ignoring {cause}')
+            return None, 0
+        if self.retries >= render_bus.max_task_retries:
+            logger.error(f'task {self.id} used up its {render_bus.max_task_retries} retries')
+            return None, return_code
+        failures = self.failures_by_frame.get((frame, job.tile), 0) + 1
+        self.failures_by_frame[(frame, job.tile)] = failures
+        if failures < render_bus.max_frame_attempts:
+            logger.warning(f'task {self.id} frame {frame} failed on {job.slot.name} ({cause}), retrying')
+            self.retries += 1
+            retried_frames.inc()
+            resumed_job = self.resume_job(job, frames_saved)
+        elif job.tile:
+            logger.error(f'task {self.id} tile {job.tile[0]} failed {failures} times, the frame cannot be stitched')
+            return None, return_code
+        else:
+            logger.error(f'task {self.id} frame {frame} failed {failures} times ({cause}), skipping it')
+            given_up_frames.inc()
+            self.failed_frames.append(frame)
+            resumed_job = self.resume_job(job, frames_saved + 1)
+        if resumed_job is not None:
+            resumed_job.avoided_slots = job.avoided_slots + (job.slot.name,)
+        return resumed_job, 0
+
+    # Blender saves frames in order, so the rest of a preempted chunk starts after the last saved one
+    def resume_job(self, job, frames_saved):
+        resume_frame = job.start_frame + frames_saved * job.frame_step
+        if resume_frame > job.end_frame:
+            return None
+        resumed_job = scheduling.Job(self.id, self.username, resume_frame, job.end_frame, job.frame_step, job.priority)
+        if job.expected_seconds is not None:
+            resumed_job.expected_seconds = job.expected_seconds * resumed_job.frame_count / job.frame_count
+        resumed_job.deadline = job.deadline
+        resumed_job.queued_at = job.queued_at
+        resumed_job.tile = job.tile
+        return resumed_job
+
+    @staticmethod
+    def parse_frame_stats(line, frame_stats):
+        frame_match = FRAME_PATTERN.match(line)
+        if frame_match:
+            frame_stats['frame'] = int(frame_match.group(1))
+        for value, unit in PEAK_MEMORY_PATTERN.findall(line):
+            frame_stats['peak_memory_mb'] = max(frame_stats['peak_memory_mb'],
+                                                float(value) * (1024 if unit == 'G' else 1))
+        sample_match = SAMPLE_PATTERN.search(line)
+        if sample_match:
+            frame_stats['samples'] = int(sample_match.group(1))
+
+    def record_frame(self, job, saved_line, frame_stats, render_seconds):
+        frame = frame_stats['frame']
+        saved_frame_match = SAVED_FRAME_PATTERN.search(saved_line)
+        if saved_frame_match:
+            frame = int(saved_frame_match.group(1))
+        render_bus.record_frame({'task_id': self.id,
+                                 'username': self.username,
+                                 'blend_sha256': self.blend_sha256,
+                                 'frame': frame,
+                                 'slot': job.slot.name,
+                                 'speed': job.slot.speed,
+                                 'render_seconds': render_seconds,
+                                 'samples': frame_stats['samples'],
+                                 'peak_memory_mb': frame_stats['peak_memory_mb'] or None,
+                                 'cost': self.frame_cost,
+                                 'finished_at': datetime.datetime.now(datetime.timezone.utc)})
+        frame_stats.update(frame=None, samples=None, peak_memory_mb=0.0)
+        return frame
+
+    def render_job_in_thread(self, job):
+        with self.lock:
+            self.running_jobs.append(job)
+        thread = threading.Thread(target=self.render_job, args=(job,))
+        thread.start()
 
     def pack_output(self):
-        self.state = 'COMPRESSING'
-        self.update_callback(self.id, self.state)
-        self.tar_path = f'{self.upload_facility}/{self.id}.tar.gz'
+        self.set_state(TaskState.COMPRESSING)
+        self.tar_path = f'{render_bus.upload_facility}/{self.id}.tar.gz'
+        start_time = time.perf_counter()
         result = subprocess.run(['tar', '-zcf', self.tar_path, '--directory', self.output_dir, '.'],
                                 stdout=subprocess.DEVNULL,
                                 stderr=subprocess.DEVNULL)
+        pack_time = time.perf_counter() - start_time
+        compress_task_seconds.observe(pack_time)
+        if self.frames_saved:
+            compress_frame_seconds.observe(pack_time / self.frames_saved)
         if result.returncode == 0:
-            self.state = 'PACKED'
+            self.set_state(TaskState.PACKED, tar_path=self.tar_path)
         else:
-            self.state = 'FAILED(TAR)'
-        self.update_callback(self.id, self.state)
-
-    def done(self):
-        self.state = 'DONE'
-        self.update_callback(self.id, self.state)
+            self.set_state(TaskState.FAILED_TAR)
 
     def cleanup(self):
+        self.log.close()
+        tasklog.remove_segments(render_bus.upload_facility, self.id)
         os.remove(self.blend_file_path)
+        shutil.rmtree(assets.task_root(render_bus.upload_facility, self.id), ignore_errors=True)
         shutil.rmtree(self.output_dir, ignore_errors=True)
+        shutil.rmtree(previews.preview_dir(render_bus.upload_facility, self.id), ignore_errors=True)
+        render_bus.previews.forget(self.id)
+        shutil.rmtree(tiles.tiles_dir(render_bus.upload_facility, self.id), ignore_errors=True)
         if self.tar_path:
             os.remove(self.tar_path)
@@ -0,0 +1,207 @@
+import threading
+import time
+
+# Slot assignment is kept free of threads, subprocesses and wall time so the same code
+# drives the live RenderBus and the offline simulator (benchmark/simulate.py)
+
+
+def split_frames(start_frame, end_frame, chunk_size, frame_step=1):
+    last_frame = start_frame + (end_frame - start_frame) // frame_step * frame_step
+    if chunk_size <= 0:
+        return [(start_frame, last_frame)]
+    return [(chunk_start, min(chunk_start + (chunk_size - 1) * frame_step, last_frame))
+            for chunk_start in range(start_frame, last_frame + 1, chunk_size * frame_step)]
+
+
+class Slot:
+    def __init__(self, name, speed=1.0, device=None):
+        self.name = name
+        self.speed = speed
+        self.device = device
+        self.job = None
+        self.busy_seconds = 0.0
+
+
+class Job:
+    __slots__ = ('task_id', 'username', 'start_frame', 'end_frame', 'frame_step', 'queued_at', 'started_at', 'slot',
+                 'expected_seconds', 'deadline', 'priority', 'preempted', 'tile', 'last_output_at', 'stalled',
+                 'avoided_slots')
+
+    def __init__(self, task_id, username, start_frame, end_frame, frame_step=1, priority=0):
+        self.task_id = task_id
+        self.username = username
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        self.frame_step = frame_step
+        self.queued_at = None
+        self.started_at = None
+        self.slot = None
+        self.expected_seconds = None
+        self.deadline = None
+        self.priority = priority
+        self.preempted = False
+        self.tile = None
+        self.last_output_at = None
+        self.stalled = False
+        self.avoided_slots = ()
+
+    @property
+    def frame_count(self):
+        return (self.end_frame - self.start_frame) // self.frame_step + 1
+
+
+class FifoPolicy:
+    name = 'fifo'
+
+    def pick(self, queue, scheduler):
+        return queue[0]
+
+
+# The user holding the fewest slots goes first, ties broken by slot time consumed so far
+class FairSharePolicy:
+    name = 'fair'
+
+    def pick(self, queue, scheduler):
+        return min(queue, key=lambda job: (scheduler.running_by_user.get(job.username, 0),
+                                           scheduler.usage_by_user.get(job.username, 0.0),
+                                           job.queued_at))
+
+
+# Cheapest predicted chunk first; chunks without a prediction wait behind predicted ones
+class ShortestExpectedJobPolicy:
+    name = 'sjf'
+
+    def pick(self, queue, scheduler):
+        return min(queue, key=lambda job: (job.expected_seconds is None, job.expected_seconds or 0.0, job.queued_at))
+
+
+class EarliestDeadlinePolicy:
+    name = 'edf'
+
+    def pick(self, queue, scheduler):
+        return min(queue, key=lambda job: (job.deadline is None, job.deadline or 0.0, job.queued_at))
+
+
+policies = {policy.name: policy for policy in (FifoPolicy, FairSharePolicy, ShortestExpectedJobPolicy,
+                                               EarliestDeadlinePolicy)}
+
+
+class Scheduler:
+    def __init__(self, slots, policy, clock=time.monotonic):
+        self.slots = slots
+        self.policy = policy
+        self.clock = clock
+        self.queue = []
+        self.lock = threading.Lock()
+        self.running_by_user = {}
+        self.usage_by_user = {}
+
+    def submit(self, jobs):
+        with self.lock:
+            now = self.clock()
+            for job in jobs:
+                if job.queued_at is None:
+                    job.queued_at = now
+            self.queue.extend(jobs)
+            # A resumed chunk keeps its place in the queue
+            if any(job.queued_at < now for job in jobs):
+                self.queue.sort(key=lambda job: job.queued_at)
+
+    def cancel(self, task_id):
+        with self.lock:
+            cancelled = [job for job in self.queue if job.task_id == task_id]
+            self.queue = [job for job in self.queue if job.task_id != task_id]
+        return cancelled
+
+    def dispatch(self):
+        assigned = []
+        with self.lock:
+            for slot in sorted(self.slots, key=lambda slot: -slot.speed):
+                if not self.queue:
+                    break
+                if slot.job is not None:
+                    continue
+                # A retried chunk stays off the slots it failed on while it has any other
+                eligible = [job for job in self.queue
+                            if slot.name not in job.avoided_slots or len(job.avoided_slots) >= len(self.slots)]
+                if not eligible:
+                    continue
+                job = self.pick(eligible)
+                self.queue.remove(job)
+                job.slot = slot
+                job.started_at = self.clock()
+                slot.job = job
+                self.running_by_user[job.username] = self.running_by_user.get(job.username, 0) + 1
+                assigned.append(job)
+        return assigned
+
+    # The policy only orders chunks of the highest priority waiting
+    def pick(self, queue):
+        top_priority = max(job.priority for job in queue)
+        return self.policy.pick([job for job in queue if job.priority == top_priority], self)
+
+    # Running chunks to stop so that waiting chunks of a higher priority get a slot: the lowest
+    # priority, most recently started first, counting chunks already being stopped
+    def preemptions(self):
+        with self.lock:
+            if any(slot.job is None for slot in self.slots):
+                return []
+            stopping = sum(1 for slot in self.slots if slot.job.preempted)
+            candidates = sorted((slot.job for slot in self.slots if not slot.job.preempted),
+                                key=lambda job: (job.priority, -job.started_at))
+            preempted = []
+            for waiting in sorted(self.queue, key=lambda job: -job.priority):
+                if stopping:
+                    stopping -= 1
+                    continue
+                if not candidates or candidates[0].priority >= waiting.priority:
+                    break
+                job = candidates.pop(0)
+                job.preempted = True
+                preempted.append(job)
+        return preempted
+
+    def release(self, job):
+        with self.lock:
+            elapsed = self.clock() - job.started_at
+            job.slot.job = None
+            job.slot.busy_seconds += elapsed
+            self.usage_by_user[job.username] = self.usage_by_user.get(job.username, 0.0) + elapsed * job.slot.speed
+            self.running_by_user[job.username] -= 1
+            if not self.running_by_user[job.username]:
+                del self.running_by_user[job.username]
+
+    # Seconds from now until the last chunk of each task ends, treating all slots as one pool
+    # of their summed speed and the queue as drained in policy order. Tasks with a chunk
+    # lacking a prediction are left out.
+    def predict_finish(self):
+        with self.lock:
+            now = self.clock()
+            total_speed = sum(slot.speed for slot in self.slots) or 1.0
+            running = [slot.job for slot in self.slots if slot.job is not None]
+            queue = list(self.queue)
+            ordered = []
+            while queue:
+                job = self.pick(queue)
+                queue.remove(job)
+                ordered.append(job)
+        unpredictable = {job.task_id for job in running + ordered if job.expected_seconds is None}
+        finish_by_task = {}
+        work = 0.0
+        for job in running:
+            if job.task_id in unpredictable:
+                continue
+            remaining = max(job.expected_seconds - (now - job.started_at) * job.slot.speed, 0.0) / job.slot.speed
+            finish_by_task[job.task_id] = max(finish_by_task.get(job.task_id, 0.0), remaining)
+            work += remaining * job.slot.speed
+        for job in ordered:
+            work += job.expected_seconds or 0.0
+            if job.task_id not in unpredictable:
+                finish_by_task[job.task_id] = max(finish_by_task.get(job.task_id, 0.0), work / total_speed)
+        return finish_by_task
+
+    def queue_depth(self):
+        return len(self.queue)
+
+    def slots_in_use(self):
+        return sum(1 for slot in self.slots if slot.job is not None)
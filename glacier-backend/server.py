@@ -1,12 +1,30 @@
 import asyncio
-import json
+import contextvars
+import datetime
+import hashlib
 import logging
+import os
 import sys
+import time
 
 import tornado
-from authenticator import AuthManager
+import assets
+import blendfile
+import election
+import encoding
+import metrics
+import overrides
+import profiler
+import startup
+import tracing
+import uploads
+from authenticator import PASSWORD_CHECK_SECONDS, AuthManager
+from config import ServerConfig
 
 auth = AuthManager()
+server_config = ServerConfig()
+
+LOG_READ_BYTES = 256 << 10
 
 
 def setup_logging():
@@ -20,185 +38,677 @@ def setup_logging():
 
 logger = logging.getLogger(__name__)
 
+http_requests = metrics.registry.counter('glacier_http_requests_total',
+                                         'Finished HTTP requests',
+                                         ('handler', 'code'))
+http_request_seconds = metrics.registry.histogram('glacier_http_request_seconds',
+                                                  'HTTP request latency',
+                                                  ('handler',))
+upload_task_seconds = metrics.registry.histogram('glacier_upload_task_seconds',
+                                                 'Result tarball transfer time per task')
+upload_frame_seconds = metrics.registry.histogram('glacier_upload_frame_seconds',
+                                                  'Result tarball transfer time divided by packed frame count')
+
+
+def log_request(handler):
+    status = handler.get_status()
+    handler_name = type(handler).__name__
+    request_time = handler.request.request_time()
+    http_requests.inc(handler=handler_name, code=status)
+    http_request_seconds.observe(request_time, handler=handler_name)
+    if status < 400:
+        log_method = tornado.log.access_log.info
+    elif status < 500:
+        log_method = tornado.log.access_log.warning
+    else:
+        log_method = tornado.log.access_log.error
+    log_method(f'{status} {handler._request_summary()} {1000.0 * request_time:.2f}ms')
+
+
+class GlacierHandler(tornado.web.RequestHandler):
+    def prepare(self):
+        # The socket opens before the database is connected, callers are asked to come back
+        if not auth.db.ready.is_set():
+            raise tornado.web.HTTPError(503)
+        self.trace, self.trace_token = tracing.slow_request_log.start(
+            f'{self.request.method} {self.request.path}')
+        self.unit_of_work, self.unit_of_work_token = auth.db.begin_unit_of_work()
+
+    # argon2 runs on a thread and the rest of the fixed duration is waited out on the IOLoop, so
+    # other clients are served meanwhile
+    async def is_password_correct(self, username, password):
+        end_time = time.monotonic() + PASSWORD_CHECK_SECONDS
+        loop = asyncio.get_running_loop()
+        is_correct = await loop.run_in_executor(None, contextvars.copy_context().run, auth.is_password_correct,
+                                                username, password)
+        with tracing.span('password_pad', is_padding=True):
+            await asyncio.sleep(max(end_time - time.monotonic(), 0))
+        return is_correct
+
+    def write_data(self, data):
+        content_type = encoding.negotiate(self.request.headers.get('Accept', ''))
+        self.set_header('Content-Type', content_type)
+        self.set_header('Vary', 'Accept')
+        self.write(encoding.encode(data, content_type))
+
+    def write_error(self, status_code, **kwargs):
+        if status_code == 503:
+            self.set_header('Retry-After', '1')
+            self.finish('Starting up')
+            return
+        super().write_error(status_code, **kwargs)
 
-class SessionListHandler(tornado.web.RequestHandler):
-    def get(self):
+    def on_finish(self):
+        unit_of_work_token = getattr(self, 'unit_of_work_token', None)
+        if unit_of_work_token is not None:
+            auth.db.end_unit_of_work(self.unit_of_work, unit_of_work_token)
+            self.unit_of_work_token = None
+        trace_token = getattr(self, 'trace_token', None)
+        if trace_token is not None:
+            tracing.slow_request_log.finish(self.trace, trace_token)
+            self.trace_token = None
+
+
+class SessionListHandler(GlacierHandler):
+    async def get(self):
         username = self.get_argument('username')
         password = self.get_argument('password')
-        if not auth.is_password_correct(username, password):
+        if not await self.is_password_correct(username, password):
             self.set_status(401)
             self.finish('Unauthorized')
             return
-        if not auth.is_session_by_username(username):
-            self.finish(json.dumps({'sessions': []}))
-            return
-        sessions_by_user_list = auth.db.get_session_by_username(username)
-        self.write(json.dumps({'sessions': sessions_by_user_list}))
+        sessions_by_user_list = [session.as_dict() for session in auth.get_sessions(username)]
+        self.write_data({'sessions': sessions_by_user_list})
 
 
-class SessionRemoveHandler(tornado.web.RequestHandler):
-    def get(self):
+class SessionRemoveHandler(GlacierHandler):
+    async def get(self):
         username = self.get_argument('username')
         password = self.get_argument('password')
         session_id = self.get_argument('session_id')
-        if not auth.is_password_correct(username, password):
+        if not await self.is_password_correct(username, password):
             self.set_status(401)
             self.finish('Unauthorized')
             return
-        if not auth.is_session_by_username(username):
+        session = auth.get_session(session_id)
+        if not session or session.username != username:
             self.set_status(404)
             self.finish('Session does not exist')
             return
-        if auth.is_session_id(session_id):
-            auth.delete_session(session_id)
-            self.write(json.dumps({'session_id': session_id}))
+        auth.delete_session(session_id)
+        self.write_data({'session_id': session_id})
 
 
-class AuthHandler(tornado.web.RequestHandler):
-    def get(self):
+class AuthHandler(GlacierHandler):
+    async def get(self):
         username = self.get_argument('username')
         password = self.get_argument('password')
-        if not auth.is_password_correct(username, password):
+        if not await self.is_password_correct(username, password):
             self.set_status(401)
             self.finish('Unauthorized')
             return
-        if not auth.is_session_by_username(username):
+        sessions = auth.get_sessions(username)
+        if not sessions:
             new_session_id = auth.add_session(username)
-            self.write(json.dumps({'session_id': new_session_id}))
+            self.write_data({'session_id': new_session_id})
             return
-        self.write(json.dumps({'session_id': auth.db.get_sessions_by_username(username)[0][0].session_id}))
-
-
-class SpawnHandler(tornado.web.RequestHandler):
-    def post(self):  # post
-        session_id = self.get_argument('session_id')
-        start_frame = self.get_argument('start_frame')
-        end_frame = self.get_argument('end_frame')
-        task_name = self.get_argument('task_name')
-        if not auth.is_session_id(session_id):
+        self.write_data({'session_id': sessions[0].session_id})
+
+
+# The body is streamed: the request is checked before the upload starts, the .blend is
+# written to disk and parsed chunk by chunk, and a bad file stops being stored at once
+@tornado.web.stream_request_body
+class SpawnHandler(GlacierHandler):
+    def prepare(self):
+        super().prepare()
+        self.blend_file = None
+        self.blend_file_path = None
+        self.upload_error = None
+        self.is_admitted = False
+        self.session_id = self.get_argument('session_id')
+        self.start_frame = self.get_argument('start_frame')
+        self.end_frame = self.get_argument('end_frame')
+        self.task_name = self.get_argument('task_name')
+        self.session = auth.get_session(self.session_id)
+        if not self.session:
             self.set_status(401)
             self.finish('Unauthorized')
             return
-        if not start_frame.isdigit() or not end_frame.isdigit():
+        if auth.janitor.is_over_user_quota(self.session.username):
+            self.set_status(507)
+            self.finish('Disk quota exceeded')
+            return
+        if not self.start_frame.isdigit() or not self.end_frame.isdigit():
             self.set_status(403)
             self.finish('Non-digit frames')
             return
-        blend_file = self.request.files['file'][0]['body']
-        new_task_id = auth.add_task(task_name, session_id, blend_file, start_frame, end_frame)
-        self.write(json.dumps({'task_id': new_task_id}))
+        if int(self.start_frame) > int(self.end_frame):
+            self.set_status(403)
+            self.finish('start_frame is after end_frame')
+            return
+        self.deadline = self.get_argument('deadline', None)
+        if self.deadline is not None and not self.deadline.isdigit():
+            self.set_status(403)
+            self.finish('Non-digit deadline')
+            return
+        if self.deadline is not None:
+            try:
+                self.deadline = datetime.datetime.fromtimestamp(int(self.deadline), datetime.timezone.utc)
+            except (OSError, OverflowError, ValueError):
+                self.set_status(403)
+                self.finish('Invalid deadline')
+                return
+        self.priority = self.get_argument('priority', '0')
+        if not self.priority.isdigit():
+            self.set_status(403)
+            self.finish('Non-digit priority')
+            return
+        self.priority = int(self.priority)
+        if (self.priority > server_config.max_user_priority
+                and self.session.username not in server_config.admin_users.split(',')):
+            self.set_status(403)
+            self.finish('Priority above MAX_USER_PRIORITY')
+            return
+        try:
+            self.render_overrides = overrides.parse(lambda name: self.get_argument(name, None))
+            self.receiver = uploads.MultipartFileReceiver(self.request.headers.get('Content-Type', ''), 'file',
+                                                          self.on_file_data, assets.MAX_MANIFEST_BYTES)
+        except Exception as e:
+            self.set_status(403)
+            self.finish(str(e))
+            return
+        frame_count = ((int(self.end_frame) - int(self.start_frame)) // self.render_overrides.get('frame_step', 1)
+                       + 1)
+        rejection = auth.admission.admit(self.session.username, frame_count)
+        if rejection is not None:
+            reason, retry_after = rejection
+            self.set_status(429)
+            self.set_header('Retry-After', str(retry_after))
+            self.finish(f'Too many requests ({reason})')
+            return
+        self.is_admitted = True
+        self.unit_of_work.close()
+        self.request.connection.set_max_body_size(server_config.max_upload_bytes)
+        self.blend_reader = blendfile.BlendReader()
+        self.blend_hash = hashlib.sha256()
+        self.task_id, self.blend_file_path = auth.new_task_upload()
+        self.blend_file = open(self.blend_file_path, 'wb')
+
+    def data_received(self, chunk):
+        if self.blend_file is None or self.upload_error is not None:
+            return
+        try:
+            self.receiver.feed(chunk)
+        except Exception as e:
+            self.upload_error = str(e)
+            self.discard_upload()
+
+    def on_file_data(self, data):
+        self.blend_reader.feed(data)
+        self.blend_hash.update(data)
+        self.blend_file.write(data)
+
+    def release_admission(self):
+        if self.is_admitted:
+            self.is_admitted = False
+            auth.admission.release()
+
+    def discard_upload(self):
+        if self.blend_file is not None:
+            self.blend_file.close()
+            self.blend_file = None
+        if self.blend_file_path is not None and os.path.exists(self.blend_file_path):
+            os.remove(self.blend_file_path)
+
+    def post(self):
+        if self.upload_error is None:
+            try:
+                self.receiver.finish()
+                blend_info = self.blend_reader.finish()
+                self.upload_error = blend_info.mismatch(int(self.start_frame), int(self.end_frame))
+            except Exception as e:
+                self.upload_error = str(e)
+        if self.upload_error is not None:
+            self.discard_upload()
+            self.set_status(400)
+            self.finish(f'Invalid upload: {self.upload_error}')
+            return
+        self.blend_file.close()
+        self.blend_file = None
+        # With an asset manifest the .blend moves into a tree mirroring the client's paths
+        if 'assets' in self.receiver.fields:
+            try:
+                manifest = assets.parse_manifest(self.receiver.fields['assets'])
+                blend_client_path = self.receiver.fields.get('blend_path', b'').decode()
+                self.blend_file_path = auth.build_task_tree(self.task_id, self.blend_file_path, blend_client_path,
+                                                            manifest)
+            except Exception as e:
+                self.discard_upload()
+                self.set_status(409)
+                self.finish(f'Invalid assets: {e}')
+                return
+        new_task_id = auth.add_task(self.task_id, self.task_name, self.session_id, self.blend_file_path,
+                                    self.start_frame, self.end_frame, self.session.username,
+                                    self.render_overrides, blend_info, self.blend_hash.hexdigest(), self.deadline,
+                                    self.priority)
+        self.blend_file_path = None
+        self.write_data({'task_id': new_task_id})
+
+    def on_finish(self):
+        self.release_admission()
+        super().on_finish()
+
+    def on_connection_close(self):
+        self.release_admission()
+        self.discard_upload()
+
+
+# Body carries sha256=... form fields; answers the ones the store lacks
+class AssetMissingHandler(GlacierHandler):
+    def post(self):
+        session_id = self.get_argument('session_id')
+        hashes = self.get_body_arguments('sha256')
+        if not auth.get_session(session_id):
+            self.set_status(401)
+            self.finish('Unauthorized')
+            return
+        if not all(assets.SHA256_PATTERN.match(sha256) for sha256 in hashes):
+            self.set_status(403)
+            self.finish('Invalid sha256')
+            return
+        self.unit_of_work.close()
+        self.write_data({'missing': auth.missing_assets(hashes)})
+
+
+# Streamed like a task upload; stored only when the content matches the sha256 it was sent for
+@tornado.web.stream_request_body
+class AssetUploadHandler(GlacierHandler):
+    def prepare(self):
+        super().prepare()
+        self.asset_file = None
+        self.asset_file_path = None
+        self.upload_error = None
+        self.is_admitted = False
+        self.sha256 = self.get_argument('sha256')
+        session = auth.get_session(self.get_argument('session_id'))
+        if not session:
+            self.set_status(401)
+            self.finish('Unauthorized')
+            return
+        if not assets.SHA256_PATTERN.match(self.sha256):
+            self.set_status(403)
+            self.finish('Invalid sha256')
+            return
+        if auth.janitor.is_over_user_quota(session.username):
+            self.set_status(507)
+            self.finish('Disk quota exceeded')
+            return
+        try:
+            self.receiver = uploads.MultipartFileReceiver(self.request.headers.get('Content-Type', ''), 'file',
+                                                          self.on_file_data)
+        except Exception as e:
+            self.set_status(403)
+            self.finish(str(e))
+            return
+        rejection = auth.admission.admit_upload(session.username)
+        if rejection is not None:
+            reason, retry_after = rejection
+            self.set_status(429)
+            self.set_header('Retry-After', str(retry_after))
+            self.finish(f'Too many requests ({reason})')
+            return
+        self.is_admitted = True
+        self.unit_of_work.close()
+        self.request.connection.set_max_body_size(server_config.max_upload_bytes)
+        self.asset_hash = hashlib.sha256()
+        self.asset_file_path = auth.new_asset_upload()
+        self.asset_file = open(self.asset_file_path, 'wb')
+
+    def data_received(self, chunk):
+        if self.asset_file is None or self.upload_error is not None:
+            return
+        try:
+            self.receiver.feed(chunk)
+        except Exception as e:
+            self.upload_error = str(e)
+            self.discard_upload()
+
+    def on_file_data(self, data):
+        self.asset_hash.update(data)
+        self.asset_file.write(data)
+
+    def release_admission(self):
+        if self.is_admitted:
+            self.is_admitted = False
+            auth.admission.release()
+
+    def discard_upload(self):
+        if self.asset_file is not None:
+            self.asset_file.close()
+            self.asset_file = None
+        if self.asset_file_path is not None and os.path.exists(self.asset_file_path):
+            os.remove(self.asset_file_path)
+
+    def post(self):
+        if self.upload_error is None:
+            try:
+                self.receiver.finish()
+            except Exception as e:
+                self.upload_error = str(e)
+        if self.upload_error is None and self.asset_hash.hexdigest() != self.sha256:
+            self.upload_error = 'content does not match sha256'
+        if self.upload_error is not None:
+            self.discard_upload()
+            self.set_status(400)
+            self.finish(f'Invalid upload: {self.upload_error}')
+            return
+        self.asset_file.close()
+        self.asset_file = None
+        auth.add_asset(self.asset_file_path, self.sha256)
+        self.asset_file_path = None
+        self.write_data({'sha256': self.sha256})
+
+    def on_finish(self):
+        self.release_admission()
+        super().on_finish()
 
+    def on_connection_close(self):
+        self.release_admission()
+        self.discard_upload()
 
-class StatHandler(tornado.web.RequestHandler):
+
+class StatHandler(GlacierHandler):
     def get(self):
         session_id = self.get_argument('session_id')
         task_id = self.get_argument('task_id')
-        if not auth.is_session_id(session_id) or not auth.is_task_id(task_id):
+        session, task = auth.get_task_for_session(session_id, task_id)
+        if not session or not task:
             self.set_status(401)
             self.finish('Unauthorized')
             return
-        task = auth.db.get_task_by_id(task_id)
-        task_data = task.as_dict()
-        progress = str(auth.render_bus.tasks_by_id[task_id].last_line)
-        task_data.update({'progress': progress})
-        self.write(json.dumps(task_data))
-
-
-class ResultHandler(tornado.web.RequestHandler):
-    def get(self):
+        with tracing.span('as_dict'):
+            task_data = task.as_dict()
+        task_data.update({'progress': task.progress or ''})
+        # Until the scheduler adopts the task, assume it starts right away
+        if task.state == 'CREATED' and task.predicted_finish is None and task.predicted_seconds is not None:
+            task_data['predicted_finish'] = (datetime.datetime.now(datetime.timezone.utc)
+                                             + datetime.timedelta(seconds=task.predicted_seconds)).isoformat()
+        with tracing.span('encode'):
+            self.write_data(task_data)
+
+
+class ResultHandler(GlacierHandler):
+    async def get(self):
         session_id = self.get_argument('session_id')
         task_id = self.get_argument('task_id')
-        if not auth.is_session_id(session_id) or not auth.is_task_id(task_id):
+        session, task_row = auth.get_task_for_session(session_id, task_id)
+        if not session or not task_row:
             self.set_status(401)
             self.finish('Unauthorized')
             return
-        tar_path = auth.render_bus.tasks_by_id[task_id].tar_path
+        tar_path = task_row.tar_path
+        frames_done = task_row.frames_done
         if not tar_path:
             self.set_status(400)
             self.finish('Task is not complete')
             return
+        self.unit_of_work.close()
+        start_time = time.perf_counter()
         with open(tar_path, 'rb') as f:
             data = f.read()
             self.write(data)
-        auth.render_bus.tasks_by_id[task_id].done()
+        await self.flush()
+        upload_time = time.perf_counter() - start_time
+        upload_task_seconds.observe(upload_time)
+        if frames_done:
+            upload_frame_seconds.observe(upload_time / frames_done)
+        os.utime(tar_path)
+        auth.task_updater(task_id, 'DONE')
         self.finish()
 
 
-class KillHandler(tornado.web.RequestHandler):
+class KillHandler(GlacierHandler):
     def get(self):
         session_id = self.get_argument('session_id')
         task_id = self.get_argument('task_id')
-        if not auth.is_session_id(session_id):
+        session, task = auth.get_task_for_session(session_id, task_id)
+        if not session:
             self.set_status(401)
             self.finish('Unauthorized')
             return
-        if not auth.is_task_id(task_id):
+        if not task:
             self.set_status(404)
             self.finish('Task does not exist')
             return
-        auth.render_bus.tasks_by_id[task_id].kill()
-        self.write(json.dumps({'task_id': task_id}))
+        auth.kill_task(task_id)
+        self.write_data({'task_id': task_id})
 
 
-class ListHandler(tornado.web.RequestHandler):
+# Tails are read in pieces: the response holds up to LOG_READ_BYTES from offset, X-Log-Offset
+# says where they start (later than asked when older output rotated away) and X-Next-Offset
+# is the offset for the next request
+class LogHandler(GlacierHandler):
     def get(self):
         session_id = self.get_argument('session_id')
-        if not auth.is_session_id(session_id):
+        task_id = self.get_argument('task_id')
+        offset = self.get_argument('offset', '0')
+        if not offset.isdigit():
+            self.set_status(403)
+            self.finish('Non-digit offset')
+            return
+        session, task = auth.get_task_for_session(session_id, task_id)
+        if not session or not task:
             self.set_status(401)
             self.finish('Unauthorized')
             return
-        if not auth.is_task_by_session_id(session_id):
-            self.write(json.dumps([]))
+        self.unit_of_work.close()
+        start, data = auth.read_task_log(task_id, int(offset), LOG_READ_BYTES)
+        self.set_header('Content-Type', 'text/plain; charset=utf-8')
+        self.set_header('X-Log-Offset', str(start))
+        self.set_header('X-Next-Offset', str(start + len(data)))
+        self.write(data)
+
+
+# The newest preview unless a frame is asked for; X-Frame tells which one was sent
+class PreviewHandler(GlacierHandler):
+    def get(self):
+        session_id = self.get_argument('session_id')
+        task_id = self.get_argument('task_id')
+        frame = self.get_argument('frame', None)
+        if frame is not None and not frame.isdigit():
+            self.set_status(403)
+            self.finish('Non-digit frame')
+            return
+        session, task = auth.get_task_for_session(session_id, task_id)
+        if not session or not task:
+            self.set_status(401)
+            self.finish('Unauthorized')
+            return
+        self.unit_of_work.close()
+        preview = auth.read_preview(task_id, int(frame) if frame is not None else None)
+        if preview is None:
+            self.set_status(404)
+            self.finish('No preview yet')
             return
-        task_list = [task[0].as_dict() for task in auth.db.get_tasks_by_session_id(session_id)]
+        frame, content_type, data = preview
+        self.set_header('Content-Type', content_type)
+        self.set_header('X-Frame', str(frame))
+        self.write(data)
+
+
+class ListHandler(GlacierHandler):
+    def get(self):
+        session_id = self.get_argument('session_id')
+        task_rows = auth.get_tasks_for_session(session_id)
+        if task_rows is None:
+            self.set_status(401)
+            self.finish('Unauthorized')
+            return
+        with tracing.span('as_dict'):
+            task_list = [task.as_dict() for task in task_rows]
         for task in task_list:
-            task_id = task['task_id']
-            progress = str(auth.render_bus.tasks_by_id[task_id].last_line)
-            task.update({'progress': progress})
-        self.write(json.dumps(task_list))
+            task['progress'] = task['progress'] or ''
+        with tracing.span('encode'):
+            self.write_data(task_list)
 
 
-class DeleteHandler(tornado.web.RequestHandler):
+class DeleteHandler(GlacierHandler):
     def get(self):
         session_id = self.get_argument('session_id')
         task_id = self.get_argument('task_id')
-        if not auth.is_session_id(session_id):
+        session, task = auth.get_task_for_session(session_id, task_id)
+        if not session:
             self.set_status(401)
             self.finish('Unauthorized')
             return
-        if not auth.is_task_id(task_id):
+        if not task:
             self.set_status(404)
             self.finish('Task does not exist')
             return
         auth.delete_task(task_id)
-        self.write(json.dumps({'task_id': task_id}))
+        self.write_data({'task_id': task_id})
+
+
+class ProfileHandler(GlacierHandler):
+    async def get(self):
+        username = self.get_argument('username')
+        password = self.get_argument('password')
+        seconds = self.get_argument('seconds', '10')
+        if not await self.is_password_correct(username, password) or username not in server_config.admin_users.split(','):
+            self.set_status(401)
+            self.finish('Unauthorized')
+            return
+        if not seconds.isdigit() or not 0 < int(seconds) <= server_config.profile_max_seconds:
+            self.set_status(403)
+            self.finish(f'seconds must be in 1..{server_config.profile_max_seconds}')
+            return
+        self.unit_of_work.close()
+        loop = asyncio.get_running_loop()
+        collapsed_stacks = await loop.run_in_executor(None, profiler.sample_collapsed_stacks, int(seconds))
+        self.set_header('Content-Type', 'text/plain; charset=utf-8')
+        self.write(collapsed_stacks)
+
+
+# Liveness: answered by the event loop alone, whatever the state of the database
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write({'status': 'ok', 'uptime_seconds': round(startup.clock.since_start(), 3)})
+
+
+# Readiness: 200 once this process can serve the API; the scheduler is reported but not
+# required, only one process runs it and the others stand by
+class ReadyHandler(tornado.web.RequestHandler):
+    def get(self):
+        upload_facility = auth.render_bus.upload_facility
+        if not auth.is_scheduler:
+            scheduler_state = 'standby'
+        elif auth.render_bus.is_running:
+            scheduler_state = 'running'
+        else:
+            scheduler_state = 'starting'
+        checks = {'database': auth.db.ready.is_set(),
+                  'storage': os.path.isdir(upload_facility) and os.access(upload_facility, os.W_OK),
+                  'scheduler': scheduler_state}
+        if not checks['database'] or not checks['storage']:
+            self.set_status(503)
+        self.write(checks)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', metrics.registry.content_type)
+        self.write(metrics.registry.exposition())
 
 
 def make_app():
     return tornado.web.Application([
         (r'/login',             AuthHandler),           # username   & password
-        (r'/task/request',      SpawnHandler),          # session_id
+        (r'/task/request',      SpawnHandler),          # session_id & optional render overrides or preview
         (r'/task/stat',         StatHandler),           # session_id & task_id
         (r'/task/result',       ResultHandler),         # session_id & task_id
         (r'/task/kill',         KillHandler),           # session_id & task_id
+        (r'/task/log',          LogHandler),            # session_id & task_id    & offset
+        (r'/task/preview',      PreviewHandler),        # session_id & task_id    & optional frame
         (r'/task/list',         ListHandler),           # session_id
+        (r'/asset/missing',     AssetMissingHandler),   # session_id & sha256 list in the body
+        (r'/asset/upload',      AssetUploadHandler),    # session_id & sha256
         (r'/task/delete',       DeleteHandler),         # session_id & task_id
         (r'/session/list',      SessionListHandler),    # username   & password
-        (r'/session/remove',    SessionRemoveHandler)   # username   & password   & session_id
-    ])
-
-
-async def main_server():
-    app = make_app()
-    logger.info('ready to accept connections')
-    app.listen(8888)
+        (r'/session/remove',    SessionRemoveHandler),  # username   & password   & session_id
+        (r'/metrics',           MetricsHandler),
+        (r'/healthz',           HealthHandler),
+        (r'/readyz',            ReadyHandler),
+        (r'/admin/profile',     ProfileHandler)         # username   & password   & seconds
+    ], log_function=log_request)
+
+
+async def main_server(sockets):
+    with startup.clock.phase('listen'):
+        app = make_app()
+        if sockets:
+            server = tornado.httpserver.HTTPServer(app)
+            server.add_sockets(sockets)
+        else:
+            try:
+                app.listen(server_config.server_port)
+            except OSError as e:
+                # Waiting threads would keep the process alive but deaf
+                logger.critical(f'cannot listen on port {server_config.server_port}: {e}, exiting')
+                logging.shutdown()
+                os._exit(1)
+    logger.info('accepting connections, API answers 503 until the database is ready')
     await asyncio.Event().wait()
 
 
-async def main():
-    setup_logging()
+# Giving up exits the process so that the supervisor restarts it; the other threads would
+# otherwise keep it alive and answering 503
+def connect_database():
+    try:
+        with startup.clock.phase('database'):
+            auth.db.connect()
+    except Exception as e:
+        logger.critical(f'{e}, exiting')
+        logging.shutdown()
+        os._exit(1)
+    startup.clock.report('ready to serve')
+
+
+# Background loops start once the database is up, the listening socket does not wait for it
+def run_when_database_ready(target, *args):
+    auth.db.ready.wait()
+    target(*args)
+
+
+# Any number of processes serve the API, the one holding the lease also runs Blender
+def run_scheduler_when_elected(lease):
+    with startup.clock.phase('election'):
+        while not lease.try_acquire():
+            time.sleep(server_config.scheduler_election_seconds)
+    logger.info(f'process {os.getpid()} elected as scheduler')
+    auth.become_scheduler()
+    auth.render_bus.lease = lease
+    auth.render_bus.scheduler()
+    # Only returns once the lease is lost; the restarted process rejoins the election
+    logger.critical('exiting after losing the scheduler lease')
+    logging.shutdown()
+    os._exit(1)
+
+
+async def main(sockets=None):
     loop = asyncio.get_event_loop()
-    await asyncio.gather(loop.run_in_executor(None, auth.render_bus.scheduler), main_server())
+    lease = election.SchedulerLease(auth.db.engine, f'{auth.render_bus.upload_facility}/.scheduler.lock')
+    await asyncio.gather(loop.run_in_executor(None, connect_database),
+                         loop.run_in_executor(None, run_when_database_ready, run_scheduler_when_elected, lease),
+                         loop.run_in_executor(None, run_when_database_ready, auth.janitor.run),
+                         loop.run_in_executor(None, run_when_database_ready, auth.sessions.run),
+                         main_server(sockets))
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    setup_logging()
+    sockets = None
+    if server_config.server_workers != 1:
+        sockets = tornado.netutil.bind_sockets(server_config.server_port)
+        tornado.process.fork_processes(server_config.server_workers)
+        auth.db.engine.dispose(close=False)
+    asyncio.run(main(sockets))
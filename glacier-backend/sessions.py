@@ -0,0 +1,92 @@
+import datetime
+import logging
+import time
+
+import metrics
+from config import SessionConfig
+from database import as_utc
+
+logger = logging.getLogger(__name__)
+
+FINISHED_STATES = ('PACKED', 'DONE', 'KILLED', 'FAILED(BLENDER)', 'FAILED(TAR)')
+
+expired_sessions = metrics.registry.counter('glacier_sessions_expired_total',
+                                            'Sessions deleted by the session sweeper')
+
+
+class SessionKeeper(SessionConfig):
+    def __init__(self, db, render_bus):
+        super().__init__()
+        self.db = db
+        self.render_bus = render_bus
+        self.last_seen_by_session_id = {}
+        self.is_sweeping = False
+        metrics.registry.gauge('glacier_sessions_pending_last_seen', 'Session touches not yet written to the database',
+                               callback=lambda: len(self.last_seen_by_session_id))
+
+    # Requests only record the touch in memory, the sweeper thread writes them in one statement
+    def touch(self, session_id, now):
+        self.last_seen_by_session_id[session_id] = now
+
+    def is_live(self, session, now=None):
+        if session is None:
+            return False
+        if now is None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+        if session.creation_time and now - as_utc(session.creation_time) \
+                > datetime.timedelta(seconds=self.session_absolute_ttl_seconds):
+            return False
+        last_seen = self.last_seen_by_session_id.get(session.session_id) or session.last_seen or session.creation_time
+        if last_seen and now - as_utc(last_seen) > datetime.timedelta(seconds=self.session_idle_ttl_seconds):
+            return False
+        return True
+
+    def check(self, session):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if not self.is_live(session, now):
+            return None
+        self.touch(session.session_id, now)
+        return session
+
+    def flush_last_seen(self):
+        if not self.last_seen_by_session_id:
+            return
+        pending = self.last_seen_by_session_id
+        self.last_seen_by_session_id = {}
+        self.db.update_sessions_last_seen(pending)
+
+    def sweep(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        expired_session_ids = self.db.get_expired_session_ids(
+            now - datetime.timedelta(seconds=self.session_absolute_ttl_seconds),
+            now - datetime.timedelta(seconds=self.session_idle_ttl_seconds))
+        if not expired_session_ids:
+            return
+        tasks = [row[0] for row in self.db.get_tasks_by_session_ids(expired_session_ids)]
+        busy_session_ids = {task.parent_session_id for task in tasks if task.state not in FINISHED_STATES}
+        finished_task_ids = [task.task_id for task in tasks if task.parent_session_id not in busy_session_ids]
+        session_ids = [session_id for session_id in expired_session_ids if session_id not in busy_session_ids]
+        for task_id in finished_task_ids:
+            if task_id in self.render_bus.tasks:
+                self.render_bus.delete_task(task_id)
+        if finished_task_ids:
+            self.db.delete_tasks_by_ids(finished_task_ids)
+        if session_ids:
+            self.db.delete_sessions_by_ids(session_ids)
+            expired_sessions.inc(len(session_ids))
+        logger.info(f'session sweeper removed {len(session_ids)} session(s) and {len(finished_task_ids)} task(s), '
+                    f'{len(busy_session_ids)} expired session(s) still have unfinished tasks')
+
+    def run(self):
+        logger.info(f'session sweeper start, idle ttl {self.session_idle_ttl_seconds}s, '
+                    f'absolute ttl {self.session_absolute_ttl_seconds}s')
+        last_sweep_time = 0.0
+        while True:
+            try:
+                self.flush_last_seen()
+                if self.is_sweeping and time.monotonic() - last_sweep_time >= self.session_sweep_interval_seconds:
+                    last_sweep_time = time.monotonic()
+                    self.sweep()
+            except Exception as e:
+                logger.error(f'session sweeper failed: {e}')
+            time.sleep(self.last_seen_flush_seconds)
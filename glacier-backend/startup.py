@@ -0,0 +1,41 @@
+import contextlib
+import logging
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# Startup runs as phases on several threads: the listening socket comes up first, the database
+# is connected and migrated in the background, the elected process then discovers devices and
+# warms up workers. Each phase is logged with its own duration and the time since the process
+# started, so a slow restart shows where the time went.
+class StartupClock:
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.seconds_by_phase = {}
+        self.lock = threading.Lock()
+        metrics.registry.gauge('glacier_startup_phase_seconds', 'Time spent in each startup phase of this process',
+                               ('phase',), callback=lambda: dict(self.seconds_by_phase))
+
+    def since_start(self):
+        return time.monotonic() - self.started_at
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start_time = time.monotonic()
+        yield
+        seconds = time.monotonic() - start_time
+        with self.lock:
+            self.seconds_by_phase[name] = seconds
+        logger.info(f'startup: {name} took {1000 * seconds:.0f}ms, {self.since_start():.2f}s since start')
+
+    def report(self, milestone):
+        with self.lock:
+            breakdown = ', '.join(f'{name} {1000 * seconds:.0f}ms' for name, seconds in self.seconds_by_phase.items())
+        logger.info(f'startup: {milestone} after {self.since_start():.2f}s ({breakdown})')
+
+
+clock = StartupClock()
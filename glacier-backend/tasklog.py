@@ -0,0 +1,121 @@
+import os
+import threading
+
+# Blender output of a task. Offsets count bytes from the task's first line and mean the same
+# in memory and on disk: the scheduler process keeps the newest ring_bytes in a ring buffer,
+# and every process can read the segment files {task_id}.log.{n} under UPLOAD_FACILITY, each
+# holding bytes [n * segment_bytes, (n + 1) * segment_bytes). Only the newest max_segments
+# files are kept.
+
+
+def segment_path(directory, task_id, index):
+    return os.path.join(directory, f'{task_id}.log.{index}')
+
+
+def segment_indexes(directory, task_id):
+    prefix = f'{task_id}.log.'
+    return sorted(int(name[len(prefix):]) for name in os.listdir(directory)
+                  if name.startswith(prefix) and name[len(prefix):].isdigit())
+
+
+def log_size(directory, task_id, segment_bytes):
+    indexes = segment_indexes(directory, task_id)
+    if not indexes:
+        return 0
+    return indexes[-1] * segment_bytes + os.path.getsize(segment_path(directory, task_id, indexes[-1]))
+
+
+# (offset of the first byte returned, data) for up to limit bytes from offset; an offset
+# that has rotated away starts at the oldest byte still kept
+def read_segments(directory, task_id, offset, limit, segment_bytes):
+    indexes = segment_indexes(directory, task_id)
+    if not indexes:
+        return 0, b''
+    offset = max(offset, indexes[0] * segment_bytes)
+    start = offset
+    chunks = []
+    while limit > 0:
+        index = offset // segment_bytes
+        try:
+            with open(segment_path(directory, task_id, index), 'rb') as segment:
+                segment.seek(offset - index * segment_bytes)
+                data = segment.read(min(limit, (index + 1) * segment_bytes - offset))
+        except FileNotFoundError:
+            break
+        if not data:
+            break
+        chunks.append(data)
+        offset += len(data)
+        limit -= len(data)
+    return start, b''.join(chunks)
+
+
+def remove_segments(directory, task_id):
+    for index in segment_indexes(directory, task_id):
+        try:
+            os.remove(segment_path(directory, task_id, index))
+        except FileNotFoundError:
+            pass
+
+
+class TaskLog:
+    def __init__(self, directory, task_id, ring_bytes, segment_bytes, max_segments):
+        self.directory = directory
+        self.task_id = task_id
+        self.ring_bytes = ring_bytes
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+        self.size = log_size(directory, task_id, segment_bytes)
+        self.ring = bytearray()
+        self.ring_start = self.size
+        self.segment = None
+        self.segment_index = None
+
+    def write_line(self, line):
+        data = (line + '\n').encode(errors='replace')
+        with self.lock:
+            self.ring += data
+            if len(self.ring) > self.ring_bytes:
+                excess = len(self.ring) - self.ring_bytes
+                del self.ring[:excess]
+                self.ring_start += excess
+            while data:
+                index = self.size // self.segment_bytes
+                if index != self.segment_index:
+                    self.open_segment(index)
+                room = (index + 1) * self.segment_bytes - self.size
+                self.segment.write(data[:room])
+                self.size += len(data[:room])
+                data = data[room:]
+            self.segment.flush()
+
+    def open_segment(self, index):
+        if self.segment is not None:
+            self.segment.close()
+        self.segment = open(segment_path(self.directory, self.task_id, index), 'ab')
+        self.segment_index = index
+        if index >= self.max_segments:
+            try:
+                os.remove(segment_path(self.directory, self.task_id, index - self.max_segments))
+            except FileNotFoundError:
+                pass
+
+    # Same contract as read_segments, None when offset is older than the ring
+    def read(self, offset, limit):
+        with self.lock:
+            if offset < self.ring_start:
+                return None
+            start = min(offset, self.size) - self.ring_start
+            return self.ring_start + start, bytes(self.ring[start:start + limit])
+
+    def tail(self, lines):
+        with self.lock:
+            return bytes(self.ring).decode(errors='replace').splitlines()[-lines:]
+
+    def close(self):
+        with self.lock:
+            if self.segment is not None:
+                self.segment.close()
+                self.segment = None
+                self.segment_index = None
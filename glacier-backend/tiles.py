@@ -0,0 +1,162 @@
+import os
+import shutil
+import struct
+import zlib
+
+try:
+    import OpenEXR
+    import Imath
+except ImportError:
+    OpenEXR = None
+
+# A still frame is rendered as horizontal bands, band 0 at the bottom as Blender's border
+# coordinates go, each cropped to its border. Adjacent bands share the same border value, so
+# Blender rounds them to the same pixel row and the bands stitch without gaps or overlap.
+# Formats that cannot be stitched exactly are rendered as PNG instead.
+
+STITCHABLE_FORMATS = ('PNG', 'OPEN_EXR', 'OPEN_EXR_MULTILAYER')
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+def tiles_dir(upload_facility, task_id):
+    return f'{upload_facility}/{task_id}.tiles'
+
+
+def tile_dir(upload_facility, task_id, index):
+    return f'{tiles_dir(upload_facility, task_id)}/{index}/'
+
+
+def python_expr(index, count):
+    return '\n'.join(['import bpy',
+                      'scene = bpy.context.scene',
+                      'scene.render.use_border = True',
+                      'scene.render.use_crop_to_border = True',
+                      'scene.render.border_min_x = 0.0',
+                      'scene.render.border_max_x = 1.0',
+                      f'scene.render.border_min_y = {index / count!r}',
+                      f'scene.render.border_max_y = {(index + 1) / count!r}',
+                      f'if scene.render.image_settings.file_format not in {STITCHABLE_FORMATS!r}:',
+                      "    scene.render.image_settings.file_format = 'PNG'"])
+
+
+def png_chunks(png_file):
+    if png_file.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+        raise Exception(f'{png_file.name} is not a PNG file')
+    while True:
+        length, kind = struct.unpack('>I4s', png_file.read(8))
+        data = png_file.read(length)
+        png_file.read(4)
+        yield kind, data
+        if kind == b'IEND':
+            return
+
+
+def write_png_chunk(png_file, kind, data):
+    png_file.write(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data)))
+
+
+# Each band's first row was filtered against an all zero row; undone here and stored unfiltered,
+# it no longer depends on the band above. Paeth of a zero row above is Sub and Up is a no-op.
+def unfilter_first_row(row, bytes_per_pixel):
+    filter_type, data = row[0], bytearray(row[1:])
+    if filter_type in (1, 4):
+        for index in range(bytes_per_pixel, len(data)):
+            data[index] = (data[index] + data[index - bytes_per_pixel]) & 0xFF
+    elif filter_type == 3:
+        for index in range(bytes_per_pixel, len(data)):
+            data[index] = (data[index] + data[index - bytes_per_pixel] // 2) & 0xFF
+    return b'\x00' + bytes(data)
+
+
+# Bands are streamed through zlib row by row, any bit depth and color type Blender writes
+def stitch_png(band_paths, target_path):
+    headers = []
+    for band_path in band_paths:
+        with open(band_path, 'rb') as band_file:
+            kind, data = next(png_chunks(band_file))
+            headers.append(struct.unpack('>IIBBBBB', data))
+    width, _, bit_depth, color_type, compression, filter_method, interlace = headers[0]
+    if interlace or any(header[0] != width or header[2:] != headers[0][2:] for header in headers):
+        raise Exception('bands differ in width or pixel format, or are interlaced')
+    height = sum(header[1] for header in headers)
+    row_bytes = 1 + (width * PNG_CHANNELS[color_type] * bit_depth + 7) // 8
+    bytes_per_pixel = max(1, PNG_CHANNELS[color_type] * bit_depth // 8)
+    compressor = zlib.compressobj()
+    with open(target_path, 'wb') as target_file:
+        target_file.write(PNG_SIGNATURE)
+        write_png_chunk(target_file, b'IHDR', struct.pack('>IIBBBBB', width, height, bit_depth, color_type,
+                                                           compression, filter_method, interlace))
+        for band_index, band_path in enumerate(band_paths):
+            with open(band_path, 'rb') as band_file:
+                decompressor = zlib.decompressobj()
+                pending = b''
+                is_first_row = True
+                has_image_data = False
+                for kind, data in png_chunks(band_file):
+                    if kind == b'IDAT':
+                        pending += decompressor.decompress(data)
+                        has_image_data = True
+                    elif kind == b'IEND':
+                        pending += decompressor.flush()
+                    else:
+                        # Ancillary chunks must not split the image data, only those ahead of it are kept
+                        if kind != b'IHDR' and band_index == 0 and not has_image_data:
+                            write_png_chunk(target_file, kind, data)
+                        continue
+                    rows_end = len(pending) - len(pending) % row_bytes
+                    if is_first_row and rows_end:
+                        target_rows = unfilter_first_row(pending[:row_bytes], bytes_per_pixel) \
+                            + pending[row_bytes:rows_end]
+                        is_first_row = False
+                    else:
+                        target_rows = pending[:rows_end]
+                    idat = compressor.compress(target_rows)
+                    if idat:
+                        write_png_chunk(target_file, b'IDAT', idat)
+                    pending = pending[rows_end:]
+        write_png_chunk(target_file, b'IDAT', compressor.flush())
+        write_png_chunk(target_file, b'IEND', b'')
+
+
+# Channels are copied in their stored pixel type, half floats stay half floats
+def stitch_exr(band_paths, target_path):
+    if OpenEXR is None:
+        raise Exception('OpenEXR is not installed')
+    channels = {}
+    header = None
+    height = 0
+    for band_path in band_paths:
+        band_file = OpenEXR.InputFile(band_path)
+        band_header = band_file.header()
+        if header is None:
+            header = band_header
+            channels = {name: [] for name in header['channels']}
+        window = band_header['dataWindow']
+        height += window.max.y - window.min.y + 1
+        for name in channels:
+            channels[name].append(band_file.channel(name))
+        band_file.close()
+    width = header['dataWindow'].max.x - header['dataWindow'].min.x + 1
+    header['dataWindow'] = Imath.Box2i(Imath.V2i(0, 0), Imath.V2i(width - 1, height - 1))
+    header['displayWindow'] = header['dataWindow']
+    target_file = OpenEXR.OutputFile(target_path, header)
+    target_file.writePixels({name: b''.join(parts) for name, parts in channels.items()})
+    target_file.close()
+
+
+# Every file band 0 saved gets its stitched counterpart in output_dir, top band first
+def stitch(upload_facility, task_id, count, output_dir):
+    stitched_paths = []
+    for file_name in sorted(os.listdir(tile_dir(upload_facility, task_id, 0))):
+        band_paths = [f'{tile_dir(upload_facility, task_id, index)}{file_name}' for index in reversed(range(count))]
+        target_path = f'{output_dir}{file_name}'
+        if file_name.lower().endswith('.png'):
+            stitch_png(band_paths, target_path)
+        elif file_name.lower().endswith('.exr'):
+            stitch_exr(band_paths, target_path)
+        else:
+            raise Exception(f'cannot stitch {file_name}')
+        stitched_paths.append(target_path)
+    shutil.rmtree(tiles_dir(upload_facility, task_id), ignore_errors=True)
+    return stitched_paths
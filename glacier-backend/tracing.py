@@ -0,0 +1,81 @@
+import contextlib
+import contextvars
+import functools
+import logging
+import time
+
+from config import ServerConfig
+
+logger = logging.getLogger(__name__)
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Trace:
+    __slots__ = ('name', 'start_time', 'spans', 'depth', 'padding_seconds')
+
+    def __init__(self, name):
+        self.name = name
+        self.start_time = time.perf_counter()
+        self.spans = []
+        self.depth = 0
+        self.padding_seconds = 0.0
+
+    def elapsed_ms(self):
+        return 1000.0 * (time.perf_counter() - self.start_time)
+
+    def format(self):
+        lines = []
+        for start_offset, depth, name, duration in sorted(self.spans):
+            lines.append(f'{"  " * (depth + 1)}{name} {1000.0 * duration:.2f}ms (+{1000.0 * start_offset:.2f}ms)')
+        return '\n'.join(lines)
+
+
+# Outside a request there is no trace and a span costs one ContextVar lookup. A padding span is a
+# deliberate wait, like the fixed duration of a password check: it shows in the trace but does not
+# make a request slow.
+@contextlib.contextmanager
+def span(name, is_padding=False):
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    depth = trace.depth
+    trace.depth += 1
+    try:
+        yield
+    finally:
+        trace.depth = depth
+        duration = time.perf_counter() - start_time
+        trace.spans.append((start_time - trace.start_time, depth, name, duration))
+        if is_padding:
+            trace.padding_seconds += duration
+
+
+def traced(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SlowRequestLog(ServerConfig):
+    def __init__(self):
+        super().__init__()
+
+    def start(self, name):
+        trace = Trace(name)
+        return trace, current_trace.set(trace)
+
+    def finish(self, trace, token):
+        current_trace.reset(token)
+        elapsed_ms = trace.elapsed_ms()
+        if elapsed_ms - 1000.0 * trace.padding_seconds >= self.slow_request_ms:
+            logger.warning(f'slow request {trace.name} {elapsed_ms:.2f}ms\n{trace.format()}')
+
+
+slow_request_log = SlowRequestLog()
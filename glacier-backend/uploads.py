@@ -0,0 +1,98 @@
+MAX_FIELD_BYTES = 64 << 10
+
+
+# Incremental multipart/form-data parser for streamed request bodies. Bytes of the part
+# named file_field go to on_file_data as they arrive; other parts are small form fields
+# kept in fields. A delimiter split across chunks is handled by holding back its length.
+class MultipartFileReceiver:
+    def __init__(self, content_type, file_field, on_file_data, max_field_bytes=MAX_FIELD_BYTES):
+        boundary = ''
+        for parameter in content_type.split(';')[1:]:
+            name, _, value = parameter.strip().partition('=')
+            if name.lower() == 'boundary':
+                boundary = value.strip('"')
+        if not content_type.lower().startswith('multipart/form-data') or not boundary:
+            raise Exception('expected a multipart/form-data upload')
+        self.delimiter = b'\r\n--' + boundary.encode()
+        self.file_field = file_field
+        self.on_file_data = on_file_data
+        self.max_field_bytes = max_field_bytes
+        self.buffer = bytearray(b'\r\n')
+        self.state = 'preamble'
+        self.part_name = None
+        self.is_file_part = False
+        self.is_file_received = False
+        self.fields = {}
+
+    def feed(self, data):
+        self.buffer += data
+        while True:
+            if self.state == 'preamble':
+                index = self.buffer.find(self.delimiter)
+                if index < 0:
+                    del self.buffer[:max(0, len(self.buffer) - len(self.delimiter))]
+                    return
+                del self.buffer[:index + len(self.delimiter)]
+                self.state = 'delimiter'
+            elif self.state == 'delimiter':
+                if len(self.buffer) < 2:
+                    return
+                if self.buffer.startswith(b'--'):
+                    self.state = 'done'
+                    return
+                self.state = 'headers'
+            elif self.state == 'headers':
+                index = self.buffer.find(b'\r\n\r\n')
+                if index < 0:
+                    if len(self.buffer) > MAX_FIELD_BYTES:
+                        raise Exception('multipart part headers too large')
+                    return
+                self.start_part(bytes(self.buffer[:index]).decode('utf-8', errors='replace'))
+                del self.buffer[:index + 4]
+                self.state = 'body'
+            elif self.state == 'body':
+                index = self.buffer.find(self.delimiter)
+                if index < 0:
+                    available = len(self.buffer) - len(self.delimiter)
+                    if available > 0:
+                        self.part_data(bytes(self.buffer[:available]))
+                        del self.buffer[:available]
+                    return
+                self.part_data(bytes(self.buffer[:index]))
+                del self.buffer[:index + len(self.delimiter)]
+                if self.is_file_part:
+                    self.is_file_received = True
+                self.state = 'delimiter'
+            else:
+                return
+
+    def start_part(self, headers):
+        self.part_name = None
+        is_file = False
+        for header in headers.split('\r\n'):
+            name, _, value = header.partition(':')
+            if name.strip().lower() != 'content-disposition':
+                continue
+            for parameter in value.split(';')[1:]:
+                key, _, parameter_value = parameter.strip().partition('=')
+                if key == 'name':
+                    self.part_name = parameter_value.strip('"')
+                elif key == 'filename':
+                    is_file = True
+        self.is_file_part = is_file and self.part_name == self.file_field
+        if not self.is_file_part:
+            self.fields[self.part_name] = b''
+
+    def part_data(self, data):
+        if self.is_file_part:
+            self.on_file_data(data)
+            return
+        if len(self.fields[self.part_name]) + len(data) > self.max_field_bytes:
+            raise Exception(f'multipart field {self.part_name} too large')
+        self.fields[self.part_name] += data
+
+    def finish(self):
+        if self.state != 'done':
+            raise Exception('incomplete multipart upload')
+        if not self.is_file_received:
+            raise Exception(f'no {self.file_field} in upload')
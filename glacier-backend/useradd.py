@@ -3,5 +3,6 @@ from config import UserAddConfig
 
 if __name__ == '__main__':
     auth = AuthManager()
+    auth.db.connect()
     config = UserAddConfig()
     auth.add_user(config.glacier_user, config.glacier_password)
@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import signal
+import subprocess
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Warm render backend: one long-lived Blender per slot running blender_worker.py, so
+# chunks after the first skip Blender startup and, for the same task, the file load and
+# scene setup. Selected with RENDER_BACKEND=pool instead of a Blender process per chunk.
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blender_worker.py')
+DONE_MARKER = 'GLACIER_WORKER_DONE'
+READY_MARKER = 'GLACIER_WORKER_READY'
+
+worker_starts = metrics.registry.counter('glacier_worker_starts_total',
+                                         'Pool Blender processes started, including restarts',
+                                         ('slot',))
+
+
+# SIGTERM to the whole process group so Blender's own children go too, SIGKILL for
+# whatever is left after the grace period
+def stop_process_group(process, grace_seconds):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(grace_seconds)
+    except ProcessLookupError:
+        pass
+    except subprocess.TimeoutExpired:
+        logger.warning(f'process {process.pid} ignored SIGTERM for {grace_seconds}s, killing')
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    return process.wait()
+
+
+class BlenderWorker:
+    def __init__(self, blender_bin, slot, kill_grace_seconds):
+        self.blender_bin = blender_bin
+        self.slot = slot
+        self.kill_grace_seconds = kill_grace_seconds
+        self.process = None
+        self.job = None
+        self.lock = threading.Lock()
+        self.job_lock = threading.Lock()
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        device = self.slot.device
+        self.process = subprocess.Popen(
+            [self.blender_bin, '-b', '--factory-startup', '--python', WORKER_SCRIPT] + device.cycles_args(),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True)
+        worker_starts.inc(slot=self.slot.name)
+        for line in self.process.stdout:
+            if line.decode(errors='replace').strip() == READY_MARKER:
+                logger.info(f'blender worker for {self.slot.name} ready, pid {self.process.pid}')
+                return
+        self.stop()
+        raise Exception(f'blender worker for {self.slot.name} exited during startup')
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+        self.process = None
+
+    # Called from another thread while render() is blocked reading the job's output. The process
+    # outlives the job, so a call arriving after the slot moved on to another job does nothing.
+    def interrupt(self, job):
+        with self.job_lock:
+            process = self.process if self.job is job else None
+            if process is None:
+                return
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        stop_process_group(process, self.kill_grace_seconds)
+
+    # Returns the job's exit code; a killed job takes the worker down with it
+    def render(self, job, job_spec, on_line, is_killed):
+        with self.lock:
+            with self.job_lock:
+                self.job = job
+            try:
+                return self.run(job_spec, on_line, is_killed)
+            finally:
+                with self.job_lock:
+                    self.job = None
+
+    def run(self, job_spec, on_line, is_killed):
+        try:
+            if not self.is_alive():
+                self.start()
+            self.process.stdin.write(json.dumps(job_spec).encode() + b'\n')
+            self.process.stdin.flush()
+        except Exception as e:
+            logger.error(f'blender worker for {self.slot.name} unavailable: {e}')
+            self.stop()
+            return 1
+        while True:
+            if is_killed():
+                self.stop()
+                return -9
+            line = self.process.stdout.readline()
+            if not line:
+                return_code = self.process.wait() or 1
+                self.process = None
+                return return_code
+            line = line.decode(errors='replace').strip()
+            if line.startswith(DONE_MARKER):
+                return int(line.split()[1])
+            on_line(line)
+
+
+class WorkerPool:
+    def __init__(self, blender_bin, slots, kill_grace_seconds):
+        self.workers_by_slot = {slot.name: BlenderWorker(blender_bin, slot, kill_grace_seconds) for slot in slots}
+        metrics.registry.gauge('glacier_workers_alive', 'Pool Blender processes currently running',
+                               callback=lambda: sum(1 for worker in self.workers_by_slot.values()
+                                                    if worker.is_alive()))
+
+    def warm_up(self):
+        for worker in self.workers_by_slot.values():
+            try:
+                worker.start()
+            except Exception as e:
+                logger.error(e)
+
+    def render(self, job, job_spec, on_line, is_killed):
+        return self.workers_by_slot[job.slot.name].render(job, job_spec, on_line, is_killed)
+
+    def stop(self):
+        for worker in self.workers_by_slot.values():
+            worker.stop()
+
+    def interrupt(self, job):
+        self.workers_by_slot[job.slot.name].interrupt(job)